@@ -0,0 +1,94 @@
+import numpy
+
+from .iai_transforms import rotationMatrices
+
+
+class AgentStateTable:
+    """The pose of every agent stored as one row per agent in contiguous
+    arrays so that all the agents can be moved at once"""
+
+    fields = ("position",  # ap - absolute pos
+              "rotation",  # ar - absolute rot
+              "speed",  # s - speed
+              "rotationSpeed",  # rs - rot speed
+              "globalVelocity",  # change in position for the last frame
+              "move",  # p - change pos by (set by the brain each frame)
+              "turn")  # r - change rot by (set by the brain each frame)
+
+    def __init__(self, capacity=16):
+        self.count = 0
+        self.capacity = capacity
+        self.ids = []
+        self.index = {}  # {agent id: row}
+        for f in self.fields:
+            setattr(self, f, numpy.zeros((capacity, 3)))
+
+    def grow(self):
+        """Double the number of rows available"""
+        self.capacity *= 2
+        for f in self.fields:
+            old = getattr(self, f)
+            new = numpy.zeros((self.capacity, 3))
+            new[:len(old)] = old
+            setattr(self, f, new)
+
+    def add(self, agentid, location, rotation):
+        """Add a new agent and return the row it is stored in"""
+        if self.count == self.capacity:
+            self.grow()
+        row = self.count
+        self.count += 1
+        self.ids.append(agentid)
+        self.index[agentid] = row
+        self.position[row] = location
+        self.rotation[row] = rotation
+        return row
+
+    def setOutputs(self, row, rx, ry, rz, px, py, pz):
+        """Store what the brain of an agent wants to do this frame"""
+        self.turn[row] = (rx, ry, rz)
+        self.move[row] = (px, py, pz)
+
+    def integrate(self):
+        """Apply the brain outputs of every agent to their poses. Called once
+        all the agents have been evaluated for the frame"""
+        n = self.count
+        self.rotation[:n] += self.turn[:n] + self.rotationSpeed[:n]
+        self.turn[:n] = 0
+
+        move = self.move[:n] + self.speed[:n]
+        rotations = rotationMatrices(-self.rotation[:n])
+        self.globalVelocity[:n] = numpy.einsum("ni,nij->nj", move, rotations)
+        self.position[:n] += self.globalVelocity[:n]
+        self.move[:n] = 0
+
+
+class OrientationCache:
+    """The world to local rotation matrix of every agent (one row per agent,
+    the same as AgentStateTable) for the current frame. Made from
+    sim.state.rotation the first time it is needed and shared by all the
+    channels. Cleared whenever the agents have been moved"""
+    def __init__(self, sim):
+        self.sim = sim
+        self.clear()
+
+    def clear(self):
+        self.rotations = None  # (n, 3, 3) array
+
+    @property
+    def matrices(self):
+        state = self.sim.state
+        n = state.count
+        if self.rotations is None or len(self.rotations) != n:
+            self.rotations = rotationMatrices(state.rotation[:n])
+        return self.rotations
+
+    def toLocal(self, rows, vectors):
+        """Rotate world space vectors into the frame of reference of the
+        agents in rows (see iai_transforms.toLocal)
+
+        :param rows: an agent index or an array of them
+        :param vectors: a vector or (n, 3) array with one for each row"""
+        return numpy.einsum("...i,...ij->...j",
+                            numpy.asarray(vectors, dtype=float),
+                            self.matrices[rows])
@@ -0,0 +1,44 @@
+import numpy
+
+
+class BakeOutput:
+    """Collects the pose of every agent each frame and writes them to the
+    scene in bulk instead of calling keyframe_insert for every agent on
+    every frame"""
+    def __init__(self, sim, flushEvery=None):
+        """:param flushEvery: write the keyframes every this many frames. If
+        None they are only written when flush is called"""
+        self.sim = sim
+        self.flushEvery = flushEvery
+        self.frames = []
+        self.locations = []  # [(n, 3) array, ] - one for each frame
+        self.rotations = []
+
+    def record(self, frame):
+        """Store the current pose of all the agents"""
+        state = self.sim.state
+        n = state.count
+        if self.frames and len(self.locations[-1]) != n:
+            # An agent has been added so the buffers can't be stacked
+            self.flush()
+        self.frames.append(frame)
+        self.locations.append(state.position[:n].copy())
+        self.rotations.append(state.rotation[:n].copy())
+        if self.flushEvery and len(self.frames) >= self.flushEvery:
+            self.flush()
+
+    def flush(self):
+        """Write everything that has been recorded to the F-curves"""
+        if not self.frames:
+            return
+        state = self.sim.state
+        scene = self.sim.scene
+        frames = numpy.array(self.frames, dtype=float)
+        locations = numpy.stack(self.locations)  # (frames, agents, 3)
+        rotations = numpy.stack(self.rotations)
+        for row, agentid in enumerate(state.ids[:locations.shape[1]]):
+            scene.writeKeyframes(agentid, frames, locations[:, row],
+                                 rotations[:, row])
+        self.frames = []
+        self.locations = []
+        self.rotations = []
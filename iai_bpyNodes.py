@@ -326,12 +326,15 @@ class PythonNode(LogicNode):
 
     Expression = bpy.props.StringProperty(default="output = Noise.random")
     # This really needs to link to a text block
+    Vectorized = BoolProperty(default=False)
 
     def draw_buttons(self, context, layout):
         layout.prop(self, "Expression")
+        layout.prop(self, "Vectorized")
 
     def getSettings(self, node):
         node.settings["Expression"] = self.Expression
+        node.settings["Vectorized"] = self.Vectorized
 
 
 class PrintNode(LogicNode):
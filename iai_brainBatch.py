@@ -0,0 +1,277 @@
+"""Evaluate the brains of every agent with the same brain type at once.
+
+Used when the simulation is made with Simulation(batch=True). The schedule of
+the CompiledBrain (see CompiledBrain.buildSchedule) is split in two:
+
+    perAgent: the nodes that can't be evaluated in a batch (mostly Input
+        nodes that query the channels) and only depend on other perAgent
+        nodes. They are evaluated for one agent at a time as normal. Input
+        nodes that are just Channel.attr[.attr...] of a channel with
+        queryBatch (see MasterChannel.queryBatch) ask for every agent at
+        once and go in vector.
+    vector: everything else. Each node is evaluated once for every agent
+        with numpy by its batch method. Nodes that don't have one (or can't
+        with their settings) are evaluated with core for each agent.
+
+The output of a node for every agent in the batch is an ImpulseTable, a
+sparse table of (agent, key id, value) sorted by agent (the key ids are from
+iai_brainClasses.internKey). The entries of each
+agent are kept in the order that the keys would be in the agent's dict and
+everything that adds up over the keys does so in that order (numpy.bincount
+and ufunc.at go through the entries in order) so the results are exactly the
+same as evaluating the agents one by one.
+"""
+
+import numpy
+
+from .iai_brainClasses import ImpulseContainer, State, wrapOutput
+from .iai_brainClasses import internKey, keyNames
+
+
+def power(base, exp):
+    """base**exp for each element using python's pow. numpy.power doesn't
+    always round the same way"""
+    base, exp = numpy.broadcast_arrays(base, exp)
+    return numpy.fromiter(map(pow, base.ravel().tolist(),
+                              exp.ravel().tolist()),
+                          dtype=float, count=base.size)
+
+
+class ImpulseTable:
+    """The outputs of one node for every agent in a batch"""
+    def __init__(self, batch, isNone, agents, codes, values):
+        """:param isNone: bool array of the agents whose output is None
+        :param agents: the agent of each entry (sorted)
+        :param codes: the key id of each entry (see internKey)
+        :param values: the value of each entry"""
+        self.batch = batch
+        self.n = batch.n
+        self.isNone = isNone
+        self.agents = agents
+        self.codes = codes
+        self.values = values
+        self._starts = None
+
+    @classmethod
+    def fromOutputs(cls, batch, outputs):
+        """:param outputs: the ImpulseContainer or None for each agent"""
+        isNone = numpy.ones(batch.n, dtype=bool)
+        agents = []
+        codes = [numpy.zeros(0, dtype=numpy.int64)]
+        values = [numpy.zeros(0)]
+        for a, output in enumerate(outputs):
+            if output is not None:
+                isNone[a] = False
+                ids, vals = output.arrays()
+                agents.append(numpy.full(len(ids), a))
+                codes.append(ids)
+                values.append(vals)
+        if agents:
+            agents = numpy.concatenate(agents)
+        else:
+            agents = numpy.zeros(0, dtype=numpy.int64)
+        # Object arrays stay object arrays
+        return cls(batch, isNone, agents, numpy.concatenate(codes),
+                   numpy.concatenate(values))
+
+    @classmethod
+    def keyed(cls, batch, active, agents, codes, values):
+        """The output of a node that returned a dict for each active agent"""
+        return cls(batch, ~active, agents, codes, values)
+
+    @classmethod
+    def scalar(cls, batch, values, active):
+        """The output of a node whose core returned values (a number or
+        an array with one for each agent) for each active agent"""
+        rows = numpy.flatnonzero(active)
+        values = numpy.broadcast_to(numpy.asarray(values, dtype=float),
+                                    (batch.n,))[rows]
+        return cls(batch, ~active, rows,
+                   numpy.full(len(rows), internKey("None")), values)
+
+    @property
+    def starts(self):
+        """The index of the first entry of each agent (and the end)"""
+        if self._starts is None:
+            self._starts = numpy.searchsorted(self.agents,
+                                              numpy.arange(self.n + 1))
+        return self._starts
+
+    def agentImpulses(self, a):
+        """The output of agent a as an ImpulseContainer (or None). It
+        uses views of the arrays in this table"""
+        if self.isNone[a]:
+            return None
+        s, e = self.starts[a], self.starts[a + 1]
+        return ImpulseContainer.fromArrays(self.codes[s:e], self.values[s:e])
+
+
+def numeric(ins):
+    """If all the values in the tables are numbers"""
+    return all(t.values.dtype != object for t in ins)
+
+
+def gather(ins, active):
+    """The entries of ins for the active agents in the order that
+    "for into in inps: for i in into:" would go through them for each agent
+
+    :returns: agents, codes, values"""
+    agents = []
+    codes = []
+    values = []
+    for t in ins:
+        use = active[t.agents]
+        agents.append(t.agents[use])
+        codes.append(t.codes[use])
+        values.append(t.values[use])
+    if not agents:
+        return (numpy.zeros(0, dtype=numpy.int64),
+                numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0))
+    agents = numpy.concatenate(agents)
+    order = numpy.argsort(agents, kind="stable")
+    return (agents[order], numpy.concatenate(codes)[order],
+            numpy.concatenate(values)[order])
+
+
+def groups(batch, agents, codes):
+    """Group the entries by (agent, key) like adding them to a dict for each
+    agent would
+
+    :returns: first, group. first is the index of the first entry of each
+        group in the order they were added. group is the group of each
+        entry"""
+    combined = agents * max(1, len(keyNames)) + codes
+    uniq, first, inverse = numpy.unique(combined, return_index=True,
+                                        return_inverse=True)
+    order = numpy.argsort(first)
+    rank = numpy.empty_like(order)
+    rank[order] = numpy.arange(len(order))
+    return first[order], rank[inverse.ravel()]
+
+
+def lookup(agents, codes, table):
+    """Find the entries of table with the same (agent, key) as each of the
+    entries given by agents and codes
+
+    :returns: found, values. found is a bool array of the entries that were
+        found and values is the value from table for each found entry"""
+    k = max(1, len(keyNames))
+    combined = table.agents * k + table.codes
+    order = numpy.argsort(combined, kind="stable")
+    combined = combined[order]
+    want = agents * k + codes
+    pos = numpy.minimum(numpy.searchsorted(combined, want),
+                        max(0, len(combined) - 1))
+    if len(combined) == 0:
+        return numpy.zeros(len(want), dtype=bool), table.values[:0]
+    found = combined[pos] == want
+    return found, table.values[order[pos[found]]]
+
+
+def lastValues(values, group, count):
+    """The value of the last entry in each group"""
+    last = numpy.zeros(count, dtype=numpy.int64)
+    numpy.maximum.at(last, group, numpy.arange(len(group)))
+    return values[last]
+
+
+def perAgentSum(batch, agents, values):
+    """The sum of values for each agent, added up in order starting from 0"""
+    return numpy.bincount(agents, weights=values, minlength=batch.n)
+
+
+def perAgentCount(batch, agents):
+    return numpy.bincount(agents, minlength=batch.n)
+
+
+class BatchPlan:
+    """How the schedule of a CompiledBrain is split up (see the top of this
+    file)"""
+    def __init__(self, compiled):
+        self.perAgent = []
+        self.vector = []
+        perAgentSlots = set()
+        for neur in compiled.schedule:
+            # States with an input in vector have to go in vector too
+            canBatch = not isinstance(neur, State) and neur.hasBatch()
+            if not canBatch and perAgentSlots.issuperset(neur.inputSlots):
+                self.perAgent.append(neur)
+                perAgentSlots.add(neur.slot)
+            else:
+                self.vector.append(neur)
+
+
+class BrainBatch:
+    """The brains of the agents with one brain type for one frame"""
+    def __init__(self, compiled, brains):
+        self.compiled = compiled
+        self.brains = brains
+        self.n = len(brains)
+        self.sim = compiled.sim
+        self.activeStates = [b.activeState for b in brains]
+        self.tables = {}  # {slot: ImpulseTable}
+
+    def table(self, slot):
+        """The outputs of the neuron in slot for every agent"""
+        if slot not in self.tables:
+            self.tables[slot] = ImpulseTable.fromOutputs(
+                self, [b.results[slot] for b in self.brains])
+        return self.tables[slot]
+
+    def noneTable(self):
+        return ImpulseTable.scalar(self, 0, numpy.zeros(self.n, dtype=bool))
+
+    def guardMask(self, guard):
+        """The agents for which a neuron with guard is evaluated"""
+        if guard is None:
+            return numpy.ones(self.n, dtype=bool)
+        return numpy.array([s in guard for s in self.activeStates],
+                           dtype=bool)
+
+    def evaluateEach(self, neur, ins, active):
+        """Evaluate neur for each agent in turn with core"""
+        outputs = []
+        for a, brain in enumerate(self.brains):
+            if not active[a]:
+                outputs.append(None)
+                continue
+            for var in brain.lvars.values():
+                var.setuser(brain.userid)
+            inps = [t.agentImpulses(a) for t in ins if not t.isNone[a]]
+            outputs.append(wrapOutput(neur.core(brain, inps, neur.settings)))
+        return ImpulseTable.fromOutputs(self, outputs)
+
+    def execute(self):
+        compiled = self.compiled
+        if compiled.batchPlan is None:
+            compiled.batchPlan = BatchPlan(compiled)
+        plan = compiled.batchPlan
+
+        for brain in self.brains:
+            brain.prepare()
+            for neur in plan.perAgent:
+                neur.evaluate(brain)
+
+        for neur in plan.vector:
+            ins = [self.table(i) for i in neur.inputSlots]
+            active = self.guardMask(neur.guard)
+            out = None
+            if numeric(ins) or isinstance(neur, State):
+                out = neur.batch(self, ins, active)
+            if out is None:
+                out = self.evaluateEach(neur, ins, active)
+            self.tables[neur.slot] = out
+
+        for a, brain in enumerate(self.brains):
+            if brain.capturing:
+                for neur in plan.vector:
+                    brain.results[neur.slot] = \
+                        self.tables[neur.slot].agentImpulses(a)
+                brain.recordOutputs()
+            brain.evaluateStates()
+
+
+def executeBatch(compiled, brains):
+    """Evaluate brains (that all use compiled) for this frame. Does the same
+    as calling execute on each of them"""
+    BrainBatch(compiled, brains).execute()
@@ -2,14 +2,29 @@ from . import iai_channels as chan
 import random
 import functools
 
-import bpy
-
-import mathutils
+import numpy
 
 from .iai_debuggingMode import debugMode
 
 
+# Every key that is put in an ImpulseContainer is given a number so that the
+#  keys can be stored in an array (see ImpulseContainer.arrays)
+keyIds = {}  # {key: id}
+keyNames = []  # The key with each id
+
+
+def internKey(key):
+    """The id of key in keyNames"""
+    i = keyIds.get(key)
+    if i is None:
+        i = keyIds[key] = len(keyNames)
+        keyNames.append(key)
+    return i
+
+
 class Impulse():
+    """A single key and value. Only made when an ImpulseContainer is iterated
+    over (by expressions and scripts). The nodes use items() instead"""
     def __init__(self, tup):
         if debugMode:
             assert isinstance(tup[0], str), "Impulse key should be type str"
@@ -20,175 +35,292 @@ class Impulse():
 
 
 class ImpulseContainer():
-    # TODO Isn't this just a dictionary?!?!?!
+    """The output of a neuron. Maps keys (usually agent names) to values.
+
+    Either made from a dict or from an array of key ids (see internKey) and
+    an array of values with fromArrays. The other form is only made if it
+    is asked for so the arrays can be views into an ImpulseTable (see
+    iai_brainBatch) without copying them"""
     def __init__(self, cont):
-        self.cont = cont
+        self._cont = cont
+        self._ids = None
+        self._vals = None
+
+    @classmethod
+    def fromArrays(cls, ids, vals):
+        ic = cls(None)
+        ic._ids = ids
+        ic._vals = vals
+        return ic
+
+    @property
+    def cont(self):
+        """The keys and values as a dict"""
+        if self._cont is None:
+            self._cont = dict(zip(map(keyNames.__getitem__,
+                                      self._ids.tolist()),
+                                  self._vals.tolist()))
+        return self._cont
+
+    def arrays(self):
+        """The key ids and values as numpy arrays. The values are float64
+        unless there are values that aren't numbers"""
+        if self._ids is None:
+            cont = self._cont
+            n = len(cont)
+            self._ids = numpy.fromiter(map(internKey, cont),
+                                       dtype=numpy.int64, count=n)
+            try:
+                self._vals = numpy.fromiter(cont.values(), dtype=float,
+                                            count=n)
+            except (TypeError, ValueError):
+                self._vals = numpy.empty(n, dtype=object)
+                self._vals[:] = list(cont.values())
+        return self._ids, self._vals
 
     def __getitem__(self, key):
         if key in self.cont:
-            if isinstance(self.cont[key], Impulse):
-                return self.cont[key]
-            else:
-                return Impulse((key, self.cont[key]))
+            return Impulse((key, self.cont[key]))
 
     def __iter__(self):
-        return iter([Impulse(x) for x in self.cont.items()])
-        # This gets calculated every time the input is looked at
-        # Better to calculate in __init__?
-        # Do iter objects need making each time
+        return (Impulse(x) for x in self.cont.items())
 
     def __contains__(self, item):
         return item in self.cont
 
     def __len__(self):
-        return len(self.cont)
+        if self._cont is None:
+            return len(self._ids)
+        return len(self._cont)
+
+    def get(self, key, default=None):
+        return self.cont.get(key, default)
+
+    def keys(self):
+        return self.cont.keys()
 
     def values(self):
         return self.cont.values()
 
+    def items(self):
+        return self.cont.items()
+
     def __repr__(self):
         return "Impusle container(" + str(self.cont) + ")"
 
 
+def wrapOutput(im):
+    """Turn what is returned by Neuron.core into the output of the neuron"""
+    if isinstance(im, dict):
+        return ImpulseContainer(im)
+    elif isinstance(im, ImpulseContainer):
+        if debugMode:
+            print("iai_brainClasses.py - This should not be allowed")
+        return im
+    elif im is None:
+        return im
+    else:
+        return ImpulseContainer({"None": im})
+
+
+def outputAverage(output):
+    """The average of the values in the output of a neuron (nan if it is
+    None or empty). All that is kept for highlighting the node"""
+    if output:
+        return sum(output.values()) / len(output)
+    return float("nan")
+
+
+def nodeColour(av):
+    """The colour that a node is displayed in when the agent is selected
+    from the outputAverage of the node"""
+    if av == av:
+        val = 1
+        if av > 0:
+            startHue = 0.333
+        else:
+            startHue = 0.5
+
+        if av > 1:
+            hueChange = -(-(abs(av)+1)/abs(av) + 2) * (1/3)
+            hue = 0.333 + hueChange
+            sat = 1
+        elif av < -1:
+            hueChange = (-(abs(av)+1)/abs(av) + 2) * (1/3)
+            hue = 0.5 + hueChange
+            sat = 1
+        else:
+            hue = startHue
+
+        if abs(av) < 1:
+            sat = abs(av)**(1/2)
+        else:
+            sat = 1
+    else:
+        hue = 0
+        sat = 0
+        val = 0.5
+    return hue, sat, val
+
+
 class Neuron():
-    """The representation of the nodes. Not to be used on own"""
-    def __init__(self, brain, bpyNode):
-        self.brain = brain  # type: Brain
-        self.neurons = self.brain.neurons  # type: List[Neuron]
+    """The representation of the nodes. Not to be used on own. Each neuron is
+    shared by all the agents with the same brain (see CompiledBrain) so
+    anything that changes during the simulation is kept in the BrainInstance
+    that is passed in"""
+    # Returned by hasSideEffects and isPure
+    sideEffects = True
+    pure = False
+
+    def __init__(self, compiled, bpyNode, name):
+        self.compiled = compiled  # type: CompiledBrain
+        self.neurons = compiled.neurons  # type: Dict[str, Neuron]
+        self.name = name
         self.inputs = []  # type: List[str] - strings are names of neurons
-        self.result = None  # type: None | ImpulseContainer - Cache for current
-        self.resultLog = [(0, 0, 0), (0, 0, 0)]  # type: List[(int, int, int)]
-        self.fillOutput = bpy.props.BoolProperty(default=True)
         self.bpyNode = bpyNode  # type: iai_bpyNodes.LogicNode
         self.settings = {}  # type: Dict[str, bpy.props.*]
         self.dependantOn = []  # type: List[str] - strings are names of neurons
 
-    def evaluate(self):
-        """Called by any neurons that take this neuron as an input"""
-        if self.result:
-            # Return a cached version of the answer if possible
-            return self.result
-        noDeps = len(self.dependantOn) == 0
-        dep = True in [self.neurons[x].isCurrent for x in self.dependantOn]
+        # set by CompiledBrain.buildSchedule
+        self.slot = None  # type: int - index in BrainInstance.results
+        self.inputSlots = ()  # type: Tuple[int] - slots of self.inputs
+        self.guard = None  # type: FrozenSet[str] | None - see buildSchedule
+
+    def setup(self):
+        """Called by iai_compileBrain.compileBrain once the settings and
+        inputs have been set. Work that only depends on them can be done
+        here instead of every time the node is evaluated"""
+        pass
+
+    def emit(self, settings):
+        """Used by iai_brainCodegen to inline this node. Returns None if the
+        node can't be inlined or (lines, kind) where lines is the python
+        source of core (reading inps as a list of dicts and brain and setting
+        im) with settings written in as constants and kind is "dict",
+        "number" or "any" for the type of im"""
+        return None
+
+    def hasSideEffects(self):
+        """If evaluating this node does anything other than give an output.
+        If not it can be removed when nothing uses its output (see
+        iai_compileBrain.optimiseBrain)"""
+        return self.sideEffects
+
+    def isPure(self):
+        """If the output only depends on the inputs and settings. Then the
+        output is worked out once if all the inputs are constant and nodes
+        that do the same thing to the same inputs are merged"""
+        return self.pure
+
+    def hasBatch(self):
+        """If batch can be used for this node (see iai_brainBatch.BatchPlan)"""
+        return type(self).batch is not Neuron.batch
+
+    def batch(self, batch, ins, active):
+        """Used by iai_brainBatch to evaluate this node for lots of agents at
+        once. Returns None if it can't or an ImpulseTable
+
+        :param batch: the BrainBatch being evaluated
+        :param ins: the ImpulseTable of each of self.inputs
+        :param active: bool array of the agents that pass self.guard"""
+        return None
+
+    def evaluate(self, brain):
+        """Called once a frame in the order of CompiledBrain.schedule so the
+        inputs have already been evaluated"""
+        results = brain.results
+        guard = self.guard
         # Only output something if the node isn't dependant on a state
         #  or if one of it's dependancies is the current state
-        if noDeps or dep:
+        if guard is None or brain.activeState in guard:
             inps = []
-            for i in self.inputs:
-                got = self.neurons[i].evaluate()
+            for i in self.inputSlots:
+                got = results[i]
                 """For each of the inputs the result is collected. If the
                 input in not a dictionary then it is made into one"""
                 if got is not None:
                     inps.append(got)
-            im = self.core(inps, self.settings)
-            if isinstance(im, dict):
-                output = ImpulseContainer(im)
-            elif isinstance(im, ImpulseContainer):
-                if debugMode:
-                    print("iai_brainClasses.py - This should not be allowed")
-                output = im
-            elif im is None:
-                output = im
-            else:
-                output = ImpulseContainer({"None": im})
+            output = wrapOutput(self.core(brain, inps, self.settings))
         else:
             output = None
-        self.result = output
-
-        # Calculate the colour that would be displayed in the agent is selected
-        total = 0
-        if output:
-            val = 1
-            av = sum(output.values()) / len(output)
-            if av > 0:
-                startHue = 0.333
-            else:
-                startHue = 0.5
-
-            if av > 1:
-                hueChange = -(-(abs(av)+1)/abs(av) + 2) * (1/3)
-                hue = 0.333 + hueChange
-                sat = 1
-            elif av < -1:
-                hueChange = (-(abs(av)+1)/abs(av) + 2) * (1/3)
-                hue = 0.5 + hueChange
-                sat = 1
-            else:
-                hue = startHue
-
-            if abs(av) < 1:
-                sat = abs(av)**(1/2)
-            else:
-                sat = 1
-        else:
-            hue = 0
-            sat = 0
-            val = 0.5
-        self.resultLog[-1] = (hue, sat, val)
-
+        results[self.slot] = output
         return output
 
-    def newFrame(self):
-        self.result = None
-        self.resultLog.append((0, 0, 0.5))
-
-    def highLight(self, frame):
+    def highLight(self, brain, frame):
         """Colour the nodes in the interface to reflect the output"""
-        hue, sat, val = self.resultLog[frame]
-        self.bpyNode.use_custom_color = True
-        c = mathutils.Color()
-        c.hsv = hue, sat, val
-        self.bpyNode.color = c
-        self.bpyNode.keyframe_insert("color")
+        av = brain.highlights.get(frame, self.name)
+        self.compiled.sim.scene.colourNode(self.bpyNode, nodeColour(av))
         # self.bpyNode.update()
 
 
 class State():
     """The basic element of the state machine. Abstract class"""
-    def __init__(self, brain, bpyNode, name):
+    def __init__(self, compiled, bpyNode, name):
         """A lot of the fields are modified by the compileBrain function"""
         self.name = name
-        self.brain = brain
-        self.neurons = self.brain.neurons
+        self.compiled = compiled
+        self.neurons = compiled.neurons
         self.outputs = []
         self.valueInputs = []  # Left empty by start state
-        self.finalValue = 1.0
-        self.finalValueCalcd = False
         self.settings = {}
-        self.isCurrent = False
 
-        self.length = 0
+        self.length = 0  # The length for each agent is in brain.stateLength
         self.cycleState = False
-        self.currentFrame = 0
 
         self.bpyNode = bpyNode
-        self.resultLog = {0:(0, 0, 0), 1:(0, 0, 0)}
 
-    def query(self):
+        # set by CompiledBrain.buildSchedule. Only states with valueInputs
+        #  are in the schedule
+        self.slot = None
+        self.inputSlots = ()
+        self.guard = None
+        # set by setup. The states that can be moved to at the end of this
+        #  one in the order they are checked
+        self.candidates = ()  # type: Tuple[State]
+
+    def setup(self):
+        """Called by iai_compileBrain.compileBrain once all the neurons have
+        been made. Works out the transitions from this state"""
+        candidates = [self.neurons[con] for con in self.outputs]
+        # If the cycleState button is checked then add a contection back to
+        #    this state again.
+        if self.cycleState and self.name not in self.outputs:
+            candidates.append(self)
+        self.candidates = tuple(candidates)
+
+    def query(self, brain):
         """If this state is a valid next move return float > 0"""
-        if not self.finalValueCalcd:
-            self.evaluate()
-        # print("query", self.name, self.finalValue)
-        return self.finalValue
+        if self.slot is None:
+            return self.settings["ValueDefault"]
+        # print("query", self.name, brain.finalValues[self.name])
+        return brain.finalValues[self.name]
 
-    def moveTo(self):
+    def moveTo(self, brain):
         """Called when the current state moves to this node"""
         # print("Moving to a new state:", self.name)
-        self.currentFrame = 0
-        self.isCurrent = True
+        brain.stateFrame[self.name] = 0
 
-    def evaluate(self):
-        """Called while all the neurons are being evaluated"""
-        if self.finalValueCalcd:
-            return
-        self.finalValueCalcd = True
+    def evaluate(self, brain):
+        """Called once a frame in the order of CompiledBrain.schedule"""
+        brain.results[self.slot] = None
         if len(self.valueInputs) == 0:
-            self.finalValue = self.settings["ValueDefault"]
+            brain.finalValues[self.name] = self.settings["ValueDefault"]
             return
-        values = []
-        for inp in self.valueInputs:
-            values.append(self.neurons[inp].evaluate())
+        values = [brain.results[i] for i in self.inputSlots]
+        brain.finalValues[self.name] = self.combine(values)
+
+    def batch(self, batch, ins, active):
+        """evaluate for every agent in a BrainBatch (see iai_brainBatch)"""
+        for a, brain in enumerate(batch.brains):
+            if len(self.valueInputs) == 0:
+                brain.finalValues[self.name] = self.settings["ValueDefault"]
+            else:
+                brain.finalValues[self.name] = self.combine(
+                    [t.agentImpulses(a) for t in ins])
+        return batch.noneTable()
 
+    def combine(self, values):
+        """The value of this state from the outputs of self.valueInputs"""
         total = 0
         num = 0
         vals = []
@@ -210,127 +342,337 @@ class State():
             result = max(vals)
         elif self.settings["ValueFilter"] == "MIN":
             result = min(vals)
-        self.finalValue = result
+        return result
 
-    def evaluateState(self):
+    def evaluateState(self, brain):
         """Return the state to move to (allowed to return itself)
 
         :returns: moving to new state, name of new state or None
         :rtype: bool, string | None
         """
-        self.currentFrame += 1
+        brain.stateFrame[self.name] += 1
+        currentFrame = brain.stateFrame[self.name]
+        length = brain.stateLength[self.name]
 
         """Check to see if the current state is still playing an animation"""
-        # print("currentFrame", self.currentFrame, "length", self.length)
-        # print("Value compared", self.length - 2 - self.settings["Fade out"])
+        # print("currentFrame", currentFrame, "length", length)
+        # print("Value compared", length - 2 - self.settings["Fade out"])
 
         # The proportion of the way through the state
-        if self.length == 0:
+        if length == 0:
             complete = 1
         else:
-            complete = self.currentFrame/self.length
+            complete = currentFrame/length
             complete = 0.5 + complete/2
-        sceneFrame = bpy.context.scene.frame_current
-        self.resultLog[sceneFrame] = ((0.15, 0.4, complete))
+        brain.recordHighlight(self.name, complete)
 
-        if self.currentFrame < self.length - 1:
+        if currentFrame < length - 1:
             return False, self.name
 
         # ==== Will stop here is this state hasn't reached its end ====
 
-        options = []
-        for con in self.outputs:
-            val = self.neurons[con].query()
-            # print(con, val)
-            if val is not None:
-                options.append((con, val))
+        return self.nextState(brain)
 
-        # If the cycleState button is checked then add a contection back to
-        #    this state again.
-        if self.cycleState and self.name not in self.outputs:
-            val = self.neurons[self.name].query()
-            # print(con, val)
-            if val is not None:
-                options.append((self.name, val))
-
-        if len(options) > 0:
-            if len(options) == 1:
-                return True, options[0][0]
-            else:
-                return True, max(options, key=lambda v: v[1])[0]
+    def nextState(self, brain):
+        """Pick which of self.candidates to move to at the end of this state
+        (see evaluateState)"""
+        best = None
+        bestVal = None
+        for con in self.candidates:
+            val = con.query(brain)
+            # The first is kept if there is a tie
+            if val is not None and (best is None or val > bestVal):
+                best = con
+                bestVal = val
 
-        return False, None
+        if best is not None:
+            return True, best.name
 
-    def newFrame(self):
-        self.finalValueCalcd = False
+        return False, None
 
-    def highLight(self, frame):
-        if frame in self.resultLog:
-            hue, sat, val = self.resultLog[frame]
+    def highLight(self, brain, frame):
+        complete = brain.highlights.get(frame, self.name)
+        if complete == complete:
+            hsv = (0.15, 0.4, complete)
         else:
-            hue = 0.0
-            sat = 0.0
-            val = 1.0
-        self.bpyNode.use_custom_color = True
-        c = mathutils.Color()
-        c.hsv = hue, sat, val
-        self.bpyNode.color = c
-        self.bpyNode.keyframe_insert("color")
-
-
-class Brain():
-    """An executable brain object. One created per agent"""
-    def __init__(self, sim, userid):
-        self.userid = userid
-        self.sim = sim
-        self.agvars = {}
-        self.lvars = self.sim.lvars
-        self.outvars = {}
-        self.tags = {}
-        self.isActiveSelection = False
+            # Not the current state on that frame
+            hsv = (0.0, 0.0, 1.0)
+        self.compiled.sim.scene.colourNode(self.bpyNode, hsv)
 
-        self.currentState = None
-        self.startState = None
+
+class CompiledBrain():
+    """The parts of a brain that are the same for every agent that uses it.
+    Made once for each brain type by compileBrain"""
+    def __init__(self, sim):
+        self.sim = sim
 
         # set in compileBrian
         self.outputs = []
         self.neurons = {}
-        self.states = []
+        self.states = []  # The names of the states
+        self.startState = None
+
+        # set by buildSchedule
+        self.schedule = []  # The neurons in the order they are evaluated
+        # set by iai_compileBrain.optimiseBrain
+        self.aliases = {}  # {name: the neuron it was merged into}
+        self.optimised = None  # What was changed. See optimiseBrain
+
+        # set by iai_brainCodegen when the simulation uses codegen
+        self.function = None  # Evaluates the whole schedule for a brain
+        self.source = None
+        # set by iai_brainBatch the first time it is used
+        self.batchPlan = None
 
     def setStartState(self, stateNode):
         """Used by compileBrian"""
-        self.currentState = stateNode
         self.startState = stateNode
 
+    def buildSchedule(self):
+        """Put every neuron that self.outputs depends on into self.schedule so
+        that each comes after all of its inputs. Called by compileBrain once
+        all the neurons have been added.
+
+        The order is the same as a depth first search from each of the
+        outputs in turn. The guard of each neuron is the set of states that
+        have to be active for it to be evaluated (or None if it always is).
+        That is its own dependantOn limited to the states in which anything
+        that uses it is evaluated."""
+        def inputsOf(neur):
+            if isinstance(neur, State):
+                return neur.valueInputs
+            return neur.inputs
+
+        schedule = []
+        done = set()
+        visiting = set()
+        for out in self.outputs:
+            if out in done:
+                continue
+            stack = [(out, iter(inputsOf(self.neurons[out])))]
+            visiting.add(out)
+            while stack:
+                name, inps = stack[-1]
+                for inp in inps:
+                    if inp in visiting:
+                        print("Ignoring the loop in the brain from", inp,
+                              "to", name)
+                    elif inp not in done:
+                        visiting.add(inp)
+                        stack.append((inp,
+                                      iter(inputsOf(self.neurons[inp]))))
+                        break
+                else:
+                    stack.pop()
+                    visiting.discard(name)
+                    done.add(name)
+                    schedule.append(self.neurons[name])
+        self.setSchedule(schedule)
+
+    def setSchedule(self, schedule):
+        """Set the slots, inputSlots and guards of the neurons for
+        schedule (see buildSchedule)"""
+        def inputsOf(neur):
+            if isinstance(neur, State):
+                return neur.valueInputs
+            return neur.inputs
+
+        for neur in self.neurons.values():
+            neur.slot = None
+        for slot, neur in enumerate(schedule):
+            neur.slot = slot
+        for neur in schedule:
+            neur.inputSlots = tuple(self.neurons[i].slot
+                                    for i in inputsOf(neur)
+                                    if self.neurons[i].slot is not None and
+                                    self.neurons[i].slot < neur.slot)
+
+        """Work backwards from the outputs. reach is the set of states in
+        which something that uses the neuron is evaluated"""
+        reach = {name: None for name in self.outputs}
+        for neur in reversed(schedule):
+            guard = reach.get(neur.name, frozenset())
+            deps = getattr(neur, "dependantOn", None)
+            if deps:
+                if guard is None:
+                    guard = frozenset(deps)
+                else:
+                    guard = guard & frozenset(deps)
+            neur.guard = guard
+            for i in inputsOf(neur):
+                if i not in reach:
+                    reach[i] = guard
+                elif reach[i] is not None:
+                    reach[i] = None if guard is None else reach[i] | guard
+
+        self.schedule = schedule
+
+    def instance(self, userid):
+        """Make the brain of an agent"""
+        return BrainInstance(self, userid)
+
+
+class HighlightLog():
+    """What the nodes of one agent's brain did over the last size frames.
+    Only the outputAverage of each neuron and how far through each state is
+    are kept. The colours are worked out when the nodes are highlighted"""
+    def __init__(self, compiled, size):
+        self.size = max(1, size)
+        self.columns = {name: i for i, name in enumerate(compiled.neurons)}
+        self.frames = numpy.full(self.size, -1, dtype=numpy.int64)
+        self.values = numpy.full((self.size, len(self.columns)), numpy.nan)
+
+    def row(self, frame):
+        """The row for frame. Overwrites the oldest frame the first time"""
+        r = frame % self.size
+        if self.frames[r] != frame:
+            self.frames[r] = frame
+            self.values[r] = numpy.nan
+        return r
+
+    def record(self, frame, name, value):
+        self.values[self.row(frame), self.columns[name]] = value
+
+    def get(self, frame, name):
+        """nan if nothing was recorded or frame isn't kept any more"""
+        r = frame % self.size
+        if self.frames[r] != frame:
+            return float("nan")
+        return float(self.values[r, self.columns[name]])
+
+    def frameValues(self, frame):
+        """Everything recorded for frame as an array (or None)"""
+        r = frame % self.size
+        if self.frames[r] != frame:
+            return None
+        return self.values[r].copy()
+
+    def setFrameValues(self, frame, values):
+        self.values[self.row(frame)] = values
+
+
+class BrainInstance():
+    """An executable brain object. One created per agent. Only holds what
+    changes while the simulation runs, the nodes are in self.compiled"""
+    def __init__(self, compiled, userid):
+        self.compiled = compiled
+        self.neurons = compiled.neurons
+        self.outputs = compiled.outputs
+        self.userid = userid
+        self.sim = compiled.sim
+        self.agvars = {"None": None}
+        self.lvars = self.sim.lvars
+        self.outvars = {}
+        # The tags this agent has. Other agents see them one frame later
+        #  through Agent.access (see Agent.swapBuffers)
+        self.tags = {}
+        # {tag: value or None if removed} since the last Agent.apply
+        self.tagChanges = {}
+        self.isActiveSelection = False
+        # If what the nodes do this frame is being kept in self.highlights
+        #  (see Simulation.enableHighlights)
+        self.capturing = False
+        self.highlights = None  # type: HighlightLog
+
+        self.currentState = compiled.startState
+        # The state that nodes which are dependant on a state see as current.
+        #  None until the state machine has been evaluated once
+        self.activeState = None
+
+        # The output of each neuron in the schedule for this frame. There is
+        #  no need to clear it as the schedule overwrites every slot
+        self.results = [None] * len(compiled.schedule)
+        self.finalValues = {}  # {state name: value} for this frame
+        self.stateFrame = {s: 0 for s in compiled.states}
+        self.stateLength = {s: self.neurons[s].length for s in compiled.states}
+
+    def setTag(self, tag, value):
+        """Use this rather than modifying self.tags so that the change is
+        passed on to sim.tagRegistry"""
+        self.tags[tag] = value
+        self.tagChanges[tag] = value
+
+    def removeTag(self, tag):
+        if tag in self.tags:
+            del self.tags[tag]
+            self.tagChanges[tag] = None
+
     def reset(self):
         self.outvars = {"rx": 0, "ry": 0, "rz": 0,
                         "px": 0, "py": 0, "pz": 0}
-        self.tags = self.sim.agents[self.userid].access["tags"]
-        # self.tags = {}
-        self.agvars = self.sim.agents[self.userid].agvars
 
-    def execute(self):
-        """Called for each time the agents needs to evaluate"""
-        actv = bpy.context.active_object
-        self.isActiveSelection = actv is not None and actv.name == self.userid
+    def prepare(self):
+        """Get ready to evaluate the neurons for this frame"""
+        actv = self.sim.scene.getActiveName()
+        self.isActiveSelection = actv == self.userid
+        frames = self.sim.highlightFrames
+        self.capturing = frames is not None and (
+            self.isActiveSelection or self.sim.scene.isSelected(self.userid))
+        if self.capturing:
+            self.highlightLog()
         self.reset()
         for name, var in self.lvars.items():
             var.setuser(self.userid)
-        for neur in self.neurons.values():
-            neur.newFrame()
-        for out in self.outputs:
-            self.neurons[out].evaluate()
+
+    def execute(self):
+        """Called for each time the agents needs to evaluate"""
+        self.prepare()
+        compiled = self.compiled
+        if compiled.function is not None:
+            compiled.function(self)
+        else:
+            for neur in compiled.schedule:
+                neur.evaluate(self)
+        if self.capturing:
+            self.recordOutputs()
+        self.evaluateStates()
+
+    def evaluateStates(self):
+        """Move the state machine on once the neurons have been evaluated"""
+        prof = self.sim.profiler
+        if prof is not None:
+            t = prof.now()
         if self.currentState:
-            new, nextState = self.neurons[self.currentState].evaluateState()
-            self.neurons[self.currentState].isCurrent = False
+            new, nextState = self.neurons[self.currentState].evaluateState(
+                self)
             if nextState is None:
-                nextState = self.startState
+                nextState = self.compiled.startState
             self.currentState = nextState
-            self.neurons[self.currentState].isCurrent = True
+            self.activeState = nextState
             if new:
-                self.neurons[nextState].moveTo()
+                self.neurons[nextState].moveTo(self)
+        if prof is not None:
+            prof.add("states", t)
+
+    def highlightLog(self):
+        """self.highlights. Made if there isn't one the right size yet"""
+        frames = self.sim.highlightFrames
+        if self.highlights is None or self.highlights.size != max(1, frames):
+            self.highlights = HighlightLog(self.compiled, frames)
+        return self.highlights
+
+    def recordOutputs(self):
+        """Keep the outputAverage of each neuron for this frame"""
+        frame = self.sim.scene.frameCurrent
+        results = self.results
+        for neur in self.compiled.schedule:
+            if not isinstance(neur, State):
+                self.highlights.record(frame, neur.name,
+                                       outputAverage(results[neur.slot]))
+        for name, target in self.compiled.aliases.items():
+            slot = self.neurons[target].slot
+            if slot is not None:
+                self.highlights.record(frame, name,
+                                       outputAverage(results[slot]))
+
+    def recordHighlight(self, name, value):
+        """Used by the states to keep how far through they are"""
+        if self.capturing:
+            self.highlights.record(self.sim.scene.frameCurrent, name, value)
 
     def hightLight(self, frame):
         """This will be called for the agent that is the active selection"""
+        if self.highlights is None:
+            return
         for n in self.neurons.values():
-            n.highLight(frame)
+            n.highLight(self, frame)
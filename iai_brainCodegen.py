@@ -0,0 +1,103 @@
+"""Compile a whole brain into one python function.
+
+Used instead of evaluating the neurons one at a time when the simulation is
+made with Simulation(codegen=True). The schedule of the CompiledBrain (see
+CompiledBrain.buildSchedule) is written out as straight line python. The
+nodes that have an emit method are inlined with their settings written in as
+constants and the rest call Neuron.evaluate as normal. The results are the
+same as evaluating the neurons.
+
+The source is cached by a hash of the brain graph so each node group is only
+turned into source and compiled once. The source of a brain is kept in
+CompiledBrain.source and can be printed to see what is being run. It is also
+put into linecache so that errors show the line that caused them.
+"""
+
+import hashlib
+import json
+import linecache
+
+from .iai_brainClasses import ImpulseContainer, State
+
+# {hash of brain graph: (source, code object)}
+sourceCache = {}
+
+
+def graphHash(brainGraph):
+    """A hash of everything in the brain graph that affects the source"""
+    graph = [{k: v for k, v in desc.items() if k != "bpyNode"}
+             for desc in brainGraph]
+    text = json.dumps(graph, sort_keys=True, default=repr)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def indent(lines, n):
+    return [" " * n + line for line in lines]
+
+
+def generateSource(compiled, funcName):
+    """The source of a function that takes a BrainInstance and does the same
+    as evaluating every neuron in compiled.schedule"""
+    lines = ["def {}(brain):".format(funcName),
+             "    results = brain.results",
+             "    activeState = brain.activeState"]
+    for neur in compiled.schedule:
+        slot = neur.slot
+        lines += ["", "    # {} ({})".format(neur.name,
+                                           type(neur).__name__)]
+        emitted = None
+        if not isinstance(neur, State):
+            emitted = neur.emit(neur.settings)
+        if emitted is None:
+            lines += ["    n{}.evaluate(brain)".format(slot)]
+            continue
+        body, kind = emitted
+        if kind == "dict":
+            wrap = ["r = IC(im)"]
+        elif kind == "number":
+            wrap = ["r = IC({'None': im})"]
+        else:
+            wrap = ["if im is None:",
+                    "    r = None",
+                    "elif isinstance(im, dict):",
+                    "    r = IC(im)",
+                    "elif isinstance(im, IC):",
+                    "    r = im",
+                    "else:",
+                    "    r = IC({'None': im})"]
+        inps = "".join("results[{}], ".format(i) for i in neur.inputSlots)
+        block = ["inps = [x.cont for x in ({}) if x is not None]".format(
+                 inps)] + body + wrap
+        if neur.guard is None:
+            lines += indent(block, 4)
+        else:
+            lines += ["    if activeState in G{}:".format(slot)]
+            lines += indent(block, 8)
+            lines += ["    else:",
+                      "        r = None"]
+        lines += ["    results[{}] = r".format(slot)]
+    return "\n".join(lines) + "\n"
+
+
+def compileBrainFunction(compiled, brainGraph):
+    """Set compiled.function and compiled.source"""
+    key = graphHash(brainGraph)
+    if compiled.optimised is None:
+        # The schedule is different if the brain hasn't been optimised
+        key = hashlib.sha1((key + " unoptimised").encode()).hexdigest()
+    funcName = "brain_" + key[:12]
+    if key not in sourceCache:
+        source = generateSource(compiled, funcName)
+        filename = "<iai brain {}>".format(key[:12])
+        linecache.cache[filename] = (len(source), None,
+                                     source.splitlines(True), filename)
+        sourceCache[key] = (source, compile(source, filename, "exec"))
+    source, code = sourceCache[key]
+
+    namespace = {"IC": ImpulseContainer}
+    for neur in compiled.schedule:
+        namespace["n{}".format(neur.slot)] = neur
+        namespace["G{}".format(neur.slot)] = neur.guard
+    exec(code, namespace)
+    compiled.source = source
+    compiled.function = namespace[funcName]
@@ -1,4 +1,3 @@
-import bpy
 from .iai_masterChannels import MasterChannel as Mc
 
 
@@ -8,4 +7,4 @@ class Crowd(Mc):
         Mc.__init__(self, sim)
 
     def allagents(self):
-        return bpy.context.scene.iai_agents
+        return self.sim.scene.getAgents()
@@ -1,19 +1,21 @@
 from .iai_masterChannels import MasterChannel as Mc
-import mathutils
-from mathutils import Vector
 
 import math
 
-from .libs.ins_clustering import clusterMatch
+import numpy
 
-import bpy
+from .libs.ins_clustering import clusterMatch
 
 
 class Formation(Mc):
     """Get data about the ground near the agent"""
+    # Querying a formation puts the agent forward to be given a target
+    queriesHaveSideEffects = True
+
     def __init__(self, sim):
         Mc.__init__(self, sim)
         self.formations = {}
+        self.reserved = set(dir(self))
 
     def newframe(self):
         for f in self.formations.values():
@@ -26,7 +28,7 @@ class Formation(Mc):
 
     def register(self, agent, formID, val):
         """Adds an object that is a formation target"""
-        if formID in dir(self):
+        if formID in self.reserved:
             print("""Formation ID must not be an attribute of this
                   python object""")
         else:
@@ -35,6 +37,25 @@ class Formation(Mc):
                 self.formations[formID] = ch
             self.formations[formID].register(agent.id, val)
 
+    def frameState(self):
+        return {formID: (f.inpBuffer, f.lastCalcd if f.calculated else None)
+                for formID, f in self.formations.items()}
+
+    def mergeFrameStates(self, states):
+        for formID, f in self.formations.items():
+            f.inpBuffer = []
+            for state in states:
+                if formID in state:
+                    inpBuffer, lastCalcd = state[formID]
+                    f.inpBuffer += inpBuffer
+                    if lastCalcd is not None:
+                        f.lastCalcd = lastCalcd
+
+    def unregister(self, agent, formID):
+        """An object is no longer a formation target"""
+        if formID in self.formations:
+            self.formations[formID].targetObjects.discard(agent.id)
+
     def retrieve(self, formID):
         """Dynamic properties"""
         if (formID in self.formations):
@@ -61,6 +82,7 @@ class Channel:
         self.priority = []
         self.calcd = {}  # {str: Vector()}
         self.lastCalcd = None  # Store from last frame to reduce jittering
+        self.calculated = False  # If calculate was called this frame
 
     def register(self, agentID, val):
         """Add a formation target object"""
@@ -73,9 +95,14 @@ class Channel:
     def newFrame(self):
         """Called at the beginning of each new frame.
         (see def checkCalcd for description of how this is used)"""
-        objs = bpy.data.objects
+        scene = self.sim.scene
 
         self.calcd = {}
+        self.calculated = False
+        # The agents are added in the order they are evaluated which is
+        #  agent order unless the brains are evaluated in a batch
+        agents = self.sim.agents
+        self.inpBuffer.sort(key=lambda x: agents[x].index)
         new = []
         for p in self.priority:
             if p in self.inpBuffer:
@@ -88,17 +115,15 @@ class Channel:
 
         self.targets = []
         for t in self.targetObjects:
-            ob = objs[t]
-            wrld = ob.matrix_world
-            self.targets += [wrld*v.co for v in ob.data.vertices]
+            self.targets += scene.getVertices(t)
 
     def calculate(self):
         """Collect data and use clusterMatch to work out pairings"""
-        objs = bpy.data.objects
+        scene = self.sim.scene
+        self.calculated = True
 
-        agAccess = lambda x: (objs[x].location.x, objs[x].location.y,
-                              objs[x].location.z)
-        tgAccess = lambda x: (x.x, x.y, x.z)
+        agAccess = lambda x: tuple(scene.getLocation(x))
+        tgAccess = lambda x: (x[0], x[1], x[2])
         setOfTargets = set([tgAccess(x) for x in self.targets])
         if self.lastCalcd:
             # TODO if the same agents are inputed the same result as last time
@@ -129,9 +154,16 @@ class Channel:
         if self.userid not in self.inpBuffer:
             self.inpBuffer.append(self.userid)
         if self.userid in self.calcd:
+            if self.sim.profiler is not None:
+                self.sim.profiler.count("cacheHit.Formation")
             return self.calcd[self.userid]
         elif self.userid in self.priority[:len(self.targets)]:
+            prof = self.sim.profiler
+            if prof is not None:
+                t = prof.now()
             self.calculate()
+            if prof is not None:
+                prof.add("channel.Formation." + self.formI, t)
             return self.calcd[self.userid]
         else:
             return False
@@ -139,11 +171,9 @@ class Channel:
     @property
     def dist(self):
         """Distance from this agent to the position in formation"""
-        objs = bpy.data.objects
-
         result = self.checkCalcd()
         if result:
-            loc = objs[self.userid].location
+            loc = self.sim.scene.getLocation(self.userid)
             return math.sqrt((loc[0] - result[0])**2 + (loc[1] - result[1])**2
                              + (loc[2] - result[2])**2)
         else:
@@ -152,20 +182,15 @@ class Channel:
     @property
     def rz(self):
         """Horizontal rotation to be pointing at position in formation"""
-        objs = bpy.data.objects
-
         to = self.checkCalcd()
         if to:
-            ag = objs[self.userid]
-
-            target = to - ag.location
+            sim = self.sim
+            location = sim.scene.getLocation(self.userid)
 
-            z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-            y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-            x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
+            target = numpy.array(tuple(to)) - location
 
-            rotation = x * y * z
-            relative = target * rotation
+            relative = sim.orientations.toLocal(sim.agents[self.userid].index,
+                                                target)
 
             return math.atan2(relative[0], relative[1])/math.pi
         else:
@@ -174,20 +199,15 @@ class Channel:
     @property
     def rx(self):
         """Vertical rotation to be pointing at position in formation"""
-        objs = bpy.data.objects
-
         to = self.checkCalcd()
         if to:
-            ag = objs[self.userid]
-
-            target = to - ag.location
+            sim = self.sim
+            location = sim.scene.getLocation(self.userid)
 
-            z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-            y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-            x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
+            target = numpy.array(tuple(to)) - location
 
-            rotation = x * y * z
-            relative = target * rotation
+            relative = sim.orientations.toLocal(sim.agents[self.userid].index,
+                                                target)
 
             return math.atan2(relative[2], relative[1])/math.pi
         else:
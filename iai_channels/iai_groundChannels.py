@@ -1,9 +1,3 @@
-import bpy
-
-from math import *
-from mathutils import *
-BVHTree = bvhtree.BVHTree
-
 from .iai_masterChannels import MasterChannel as Mc
 
 import time
@@ -15,12 +9,20 @@ class Ground(Mc):
         Mc.__init__(self, sim)
         self.store = {}
         self.calced = False
-        self.groundTrees = {}
+        self.grounds = set()  # Ids of the agents tagged "Ground"
 
     def newframe(self):
         self.store = {}
         self.calced = False
 
+    def register(self, agent, key, val):
+        if key == "":
+            self.grounds.add(agent.id)
+
+    def unregister(self, agent, key):
+        if key == "":
+            self.grounds.discard(agent.id)
+
     def setuser(self, userid):
         self.store = {}
         self.calced = False
@@ -29,25 +31,16 @@ class Ground(Mc):
     def calcground(self):
         """Called the first time each agent uses the Ground channel"""
         results = []
-        s = bpy.context.scene.objects[self.userid]
-        for ag in self.sim.agents.values():
-            if "Ground" in ag.access["tags"]:
-                # TODO record this when the tags are set
-                gnd = bpy.context.scene.objects[ag.id]
-                if ag.id not in self.groundTrees:
-                    r = gnd.rotation_euler
-                    if not (r[0] or r[1] or r[2]):
-                        print(ag.id, "rotation must be applied")
-                        # TODO make ray_cast work with rotation
-                    sce = bpy.context.scene
-                    self.groundTrees[ag.id] = BVHTree.FromObject(gnd, sce)
-                point = s.location - gnd.location
-                calcd = self.groundTrees[ag.id].ray_cast(point, (0, 0, -1))
-                if calcd[0]:
-                    results.append(calcd + (1,))
-                calcd = self.groundTrees[ag.id].ray_cast(point, (0, 0, 1))
-                if calcd[0]:
-                    results.append(calcd + (-1,))
+        scene = self.sim.scene
+        location = scene.getLocation(self.userid)
+        for groundid in self.grounds:
+            point = location - scene.getLocation(groundid)
+            calcd = scene.rayCast(groundid, point, (0, 0, -1))
+            if calcd[0] is not None:
+                results.append(calcd + (1,))
+            calcd = scene.rayCast(groundid, point, (0, 0, 1))
+            if calcd[0] is not None:
+                results.append(calcd + (-1,))
 
         if len(results) > 0:
             loc, norm, ind, dist, direc = min(results, key=lambda x: x[3])
@@ -61,8 +54,15 @@ class Ground(Mc):
     @property
     def dh(self):
         """Return the vertical distance to the nearest ground object"""
+        prof = self.sim.profiler
         if not self.calced:
+            if prof is not None:
+                t = prof.now()
             self.calcground()
+            if prof is not None:
+                prof.add("channel.Ground", t)
+        elif prof is not None:
+            prof.count("cacheHit.Ground")
         if self.store:
             return self.store["distance"]
         else:
@@ -1,8 +1,9 @@
-import random
-
-
 class MasterChannel:
     """The parent class for all the channels"""
+    # If querying the channel changes what later queries give (so Input
+    #  nodes that use it can't be removed when nothing uses their output)
+    queriesHaveSideEffects = False
+
     def __init__(self, sim):
         self.sim = sim
 
@@ -16,25 +17,115 @@ class MasterChannel:
         return 0
 
     def register(self, agent, frequency, val):
-        """Override this in child classes to define channels"""
+        """Override this in child classes to define channels. Called by the
+        TagRegistry when an agent sets a tag starting with the channel name"""
+        pass
+
+    def unregister(self, agent, frequency):
+        """Called by the TagRegistry when the tag is removed again"""
+        pass
+
+    def frameState(self):
+        """Override this in child classes that keep state which depends on
+        the order the agents are evaluated in. Returns the part of that state
+        that was made this frame (must be picklable). See iai_parallel"""
+        return None
+
+    def mergeFrameStates(self, states):
+        """Combine the frameStates of every worker process (in agent order)
+        so that all processes carry on as if they had evaluated every
+        agent"""
         pass
 
     def setuser(self, userid):
         """Set up the channel to be used with a new agent"""
         self.userid = userid
-        self.randstate = hash(userid) + self.sim.framelast
-        random.seed(self.randstate)
+
+    def hasBatchQuery(self, attrs):
+        """If queryBatch can answer Channel.attrs[0].attrs[1]... Override
+        this in child classes that can answer for lots of agents at once
+        (see iai_brainBatch). The queries are moved after all the queries
+        that can't be batched so it must only be True if that doesn't
+        change what they give"""
+        return False
+
+    def queryBatch(self, attrs, userids):
+        """The value of Channel.attrs[0].attrs[1]... for each of the agents
+        in userids as a list. Only called if hasBatchQuery(attrs). None
+        means the agents have to be asked one at a time"""
+        return None
 
 
 class Wrapper:
     """This is so that the channel can decide how to handle retrievals"""
+    # Used by the simulation rather than queries from the brains
+    notQueries = {"setuser", "newframe", "register", "unregister",
+                  "frameState", "mergeFrameStates"}
+
     def __init__(self, channel, *args):
         self.channel = channel
+        # Anything else is looked up with channel.retrieve unless it has been
+        #  set on the channel itself
+        self.classAttributes = frozenset(dir(type(channel)))
 
     def __getattr__(self, attr):
         """When attribute retrieved for object wrapped by this pass it on to
         the contained channel in the correct form"""
-        if attr in self.channel.__dir__():
-            return getattr(self.channel, attr)
+        channel = self.channel
+        prof = channel.sim.profiler
+        if prof is not None and attr not in self.notQueries:
+            prof.count("query." + type(channel).__name__)
+        if attr in self.classAttributes or attr in vars(channel):
+            return getattr(channel, attr)
+        else:
+            return channel.retrieve(attr)
+
+    def hasQuery(self, attr):
+        """If attr can be asked for. Channels without dynamic properties
+        (see MasterChannel.retrieve) only have their own attributes"""
+        channel = self.channel
+        return attr in self.classAttributes or attr in vars(channel) or \
+            type(channel).retrieve is not MasterChannel.retrieve
+
+    def getter(self, attr):
+        """A function that does the same as getting attr from this but
+        without working out how to get it each time"""
+        channel = self.channel
+        sim = channel.sim
+        name = "query." + type(channel).__name__
+        if attr in self.classAttributes:
+            def get():
+                prof = sim.profiler
+                if prof is not None:
+                    prof.count(name)
+                return getattr(channel, attr)
         else:
-            return self.channel.retrieve(attr)
+            retrieve = channel.retrieve
+
+            def get():
+                prof = sim.profiler
+                if prof is not None:
+                    prof.count(name)
+                if attr in vars(channel):
+                    return getattr(channel, attr)
+                return retrieve(attr)
+        return get
+
+    def batchGetter(self, attrs):
+        """A function that gets Channel.attrs[0].attrs[1]... for a list of
+        agents with channel.queryBatch or None if the channel can't do that
+        (then the function returns None as well)"""
+        channel = self.channel
+        if not channel.hasBatchQuery(attrs):
+            return None
+        sim = channel.sim
+        name = "query." + type(channel).__name__
+
+        def get(userids):
+            if attrs[0] in vars(channel):
+                return None
+            prof = sim.profiler
+            if prof is not None:
+                prof.count(name, len(userids))
+            return channel.queryBatch(attrs, userids)
+        return get
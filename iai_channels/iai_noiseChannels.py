@@ -1,25 +1,85 @@
-import bpy
 from .iai_masterChannels import MasterChannel as Mc
-import random
+from ..iai_random import streamId
 
 
 class Noise(Mc):
     """Used to generate randomness in a scene"""
+    RANDOM = streamId("Noise.random")
+    AGENTRANDOM = streamId("Noise.agentRandom")
+    # Each random number depends on how many came before it
+    queriesHaveSideEffects = True
+
     def __init__(self, sim):
         Mc.__init__(self, sim)
+        # {userid: numbers given to that user this frame}. Kept for each user
+        #  as the brains may be evaluated in a batch (see iai_brainBatch)
+        #  and then setuser is called more than once in a frame
+        self.draws = {}
+
+    def newframe(self):
+        self.draws = {}
 
     @property
     def random(self):
         """Returns a random number in range 0-1"""
-        return random.random()
+        sim = self.sim
+        draws = self.draws.get(self.userid, 0)
+        result = sim.rng.random(sim.agents[self.userid].index, sim.framelast,
+                                self.RANDOM, draws)
+        self.draws[self.userid] = draws + 1
+        return result
 
     @property
     def agentRandom(self):
         """Return a random number that is consistent between frames"""
-        state = random.getstate()
-        random.seed(hash(self.userid) - 1)
-        # -1 so that this number is different to the first random number
-        # generated on frame 0 (if used) of the simulation
-        result = random.random()
-        random.setstate(state)
-        return result
+        sim = self.sim
+        return sim.rng.random(sim.agents[self.userid].index, 0,
+                              self.AGENTRANDOM)
+
+    def hasBatchQuery(self, attrs):
+        # Noise.random can't be batched as each number depends on the ones
+        #  the agent was given before it
+        return list(attrs) == ["agentRandom"]
+
+    def queryBatch(self, attrs, userids):
+        """Noise.agentRandom for lots of agents at once"""
+        sim = self.sim
+        agents = [sim.agents[u].index for u in userids]
+        return sim.rng.randomArray(agents, 0, self.AGENTRANDOM).tolist()
+
+
+if __name__ == "__main__":
+    import unittest
+    from types import SimpleNamespace
+
+    from .iai_masterChannels import Wrapper as wr
+    from ..iai_random import RandomStreams
+
+    class FakeSimulation():
+        """Impersonate the Simulation object"""
+        def __init__(self):
+            self.rng = RandomStreams(42)
+            self.agents = {name: SimpleNamespace(index=i) for i, name in
+                           enumerate(["OB1", "OB2", "OB3", "OB4"])}
+            self.framelast = 3
+            self.profiler = None
+
+    class Test(unittest.TestCase):
+        def setUp(self):
+            self.noise = wr(Noise(FakeSimulation()))
+
+        def testAgentRandomBatch(self):
+            """The batch gives what each agent would get on its own"""
+            users = ["OB3", "OB1", "OB4"]
+            expected = []
+            for user in users:
+                self.noise.setuser(user)
+                expected.append(self.noise.agentRandom)
+            get = self.noise.batchGetter(["agentRandom"])
+            self.assertEqual(get(users), expected)
+
+        def testRandomNotBatched(self):
+            self.assertIsNone(self.noise.batchGetter(["random"]))
+
+    # Run unit test
+    unittest.main()
@@ -1,76 +1,339 @@
 from .iai_masterChannels import MasterChannel as Mc
 import math
-import mathutils
-Vector = mathutils.Vector
 
-from .libs import ins_octree as ot
-
-if __name__ != "__main__":
-    import bpy
-
-else:
-    import unittest
-
-    from .iai_masterChannels import Wrapper as wr
-
-    class FakeObject():
-        """Impersonate bpy.context.scene.objects[n]"""
-        def __init__(self, location, rotation):
-            self.location = mathutils.Vector(location)
-            self.rotation_euler = mathutils.Euler(rotation)
-
-    class FakeAgent():
-        """Impersonate Simulation.agents[n]"""
-        def __init__(self, bid):
-            self.id = bid
-
-    class FakeSimulation():
-        """Impersonate the Simulation object"""
-        def __init__(self):
-            self.framelast = 1
-
-    class Test(unittest.TestCase):
-        def setUp(self):
-            O = bpy.context.scene.objects
-            # Impersonate bpy.context.scene.objects
-            # These are the objects that can be used to emit and hear sounds
-            O = {"OB1": FakeObject([0, 0, 0], [0, 0, 0]),
-                 "OB2": FakeObject([1, 0, 0], [0, 0, 0]),
-                 "OB3": FakeObject([0, 1, 0], [0, 0, 0]),
-                 "OB4": FakeObject([0, -1, 0], [0, 0, 0]),
-                 "OB5": FakeObject([-0.1, -1, 0], [0, 0, 0])}
-
-            self.FSim = FakeSimulation()
-
-            self.sound = wr(Sound(self.FSim))
-
-        def testOne(self):
-            """Some simple test cases"""
-            self.sound.register(FakeAgent("OB1", "A", 1))
-            self.sound.register(FakeAgent("OB2", "A", 1))
-            self.sound.register(FakeAgent("OB3", "A", 1))
-
-            self.sound.setuser("OB1")
-            self.assertEqual(self.sound.A.rz, {"OB2": 0.5,
-                                               "OB3": 0})
-            self.assertEqual(self.sound.A.db, {"OB2": 0,
-                                               "OB3": 0})
-
-        def testBoundryRotations(self):
-            """Testing the extremes of the rotation"""
-            self.sound.register(FakeAgent("OB1", "A", 1))
-            self.sound.register(FakeAgent("OB4", "A", 1))
-            self.sound.register(FakeAgent("OB5", "A", 1))
-
-            self.sound.setuser("OB1")
-            self.assertEqual(self.sound.A.rz["OB4"], 1)
-            self.assertTrue(-1 < self.sound.A.rz["OB5"] < -0.75)
+import numpy
+
+
+# How far ahead (in frames) steering and prediction look
+MAXLOOKAHEAD = 64
+# Boxes that cover more grid cells than this are checked against every other
+#  box by boxPairs
+MAXCELLS = 64
+
+
+def gridPairs(points, centres, reach):
+    """Every (point, centre) pair that is less than reach apart on each axis
+    (and some that are further). Only the centres in the 27 cells of a grid
+    with cells of size reach around each point are looked at. The pairs
+    still need checking against their actual distance
+
+    :param points: (n, 3) array
+    :param centres: (m, 3) array
+    :returns: point indices, centre indices. Sorted by point then centre"""
+    empty = numpy.zeros(0, dtype=numpy.int64)
+    if len(points) == 0 or len(centres) == 0 or not reach > 0:
+        return empty, empty
+    cells = numpy.floor(centres / reach)
+    pointCells = numpy.floor(points / reach)
+    lo = cells.min(axis=0) - 1
+    span = cells.max(axis=0) - lo + 2
+    if not numpy.isfinite(reach) or numpy.prod(span) >= 2**62:
+        # Everything is in range of everything else
+        return numpy.divmod(numpy.arange(len(points) * len(centres)),
+                            len(centres))
+    lo = lo.astype(numpy.int64)
+    span = span.astype(numpy.int64)
+
+    def key(c):
+        c = c - lo
+        return (c[:, 0] * span[1] + c[:, 1]) * span[2] + c[:, 2]
+
+    keys = key(cells.astype(numpy.int64))
+    order = numpy.argsort(keys, kind="stable")
+    sortedKeys = keys[order]
+    pointCells = pointCells.astype(numpy.int64)
+
+    pointIndices = [empty]
+    centreIndices = [empty]
+    for offset in numpy.ndindex(3, 3, 3):
+        near = pointCells + numpy.array(offset) - 1
+        valid = numpy.flatnonzero(((near >= lo) & (near < lo + span))
+                                  .all(axis=1))
+        k = key(near[valid])
+        first = numpy.searchsorted(sortedKeys, k, side="left")
+        counts = numpy.searchsorted(sortedKeys, k, side="right") - first
+        total = counts.sum()
+        if total == 0:
+            continue
+        starts = numpy.repeat(first - numpy.cumsum(counts) + counts, counts)
+        pointIndices.append(numpy.repeat(valid, counts))
+        centreIndices.append(order[starts + numpy.arange(total)])
+    pointIndices = numpy.concatenate(pointIndices)
+    centreIndices = numpy.concatenate(centreIndices)
+    sort = numpy.lexsort((centreIndices, pointIndices))
+    return pointIndices[sort], centreIndices[sort]
+
+
+def boxCells(lo, hi, size, origin):
+    """The grid cells (of size size, counted from origin) that each box
+    covers
+
+    :returns: box index, cell (n, 3) for every (box, cell) pair"""
+    first = numpy.floor((lo - origin) / size).astype(numpy.int64)
+    counts = numpy.floor((hi - origin) / size).astype(numpy.int64) - first + 1
+    total = counts.prod(axis=1)
+    box = numpy.repeat(numpy.arange(len(lo)), total)
+    k = numpy.arange(total.sum()) - numpy.repeat(numpy.cumsum(total) - total,
+                                                 total)
+    ny = counts[box, 1]
+    nz = counts[box, 2]
+    cell = first[box] + numpy.stack((k // (ny * nz), (k // nz) % ny, k % nz),
+                                    axis=1)
+    return box, cell
+
+
+def boxPairs(loA, hiA, loB, hiB):
+    """Every (a, b) pair of axis aligned boxes that overlap. The boxes are
+    put in the cells of a grid that they cover and only boxes that share a
+    cell are checked. Boxes that cover lots of cells are checked against
+    everything instead
+
+    :param loA: (n, 3) array of the lowest corner of each box in A
+    :returns: A indices, B indices. Sorted by A then B"""
+    empty = numpy.zeros(0, dtype=numpy.int64)
+    if len(loA) == 0 or len(loB) == 0:
+        return empty, empty
+    extent = numpy.concatenate((hiA - loA, hiB - loB))
+    size = numpy.median(extent.max(axis=1))
+    if not size > 0:
+        size = 1
+    origin = numpy.minimum(loA.min(axis=0), loB.min(axis=0))
+    span = numpy.floor((numpy.maximum(hiA.max(axis=0), hiB.max(axis=0)) -
+                        origin) / size) + 1
+    if not numpy.isfinite(span).all() or numpy.prod(span) >= 2**62:
+        bigA = numpy.ones(len(loA), dtype=bool)
+    else:
+        bigA = (numpy.floor(hiA / size) - numpy.floor(loA / size) + 1).prod(
+            axis=1) > MAXCELLS
+    bigB = (numpy.floor(hiB / size) - numpy.floor(loB / size) + 1).prod(
+        axis=1) > MAXCELLS
+    if bigA.all():
+        bigB[:] = False
+    span = span.astype(numpy.int64) if not bigA.all() else None
+
+    pairsA = [empty]
+    pairsB = [empty]
+    smallA = numpy.flatnonzero(~bigA)
+    smallB = numpy.flatnonzero(~bigB)
+    if len(smallA) != 0 and len(smallB) != 0:
+        def key(cell):
+            return (cell[:, 0] * span[1] + cell[:, 1]) * span[2] + cell[:, 2]
+        boxA, cellA = boxCells(loA[smallA], hiA[smallA], size, origin)
+        boxB, cellB = boxCells(loB[smallB], hiB[smallB], size, origin)
+        keysB = key(cellB)
+        order = numpy.argsort(keysB, kind="stable")
+        keysB = keysB[order]
+        keysA = key(cellA)
+        first = numpy.searchsorted(keysB, keysA, side="left")
+        counts = numpy.searchsorted(keysB, keysA, side="right") - first
+        starts = numpy.repeat(first - numpy.cumsum(counts) + counts, counts)
+        pairsA.append(smallA[numpy.repeat(boxA, counts)])
+        pairsB.append(smallB[boxB[order[starts +
+                                        numpy.arange(counts.sum())]]])
+    for big, pairs, other in ((numpy.flatnonzero(bigA), pairsA, pairsB),
+                              (numpy.flatnonzero(bigB), pairsB, pairsA)):
+        if len(big) != 0:
+            n = len(loB) if pairs is pairsA else len(loA)
+            pairs.append(numpy.repeat(big, n))
+            other.append(numpy.tile(numpy.arange(n), len(big)))
+    a = numpy.concatenate(pairsA)
+    b = numpy.concatenate(pairsB)
+    unique = numpy.unique(a * len(loB) + b)
+    a, b = numpy.divmod(unique, len(loB))
+    overlap = ((loA[a] <= hiB[b]) & (loB[b] <= hiA[a])).all(axis=1)
+    return a[overlap], b[overlap]
+
+
+def agentRows(sim):
+    """The agents in the order of their index (their row in sim.state)
+
+    :returns: agents, the index of each, {agent id: position in agents}"""
+    agents = sorted(sim.agents.values(), key=lambda ag: ag.index)
+    rows = numpy.array([ag.index for ag in agents], dtype=numpy.int64)
+    return agents, rows, {ag.id: i for i, ag in enumerate(agents)}
+
+
+class PairTable:
+    """The values for every (listener, emitter) pair of a frequency for one
+    frame. The pairs are sorted by listener (the index of the agent) so the
+    pairs of each listener are a slice"""
+    def __init__(self, count, listeners, emitters, columns):
+        """:param count: the number of agent indices (sim.state.count)
+        :param listeners: the index of the listener of each pair
+        :param emitters: the id of the emitter of each pair
+        :param columns: {property: array with a value for each pair}"""
+        self.count = count
+        self.starts = numpy.searchsorted(listeners, numpy.arange(count + 1))
+        self.emitters = emitters
+        self.columns = columns
+
+    def get(self, listener, prop, default=0):
+        """{emitter id: value of prop} for the agent with index listener or
+        None if it doesn't hear anything"""
+        s, e = self.starts[listener], self.starts[listener + 1]
+        if s == e:
+            return None
+        emitters = self.emitters[s:e]
+        if prop not in self.columns:
+            return dict.fromkeys(emitters, default)
+        return dict(zip(emitters, self.columns[prop][s:e].tolist()))
 
-        def tearDown(self):
-            self.sound.newFrame()
 
-    # Run unit test
-    unittest.main()
+class PairCache:
+    """What is worked out about a pair of agents for steering and prediction
+    that is the same whichever of the two is asking (apart from the sign
+    of directions or the order of times). Kept for one frame and shared by
+    all the frequencies of Sound so each pair is only solved once"""
+    def __init__(self, sim):
+        self.sim = sim
+        self.clear()
+
+    def clear(self):
+        self.count = None  # The number of agents the keys are for
+        # {kind: sorted lo * count + hi for each pair of agent indices}
+        self.keys = {}
+        self.columns = {}  # {kind: {name: array with a row for each key}}
+
+    def lookup(self, kind, solve, first, second):
+        """The columns made by solve(lo, hi) for each (first, second) pair of
+        agent indices. Only the pairs that haven't been seen yet this frame
+        are solved
+
+        :returns: {name: array with a row for each pair}, which pairs have
+            first as lo"""
+        n = max(1, self.sim.state.count)
+        if self.count != n:
+            self.clear()
+            self.count = n
+        lo = numpy.minimum(first, second)
+        keys = lo * n + numpy.maximum(first, second)
+        known = self.keys.get(kind, numpy.zeros(0, dtype=numpy.int64))
+        want = numpy.unique(keys)
+        missing = want[~numpy.isin(want, known)]
+        if len(missing) != 0:
+            columns = solve(missing // n, missing % n)
+            known = numpy.concatenate((known, missing))
+            order = numpy.argsort(known, kind="stable")
+            self.keys[kind] = known[order]
+            if kind in self.columns:
+                columns = {k: numpy.concatenate((v, columns[k]))
+                           for k, v in self.columns[kind].items()}
+            self.columns[kind] = {k: v[order] for k, v in columns.items()}
+        pos = numpy.searchsorted(self.keys[kind], keys)
+        return ({k: v[pos] for k, v in self.columns[kind].items()},
+                first == lo)
+
+    def steering(self, first, second):
+        """The parts of Channel.calculateSteering that only depend on the
+        pair for each (first, second) pair of agent indices, as seen from
+        first. first and second must not be the same
+
+        :returns: {name: array with a row for each pair}"""
+        result, forward = self.lookup("steer", self.solveSteering,
+                                      first, second)
+        # Directions are from lo to hi
+        result["direction"] *= numpy.where(forward, 1.0, -1.0)[:, None]
+        return result
+
+    def solveSteering(self, lo, hi):
+        """See steering. Everything is from the point of view of lo"""
+        sim = self.sim
+        state = sim.state
+        radius = numpy.zeros(state.count)
+        for ag in sim.agents.values():
+            radius[ag.index] = ag.radius
+
+        rx = radius[lo]
+        vx = state.globalVelocity[lo]
+        px = state.position[lo]
+
+        ry = radius[hi]
+        vy = state.globalVelocity[hi]
+        py = state.position[hi]
+
+        # ax^2 + bx + (c - d) = 0
+        a = ((vx - vy) * (vx - vy)).sum(axis=1)
+        b = 2 * ((px - py) * (vx - vy)).sum(axis=1)
+        c = ((px - py) * (px - py)).sum(axis=1) - (rx + ry)**2
+
+        """Calculate the time at which the agents will be at their closest
+        and the distance between at that time"""
+        moving = a != 0
+        safeA = numpy.where(moving, a, 1)
+        tc = numpy.where(moving, -b / (2 * safeA), 0)
+
+        # How close they get in the next MAXLOOKAHEAD frames
+        soonest = numpy.clip(tc, 0, MAXLOOKAHEAD)[:, None]
+        gap = (px - py) + soonest * (vx - vy)
+
+        xc = px + tc[:, None] * vx
+        yc = py + tc[:, None] * vy
+        distTmp = numpy.sqrt(((xc - yc) * (xc - yc)).sum(axis=1))
+        # The distance can't be negative
+        dist = numpy.maximum(distTmp - (rx + ry), 0)
+
+        """Check if they actually collide"""
+        det = b**2 - 4*a*c
+        collide = det > 0
+        root = numpy.sqrt(numpy.where(collide, det, 0))
+        t0 = (-b - root) / (2 * safeA)
+        t1 = (-b + root) / (2 * safeA)
+        collide &= (t0 >= 0) | (t1 >= 0)
+
+        t0c = t0[:, None]
+        t1c = t1[:, None]
+        direction = numpy.where(collide[:, None],
+                                (py + t0c * vy) - (px + t0c * vx) +
+                                (py + t1c * vy) - (px + t1c * vx),
+                                yc - xc)
+        length = numpy.sqrt((direction * direction).sum(axis=1))
+        # Zero vectors are left as they are
+        direction /= numpy.where(length == 0, 1, length)[:, None]
+        direction *= (rx + ry)[:, None]
+
+        return {"gap": (gap * gap).sum(axis=1), "tc": tc, "det": det,
+                "t0": t0, "t1": t1, "collide": collide, "dist": dist,
+                "distTmp": distTmp, "radii": rx + ry,
+                "direction": direction}
+
+    def approach(self, first, second):
+        """When the agents with indices first and second (which can't be the
+        same) are closest if they keep going in a straight line, for each
+        (first, second) pair (see Channel.calculatePrediction)
+
+        :returns: {"s": time for first, "t": time for second,
+            "parallel": if they are moving parallel to each other (and s and
+            t mean nothing)}"""
+        result, forward = self.lookup("approach", self.solveApproach,
+                                      first, second)
+        s, t = result["s"], result["t"]
+        result["s"] = numpy.where(forward, s, t)
+        result["t"] = numpy.where(forward, t, s)
+        return result
+
+    def solveApproach(self, lo, hi):
+        """See approach. s is the time for lo"""
+        state = self.sim.state
+        p1 = state.position[lo]
+        p2 = state.position[hi]
+
+        d1 = state.globalVelocity[lo]
+        d2 = state.globalVelocity[hi]
+
+        a = (d1 * d1).sum(axis=1)
+        b = (d1 * d2).sum(axis=1)
+        e = (d2 * d2).sum(axis=1)
+
+        d = a*e - b*b
+        parallel = d == 0
+        d = numpy.where(parallel, 1, d)
+
+        r = p1 - p2
+        c = (d1 * r).sum(axis=1)
+        f = (d2 * r).sum(axis=1)
+
+        return {"s": (b*f - c*e) / d, "t": (a*f - b*c) / d,
+                "parallel": parallel}
 
 
 class Sound(Mc):
@@ -79,18 +342,29 @@ class Sound(Mc):
         Mc.__init__(self, sim)
         # All the different sound frequencies that were emitted last frame
         self.channels = {}
+        self.pairs = PairCache(sim)
+        self.reserved = set(dir(self))
 
     def register(self, agent, frequency, val):
         """Adds an object that is emitting a sound"""
-        if frequency in dir(self):
+        if frequency in self.reserved:
             print("""frequency must not be an attribute of this
                   python object""")
         else:
             if frequency not in self.channels:
-                ch = Channel(frequency, self.sim)
+                ch = Channel(frequency, self.sim, self.pairs)
                 self.channels[frequency] = ch
             self.channels[frequency].register(agent.id, val)
 
+    def unregister(self, agent, frequency):
+        """An object has stopped emitting a sound"""
+        if frequency in self.channels:
+            ch = self.channels[frequency]
+            ch.emitters.pop(agent.id, None)
+            ch.tables = {}
+            if not ch.emitters:
+                del self.channels[frequency]
+
     def retrieve(self, freq):
         """Dynamic properties"""
         if (freq in self.channels):
@@ -100,13 +374,45 @@ class Sound(Mc):
             # TODO this is really hacky...
 
     def newframe(self):
-        self.channels = {}
+        self.pairs.clear()
+        for chan in self.channels.values():
+            chan.newFrame()
 
     def setuser(self, userid):
         for chan in self.channels.values():
             chan.newuser(userid)
         Mc.setuser(self, userid)
 
+    def parseQuery(self, attrs):
+        """(frequency, kind, property) for Sound.freq.prop,
+        Sound.freq.steer.prop or Sound.freq.pred.prop or None"""
+        attrs = list(attrs)
+        freq = attrs.pop(0)
+        if freq in self.reserved:
+            return None
+        kind = "dist"
+        if attrs and attrs[0] in ("steer", "pred"):
+            kind = attrs.pop(0)
+        if len(attrs) != 1 or attrs[0] not in Channel.columns:
+            return None
+        return freq, kind, attrs[0]
+
+    def hasBatchQuery(self, attrs):
+        # Nothing about a frame's sound depends on the order of the queries
+        return self.parseQuery(attrs) is not None
+
+    def queryBatch(self, attrs, userids):
+        """Sound.freq.prop, Sound.freq.steer.prop and Sound.freq.pred.prop
+        for lots of agents at once, read from the same PairTables"""
+        query = self.parseQuery(attrs)
+        if query is None:
+            return None
+        freq, kind, prop = query
+        if freq not in self.channels:
+            # See EmptyChannel
+            return [None] * len(userids)
+        return self.channels[freq].getBatch(kind, prop, userids)
+
 
 class EmptyChannel():
     def __getattr__(self, attr):
@@ -119,325 +425,240 @@ class EmptyChannel():
 class Channel:
     """Holds a record of all objects that are emitting on a
     certain frequency"""
-    def __init__(self, frequency, sim):
+    def __init__(self, frequency, sim, pairs=None):
         """
         :param frequency: The identifier for this channel
-        :type frequency: String"""
+        :type frequency: String
+        :param pairs: the PairCache shared with the other frequencies"""
         self.sim = sim
+        if pairs is None:
+            pairs = PairCache(sim)
+        self.pairs = pairs
 
         self.emitters = {}
         self.frequency = frequency
-        # Temporary storage which is reset after each agents has used it
-        self.store = {}
-        self.storePrediction = {}
-        self.storeSteering = {}
 
         self.predictNext = False
         self.steeringNext = False
 
-        self.octree = None
+        # {"dist", "steer" or "pred": PairTable} What every agent hears this
+        #  frame. Made by calculate, calculateSteering and calculatePrediction
+        #  the first time they are needed
+        self.tables = {}
 
     def register(self, objectid, val):
         """Add an object that emits sound"""
         self.emitters[objectid] = val
+        self.tables = {}
+
+    def newFrame(self):
+        """The emitters stay registered but everything calculated from their
+        positions is out of date"""
+        self.tables = {}
 
     def newuser(self, userid):
         self.userid = userid
-        self.store = {}
-        self.storePrediction = {}
-        self.storeSteering = {}
 
     def calculate(self):
-        """Called the first time an agent uses this frequency"""
-        O = bpy.context.scene.objects
-        userDim = self.sim.agents[self.userid].dimensions
-
-        if self.octree is None:
-            bss = []  # List of bounding spheres
-            for emitterid, val in self.emitters.items():
-                emitDim = self.sim.agents[emitterid].dimensions
-
-                dim = (val + emitDim[a] + userDim[a] for a in range(3))
-
-                bss.append(ot.boundingSphereFromBPY(O[emitterid], dim))
-
-            self.octree = ot.createOctree(bss)
-
-        ag = O[self.userid]
-
-        collisions = self.octree.checkPoint(ag.location.to_tuple())
-
-        for emitterid in collisions:
-            if emitterid == self.userid:
-                continue
-            to = O[emitterid]
-            val = self.emitters[emitterid]
-
-            eDim = max(self.sim.agents[emitterid].dimensions)
-            uDim = max(userDim)
-
-            difx = to.location.x - ag.location.x
-            dify = to.location.y - ag.location.y
-            difz = to.location.z - ag.location.z
-            dist = math.sqrt(difx**2 + dify**2 + difz**2)
-
-            target = to.location - ag.location
-
-            z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-            y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-            x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
-
-            rotation = x * y * z
-            relative = target * rotation
-
-            changez = math.atan2(relative[0], relative[1])/math.pi
-            changex = math.atan2(relative[2], relative[1])/math.pi
-            self.store[emitterid] = {"rz": changez,
-                                     "rx": changex,
-                                     "distProp": 1-(dist/(val+eDim+uDim))}
-            # (z rot, x rot, dist proportion, time until prediction)"""
-
-        # The old implementation not using octree
-        """ag = O[self.userid]
-        for emitterid, val in self.emitters.items():
-            if emitterid != self.userid:
-                to = O[emitterid]
-
-                difx = to.location.x - ag.location.x
-                dify = to.location.y - ag.location.y
-                difz = to.location.z - ag.location.z
-                dist = math.sqrt(difx**2 + dify**2 + difz**2)
-                if dist <= val:
-                    target = to.location - ag.location
-
-                    z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-                    y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-                    x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
-
-                    rotation = x * y * z
-                    relative = target * rotation
-
-                    changez = math.atan2(relative[0], relative[1])/math.pi
-                    changex = math.atan2(relative[2], relative[1])/math.pi
-                    self.store[emitterid] = (changez, changex, 1-(dist/val), 1)
-                    # (z rot, x rot, dist proportion, time until prediction)"""
+        """Work out what every agent hears on this frequency this frame.
+        Called the first time an agent uses it
+
+        :rtype: PairTable"""
+        sim = self.sim
+        scene = sim.scene
+        agents, rows, column = agentRows(sim)
+        location = numpy.array([scene.getLocation(ag.id) for ag in agents],
+                               dtype=float).reshape(-1, 3)
+        dims = numpy.array([ag.dimensions for ag in agents],
+                           dtype=float).reshape(-1, 3)
+
+        # In the order of the agents so that everything is in the same order
+        #  in every run
+        emitterIds = sorted(self.emitters, key=lambda x: sim.agents[x].index)
+        # Where each emitter is in agents
+        emitters = numpy.array([column[e] for e in emitterIds],
+                               dtype=numpy.int64)
+        vals = numpy.array([self.emitters[e] for e in emitterIds],
+                           dtype=float)
+        centres = numpy.array([scene.getBoundsCentre(e) for e in emitterIds],
+                              dtype=float).reshape(-1, 3)
+        emitDims = dims[emitters]
+
+        reach = 0
+        if len(emitters) != 0:
+            reach = (vals + emitDims.max(axis=1)).max() + dims.max()
+        listener, e = gridPairs(location, centres, reach)
+        prof = sim.profiler
+        if prof is not None:
+            prof.count("soundCandidates", len(e))
+
+        """Each emitter can be heard inside a sphere around its centre. The
+        size depends on the volume and the size of both agents"""
+        radius = (vals[e, None] + emitDims[e] + dims[listener]).max(axis=1)
+        offset = centres[e] - location[listener]
+        heard = ((offset * offset).sum(axis=1) < radius * radius) & \
+            (emitters[e] != listener)
+        listener = listener[heard]
+        e = e[heard]
+
+        target = location[emitters[e]] - location[listener]
+        dist = numpy.sqrt((target * target).sum(axis=1))
+        relative = sim.orientations.toLocal(rows[listener], target)
+
+        changez = numpy.arctan2(relative[:, 0], relative[:, 1]) / math.pi
+        changex = numpy.arctan2(relative[:, 2], relative[:, 1]) / math.pi
+        distProp = 1 - (dist / (vals[e] + emitDims[e].max(axis=1) +
+                                dims[listener].max(axis=1)))
+        # (z rot, x rot, dist proportion) for every pair
+        return PairTable(sim.state.count, rows[listener],
+                         numpy.array(emitterIds, dtype=object)[e],
+                         {"rz": changez, "rx": changex, "distProp": distProp})
 
     def calculatePrediction(self):
-        """Called the first time an agent uses this frequency"""
-        ag = O[self.userid]
-        agSim = self.sim.agents[self.userid]
-        for emitterid, val in self.emitters.items():
-            if emitterid != self.userid:
-                to = O[emitterid]
-                toSim = self.sim.agents[emitterid]
-
-                p1 = mathutils.Vector((agSim.apx, agSim.apy, agSim.apz))
-                p2 = mathutils.Vector((toSim.apx, toSim.apy, toSim.apz))
-
-                d1 = mathutils.Vector(agSim.globalVelocity)
-                d2 = mathutils.Vector(toSim.globalVelocity)
-
-                # O["Cube.Pointer"].location = p1 + (d1 * 2)
-                # O["Cube.001.Pointer"].location = p2 + (d2 * 2)
-
-                a = d1.dot(d1)
-                b = d1.dot(d2)
-                e = d2.dot(d2)
-
-                d = a*e - b*b
-
-                if (d != 0):  # If the two lines are not parallel.
-                    r = p1 - p2
-                    c = d1.dot(r)
-                    f = d2.dot(r)
-
-                    s = (b*f - c*e) / d
-                    t = (a*f - b*c) / d
-                    # t*d2 == closest point
-                    # s*d2 == point 2 is at when 1 is at closest approach
-                    pd1 = p1 + (s*d1)
-                    pd2 = p2 + (s*d2)
-                    dist = (pd1 - pd2).length
-                else:
-                    dist = float("inf")
-
-                # pd1 and pd2 are the positions the agents will be when they
-                #  make their closest approach
-                if dist <= val:
-                    target = pd2 - pd1
-
-                    z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-                    y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-                    x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
-
-                    rotation = x * y * z
-                    relative = target * rotation
-
-                    changez = math.atan2(relative[0], relative[1])/math.pi
-                    changex = math.atan2(relative[2], relative[1])/math.pi
-                    if (s < 1) or (t < 1):
-                        cert = 0
-                    else:
-                        if s > 32:
-                            c = 1
-                        else:
-                            c = s / 32
-                        cert = (1 - ((-(c**3)/3 + (c**2)/2) * 6))**2
-                        # https://www.desmos.com/calculator/godi4zejgd
-                    self.storePrediction[emitterid] = {"rz": changez,
-                                                       "changex": changex,
-                                                       "distProp": 1-(dist/val),
-                                                       "cert": cert}
-                    # (z rot, x rot, dist proportion, time until prediction)
+        """Work out where every agent will be relative to the agents emitting
+        on this frequency when they make their closest approach (if they
+        both keep going in a straight line). Called the first time an agent
+        uses it
+
+        Only closest approaches in the next MAXLOOKAHEAD frames are looked
+        at. The pairs are found by checking which of the boxes that the
+        agents sweep through in that time overlap
+
+        :rtype: PairTable"""
+        sim = self.sim
+        agents, rows, column = agentRows(sim)
+        position = sim.state.position[rows]
+        velocity = sim.state.globalVelocity[rows]
+
+        # In the order they were registered
+        emitterIds = list(self.emitters)
+        # Where each emitter is in agents
+        emitters = numpy.array([column[e] for e in emitterIds],
+                               dtype=numpy.int64)
+        vals = numpy.array([self.emitters[e] for e in emitterIds],
+                           dtype=float)
+
+        end = position + velocity * MAXLOOKAHEAD
+        lo = numpy.minimum(position, end)
+        hi = numpy.maximum(position, end)
+        pad = vals[:, None]
+        listener, e = boxPairs(lo, hi, lo[emitters] - pad, hi[emitters] + pad)
+        prof = sim.profiler
+        if prof is not None:
+            prof.count("predCandidates", len(e))
+        keep = emitters[e] != listener
+        listener = listener[keep]
+        e = e[keep]
+        val = vals[e]
+        pair = self.pairs.approach(rows[listener], rows[emitters[e]])
+        s = pair["s"]
+        t = pair["t"]
+
+        # pd1 and pd2 are the positions the agents will be when the listener
+        #  makes its closest approach
+        pd1 = position[listener] + s[:, None] * velocity[listener]
+        pd2 = position[emitters[e]] + s[:, None] * velocity[emitters[e]]
+        target = pd2 - pd1
+        dist = numpy.sqrt((target * target).sum(axis=1))
+        use = ~pair["parallel"] & (s >= 0) & (s <= MAXLOOKAHEAD) & \
+            (dist <= val)
+
+        relative = sim.orientations.toLocal(rows[listener], target)
+
+        changez = numpy.arctan2(relative[:, 0], relative[:, 1]) / math.pi
+        changex = numpy.arctan2(relative[:, 2], relative[:, 1]) / math.pi
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            distProp = 1 - (dist / val)
+
+        c = numpy.minimum(s / 32, 1)
+        cert = (1 - ((-(c**3)/3 + (c**2)/2) * 6))**2
+        # https://www.desmos.com/calculator/godi4zejgd
+        cert = numpy.where((s < 1) | (t < 1), 0, cert)
+
+        # (z rot, x rot, dist proportion, time until prediction)
+        return PairTable(sim.state.count, rows[listener[use]],
+                         numpy.array(emitterIds, dtype=object)[e[use]],
+                         {"rz": changez[use], "rx": changex[use],
+                          "distProp": distProp[use], "cert": cert[use]})
 
     def calculateSteering(self):
-        """Called the first time an agent uses this frequency"""
-        MAXLOOKAHEAD = 64
-        O = bpy.data.objects
-
-        ag = O[self.userid]
-        agSim = self.sim.agents[self.userid]
-
-        for emitterid, val in self.emitters.items():
-            if emitterid == self.userid:
-                continue
-            to = O[emitterid]
-            toSim = self.sim.agents[emitterid]
-
-            x = ag
-            rx = agSim.radius
-            vx = mathutils.Vector(agSim.globalVelocity)
-            px = x.location
-
-            y = to
-            ry = toSim.radius
-            vy = mathutils.Vector(toSim.globalVelocity)
-            py = y.location
-
-            # ax^2 + bx + (c - d) = 0
-            a = (vx - vy).length**2
-            # a = (vx[0] - vy[0])**2 + (vx[1] - vy[1])**2 + \
-            #     (vx[2] - vy[2])**2
-
-            b = 2*(px[0] - py[0])*(vx[0] - vy[0]) +\
-                2*(px[1] - py[1])*(vx[1] - vy[1]) +\
-                2*(px[2] - py[2])*(vx[2] - vy[2])
-
-            c = (px - py).length**2 - (rx + ry)**2
-
-            # c = (px[0] - py[0])**2 + (px[1] - py[1])**2 +
-            #     (px[2] - py[2])**2 - (rx + ry)**2
-
-            """Calculate the time at which the agents will be at their closest
-            and the distance between at that time"""
-            if a == 0:
-                tc = 0
-            else:
-                tc = -b/(2*a)  # Time that they are closest
-
-            xc = px + tc * vx
-            yc = py + tc * vy
-
-            # bpy.data.objects["Empty.001"].location = xc
-            # bpy.data.objects["Empty.002"].location = yc
-
-            distTmp = (xc - yc).length
-            dist = distTmp - (agSim.radius + toSim.radius)
-            dist = max(dist, 0)  # The distance can't be negative
-
-            """Check if they actually collide"""
-            det = b**2 - 4*a*c
-            if det > 0:
-                t0 = (-b - det**0.5)/(2*a)
-                t1 = (-b + det**0.5)/(2*a)
-                if ((t0 >= 0) or (t1 >= 0)):
-                    x0 = px + t0 * vx
-                    x1 = px + t1 * vx
-
-                    y0 = py + t0 * vy
-                    y1 = py + t1 * vy
-
-                    target = y0 - x0 + y1 - x1
-                    target.normalize()
-                    target *= (rx + ry)
-
-                    z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-                    y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-                    x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
-
-                    rotation = x * y * z
-                    relative = target * rotation
-
-                    changez = relative[0] / (abs(relative[0]) + 1)
-                    changex = relative[2] / (abs(relative[2]) + 1)
-
-                    acc = relative[1] / (abs(relative[1]) + 1)
-
-                    overlap = 1 - (distTmp / (rx + ry))
-
-                    if t1 < 0:
-                        # collision in the past
-                        cert = 0
-                    elif t0 < 0:
-                        # currently colliding
-                        cert = 1
-                    else:
-                        # collision in the future
-                        if t0 > MAXLOOKAHEAD:
-                            c = 1
-                        else:
-                            c = t0 / MAXLOOKAHEAD
-                        cert = (1 - ((-(c**3)/3 + (c**2)/2) * 6))**2
-                        # https://www.desmos.com/calculator/godi4zejgd
-
-                    self.storeSteering[emitterid] = {"rz": changez,
-                                                     "rx": changex,
-                                                     "distProp": 1,
-                                                     "acc": acc,
-                                                     "overlap": overlap,
-                                                     "cert": cert}
-
-                    # bpy.data.objects["Empty"].location = target
-                    # (z rot, x rot, dist proportion, recommended acceleration)
-            elif dist < val and tc >= 0:
-                target = yc - xc
-                target.normalize()
-                target *= (rx + ry)
-
-                # bpy.data.objects["Empty"].location = target
-
-                z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-                y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-                x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
-
-                rotation = x * y * z
-                relative = target * rotation
-
-                changez = relative[0] / (abs(relative[0]) + 1)
-                changex = relative[2] / (abs(relative[2]) + 1)
-
-                dstp = 1-(dist/val)  # distance proportion 0-1
-
-                if tc < 0:
-                    # collision in the past
-                    cert = 0
-                else:
-                    # collision in the future
-                    if tc > MAXLOOKAHEAD:
-                        c = 1
-                    else:
-                        c = tc / MAXLOOKAHEAD
-                    cert = (1 - ((-(c**3)/3 + (c**2)/2) * 6))**2
-                    # https://www.desmos.com/calculator/godi4zejgd
-
-                self.storeSteering[emitterid] = {"rz": changez,
-                                                 "rx": changex,
-                                                 "distProp": dstp,
-                                                 "acc": 0,
-                                                 "overlap": 0,
-                                                 "cert": 0}
-                # (z rot, x rot, dist proportion, recommended acceleration)
-
+        """Work out how every agent should steer to avoid the agents emitting
+        on this frequency this frame. Called the first time an agent uses it
+
+        Only pairs that can get within range of each other in the next
+        MAXLOOKAHEAD frames are looked at. They are found by checking which
+        of the boxes that the agents sweep through in that time overlap
+
+        :rtype: PairTable"""
+        sim = self.sim
+        agents, rows, column = agentRows(sim)
+        position = sim.state.position[rows]
+        velocity = sim.state.globalVelocity[rows]
+        radius = numpy.array([ag.radius for ag in agents], dtype=float)
+
+        # In the order they were registered
+        emitterIds = list(self.emitters)
+        # Where each emitter is in agents
+        emitters = numpy.array([column[e] for e in emitterIds],
+                               dtype=numpy.int64)
+        vals = numpy.array([self.emitters[e] for e in emitterIds],
+                           dtype=float)
+
+        end = position + velocity * MAXLOOKAHEAD
+        lo = numpy.minimum(position, end)
+        hi = numpy.maximum(position, end)
+        pad = (radius[emitters] + vals)[:, None]
+        listener, e = boxPairs(lo - radius[:, None], hi + radius[:, None],
+                               lo[emitters] - pad, hi[emitters] + pad)
+        prof = sim.profiler
+        if prof is not None:
+            prof.count("steerCandidates", len(e))
+        keep = emitters[e] != listener
+        listener = listener[keep]
+        e = e[keep]
+        val = vals[e]
+        pair = self.pairs.steering(rows[listener], rows[emitters[e]])
+
+        """Leave out the pairs that don't get within range of each other
+        in the next MAXLOOKAHEAD frames"""
+        reach = pair["radii"] + val
+        near = pair["gap"] <= reach * reach
+
+        collide = pair["collide"]
+        dist = pair["dist"]
+        t0 = pair["t0"]
+        t1 = pair["t1"]
+        # Heard but not going to collide
+        close = ~(pair["det"] > 0) & (dist < val) & (pair["tc"] >= 0)
+        use = near & (collide | close)
+
+        relative = sim.orientations.toLocal(rows[listener],
+                                            pair["direction"])
+
+        changez = relative[:, 0] / (abs(relative[:, 0]) + 1)
+        changex = relative[:, 2] / (abs(relative[:, 2]) + 1)
+        acc = numpy.where(collide, relative[:, 1] / (abs(relative[:, 1]) + 1),
+                          0)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            overlap = numpy.where(collide,
+                                  1 - (pair["distTmp"] / pair["radii"]), 0)
+            # distance proportion 0-1
+            distProp = numpy.where(collide, 1,
+                                   1 - (dist / numpy.where(close, val, 1)))
+
+        # How soon the collision is. Nothing but collisions is certain
+        t = numpy.minimum(t0 / MAXLOOKAHEAD, 1)
+        cert = (1 - ((-(t**3)/3 + (t**2)/2) * 6))**2
+        # https://www.desmos.com/calculator/godi4zejgd
+        cert = numpy.where(t0 < 0, 1, cert)
+        cert = numpy.where(collide & (t1 >= 0), cert, 0)
+
+        # (z rot, x rot, dist proportion, recommended acceleration)
+        return PairTable(sim.state.count, rows[listener[use]],
+                         numpy.array(emitterIds, dtype=object)[e[use]],
+                         {"rz": changez[use], "rx": changex[use],
+                          "distProp": distProp[use], "acc": acc[use],
+                          "overlap": overlap[use], "cert": cert[use]})
 
     # TODO The following is extraordinary hacky... do something about it!
 
@@ -453,82 +674,301 @@ class Channel:
         self.steeringNext = False  # So you can't do Sound.A.steer.pred...
         return self
 
-    def calcAndGetItems(self):
-        # TODO this gets called for both the sender and the receiver but I
-        #   think it always calculates the same results...
-        """If this channel hasn't been used then calculate and then return the
-        correct values to use"""
-        pre = self.predictNext
-        ste = self.steeringNext
+    def table(self, kind, index):
+        """The PairTable of kind ("dist", "steer" or "pred") for this frame.
+        Made if it hasn't been yet or doesn't have the agent index"""
+        prof = self.sim.profiler
+        table = self.tables.get(kind)
+        if table is None or table.count <= index:
+            if prof is not None:
+                t = prof.now()
+            if kind == "pred":
+                table = self.calculatePrediction()
+            elif kind == "steer":
+                table = self.calculateSteering()
+            else:
+                table = self.calculate()
+            self.tables[kind] = table
+            if prof is not None:
+                prof.add("channel.Sound.{}.{}".format(self.frequency, kind),
+                         t)
+        elif prof is not None:
+            prof.count("cacheHit.Sound")
+        return table
+
+    def getProperty(self, prop, default=0):
+        """{emitter id: prop} for the current user or None if nothing is
+        heard"""
+        if self.predictNext:
+            kind = "pred"
+        elif self.steeringNext:
+            kind = "steer"
+        else:
+            kind = "dist"
         self.predictNext = False
         self.steeringNext = False
-        if pre:
-            # TODO if the dictionary is empty then this evaluates to false
-            if not self.storePrediction:
-                self.calculatePrediction()
-            items = self.storePrediction.items()
-        elif ste:
-            # TODO if the dictionary is empty then this evaluates to false
-            if not self.storeSteering:
-                self.calculateSteering()
-            items = self.storeSteering.items()
-        else:
-            # TODO if the dictionary is empty then this evaluates to false
-            if not self.store:
-                self.calculate()
-            items = self.store.items()
-        return items
+        index = self.sim.agents[self.userid].index
+        return self.table(kind, index).get(index, prop, default)
 
-    @staticmethod
-    def buildDictFromProperty(dictionary, prop, default=0):
-        return {k: v[prop] if prop in v else default for k, v in dictionary}
+    def getBatch(self, kind, name, userids):
+        """The same as Sound.freq[.kind].name for each agent in userids or
+        None if name isn't one of the properties in columns"""
+        if name not in self.columns:
+            return None
+        if not userids:
+            return []
+        prop, default = self.columns[name]
+        indices = [self.sim.agents[u].index for u in userids]
+        table = self.table(kind, max(indices))
+        result = [table.get(i, prop, default) for i in indices]
+        if name == "db":
+            result = [{k: v**2 for k, v in r.items()} if r else None
+                      for r in result]
+        return result
+
+    # {property: (PairTable column, default)} The properties that just read
+    #  a column (see getBatch)
+    columns = {"rz": ("rz", 0), "rx": ("rx", 0), "dist": ("distProp", 0),
+               "db": ("rz", 0), "cert": ("cert", 1), "acc": ("acc", 0),
+               "over": ("overlap", 0)}
 
     @property
     def rz(self):
         """Return the horizontal angle of sound emitting agents"""
-        items = self.calcAndGetItems()
-        if items:
-            return self.buildDictFromProperty(items, "rz")
+        return self.getProperty("rz")
 
     @property
     def rx(self):
         """Return the vertical angle of sound emitting agents"""
-        items = self.calcAndGetItems()
-        if items:
-            return self.buildDictFromProperty(items, "rx")
+        return self.getProperty("rx")
 
     @property
     def dist(self):
         """Return the distance to the sound emitting agents 0-1"""
-        items = self.calcAndGetItems()
-        if items:
-            return self.buildDictFromProperty(items, "distProp")
+        return self.getProperty("distProp")
 
     @property
     def db(self):
         """Return the volume (dist^2) of sound emitting agents"""
-        items = self.calcAndGetItems()
-        if items:
-            tmp = self.buildDictFromProperty(items, "rz")
+        tmp = self.getProperty("rz")
+        if tmp:
             return {k: v**2 for k, v in tmp.items()}
 
     @property
     def cert(self):
         """Return the certainty of a prediction 0-1"""
-        items = self.calcAndGetItems()
-        if items:
-            return self.buildDictFromProperty(items, "cert", default=1)
+        return self.getProperty("cert", default=1)
 
     @property
     def acc(self):
         """Return the recommended acceleration to avoid a collision"""
-        items = self.calcAndGetItems()
-        if items:
-            return self.buildDictFromProperty(items, "acc")
+        return self.getProperty("acc")
 
     @property
     def over(self):
         """Return the predicted worst case overlap"""
-        items = self.calcAndGetItems()
-        if items:
-            return self.buildDictFromProperty(items, "overlap")
+        return self.getProperty("overlap")
+
+
+if __name__ == "__main__":
+    import unittest
+
+    from .iai_masterChannels import Wrapper as wr
+    from ..iai_agentState import AgentStateTable, OrientationCache
+    from ..iai_transforms import toLocal
+
+    class FakeScene():
+        """Impersonate the SceneAdapter. Objects are where their agents are"""
+        def __init__(self, state):
+            self.state = state
+
+        def getLocation(self, name):
+            return self.state.position[self.state.index[name]]
+
+        def getRotation(self, name):
+            return self.state.rotation[self.state.index[name]]
+
+        def getBoundsCentre(self, name):
+            return self.getLocation(name)
+
+    class FakeAgent():
+        """Impersonate Simulation.agents[n]"""
+        def __init__(self, bid, index):
+            self.id = bid
+            self.index = index
+            self.dimensions = (1, 1, 1)
+            self.radius = 0.5
+
+    class FakeSimulation():
+        """Impersonate the Simulation object"""
+        def __init__(self):
+            self.state = AgentStateTable()
+            self.scene = FakeScene(self.state)
+            self.agents = {}
+            self.orientations = OrientationCache(self)
+            self.profiler = None
+
+        def add(self, name, location, rotation=(0, 0, 0),
+                velocity=(0, 0, 0)):
+            row = self.state.add(name, location, rotation)
+            self.state.globalVelocity[row] = velocity
+            self.agents[name] = FakeAgent(name, row)
+            return self.agents[name]
+
+    def predictOne(sim, user, emitter, val):
+        """What calculatePrediction should give for one pair (worked out the
+        long way) or None if it isn't heard"""
+        state = sim.state
+        rows = state.index
+        p1 = state.position[rows[user]]
+        p2 = state.position[rows[emitter]]
+        d1 = state.globalVelocity[rows[user]]
+        d2 = state.globalVelocity[rows[emitter]]
+        a, b, e = d1.dot(d1), d1.dot(d2), d2.dot(d2)
+        d = a*e - b*b
+        if d == 0:
+            return None
+        c, f = d1.dot(p1 - p2), d2.dot(p1 - p2)
+        s = (b*f - c*e) / d
+        t = (a*f - b*c) / d
+        target = (p2 + s*d2) - (p1 + s*d1)
+        dist = numpy.linalg.norm(target)
+        if not (0 <= s <= MAXLOOKAHEAD and dist <= val):
+            return None
+        relative = toLocal(state.rotation[rows[user]], target)
+        c = min(s / 32, 1)
+        cert = 0 if s < 1 or t < 1 else \
+            (1 - ((-(c**3)/3 + (c**2)/2) * 6))**2
+        return {"rz": math.atan2(relative[0], relative[1])/math.pi,
+                "rx": math.atan2(relative[2], relative[1])/math.pi,
+                "dist": 1 - dist/val, "cert": cert}
+
+    class Test(unittest.TestCase):
+        def setUp(self):
+            self.FSim = FakeSimulation()
+            # These are the objects that can be used to emit and hear sounds
+            self.OB1 = self.FSim.add("OB1", [0, 0, 0])
+            self.OB2 = self.FSim.add("OB2", [1, 0, 0])
+            self.OB3 = self.FSim.add("OB3", [0, 1, 0])
+            self.OB4 = self.FSim.add("OB4", [0, -1, 0])
+            self.OB5 = self.FSim.add("OB5", [-0.1, -1, 0])
+
+            self.sound = wr(Sound(self.FSim))
+
+        def testOne(self):
+            """Some simple test cases"""
+            self.sound.register(self.OB1, "A", 1)
+            self.sound.register(self.OB2, "A", 1)
+            self.sound.register(self.OB3, "A", 1)
+
+            self.sound.setuser("OB1")
+            self.assertEqual(self.sound.A.rz, {"OB2": 0.5,
+                                               "OB3": 0})
+            self.assertEqual(self.sound.A.db, {"OB2": 0.25,
+                                               "OB3": 0})
+
+        def testBoundryRotations(self):
+            """Testing the extremes of the rotation"""
+            self.sound.register(self.OB1, "A", 1)
+            self.sound.register(self.OB4, "A", 1)
+            self.sound.register(self.OB5, "A", 1)
+
+            self.sound.setuser("OB1")
+            self.assertEqual(self.sound.A.rz["OB4"], 1)
+            self.assertTrue(-1 < self.sound.A.rz["OB5"] < -0.75)
+
+        def testAgentOrder(self):
+            """Tables are looked up by agent index, whatever order
+            sim.agents is in"""
+            self.FSim.agents = dict(reversed(list(self.FSim.agents.items())))
+            for ob in (self.OB1, self.OB2, self.OB3):
+                self.sound.register(ob, "A", 1)
+
+            for user, expected in (("OB1", {"OB2": 0.5, "OB3": 0}),
+                                   ("OB2", {"OB1": -0.5, "OB3": -0.25})):
+                self.sound.setuser(user)
+                self.assertEqual(self.sound.A.rz, expected)
+                self.assertEqual(self.sound.A.pred.rz, None)
+
+        def testPredictionCrossing(self):
+            """Two agents crossing paths. P1 is closest 5 frames from now and
+            P2 6 frames from now"""
+            self.FSim.add("P1", [0, 0, 0], velocity=[0, 1, 0])
+            self.FSim.add("P2", [6, 5, 0], velocity=[-1, 0, 0])
+            self.sound.register(self.FSim.agents["P1"], "A", 2)
+            self.sound.register(self.FSim.agents["P2"], "A", 2)
+
+            def certainty(s):
+                c = s / 32
+                return (1 - ((-(c**3)/3 + (c**2)/2) * 6))**2
+
+            self.sound.setuser("P1")
+            self.assertEqual(self.sound.A.pred.rz, {"P2": 0.5})
+            self.assertEqual(self.sound.A.pred.rx, {"P2": 0})
+            self.assertEqual(self.sound.A.pred.dist, {"P2": 0.5})
+            self.assertAlmostEqual(self.sound.A.pred.cert["P2"],
+                                   certainty(5))
+            # The other end of the pair uses its own time
+            self.sound.setuser("P2")
+            self.assertEqual(self.sound.A.pred.rz, {"P1": 0})
+            self.assertEqual(self.sound.A.pred.dist, {"P1": 0.5})
+            self.assertAlmostEqual(self.sound.A.pred.cert["P1"],
+                                   certainty(6))
+
+        def testPredictionNotHeard(self):
+            """Parallel, separating and distant agents predict nothing"""
+            self.FSim.add("P1", [0, 0, 0], velocity=[0, 1, 0])
+            self.FSim.add("P2", [1, 0, 0], velocity=[0, 1, 0])
+            self.FSim.add("P3", [1, -2, 0], velocity=[1, -1, 0])
+            self.FSim.add("P4", [50, 20, 0], velocity=[0, -1, 0])
+            for name in ("P2", "P3", "P4"):
+                self.sound.register(self.FSim.agents[name], "A", 2)
+
+            self.sound.setuser("P1")
+            self.assertIsNone(self.sound.A.pred.rz)
+            self.assertIsNone(self.sound.A.pred.cert)
+
+        def testPredictionSoon(self):
+            """Approaches less than a frame away aren't certain"""
+            self.FSim.add("P1", [0, 0, 0], velocity=[0, 1, 0])
+            self.FSim.add("P2", [0.5, 0.5, 0], velocity=[-1, 0, 0])
+            self.sound.register(self.FSim.agents["P2"], "A", 2)
+
+            self.sound.setuser("P1")
+            self.assertEqual(self.sound.A.pred.cert, {"P2": 0})
+
+        def testPredictionCrowd(self):
+            """A crowd compared with working out each pair on its own"""
+            rnd = numpy.random.RandomState(0)
+            names = ["C{}".format(i) for i in range(60)]
+            for name in names:
+                self.FSim.add(name, rnd.uniform(-20, 20, 3) * [1, 1, 0.1],
+                              [0, 0, rnd.uniform(-3, 3)],
+                              rnd.uniform(-1, 1, 3) * [1, 1, 0.1])
+            vals = {name: rnd.uniform(1, 6) for name in names[::2]}
+            for name, val in vals.items():
+                self.sound.register(self.FSim.agents[name], "A", val)
+
+            heard = 0
+            for user in names:
+                self.sound.setuser(user)
+                got = {p: getattr(self.sound.A.pred, p) or {}
+                       for p in ("rz", "rx", "dist", "cert")}
+                expected = {}
+                for emitter, val in vals.items():
+                    if emitter != user:
+                        result = predictOne(self.FSim, user, emitter, val)
+                        if result is not None:
+                            expected[emitter] = result
+                self.assertEqual(list(got["rz"]), list(expected))
+                for emitter, result in expected.items():
+                    for p, v in result.items():
+                        self.assertAlmostEqual(got[p][emitter], v)
+                heard += len(expected)
+            self.assertTrue(heard > 0)
+
+        def tearDown(self):
+            self.sound.newframe()
+
+    # Run unit test
+    unittest.main()
@@ -1,4 +1,5 @@
-import bpy
+import numpy
+
 from .iai_masterChannels import MasterChannel as Mc
 
 
@@ -9,17 +10,18 @@ class State(Mc):
 
     @property
     def radius(self):
-        return bpy.context.scene.objects[self.userid].dimensions.length/2
+        dimensions = self.sim.scene.getDimensions(self.userid)
+        return numpy.linalg.norm(dimensions)/2
 
     @property
     def userObject(self):
         """Shoudn't really ever be used but here for when a feature is missing"""
-        return bpy.context.scene.objects[self.userid]
+        return self.sim.scene.getObject(self.userid)
 
     @property
     def speed(self):
         """Get the distance travelled in the last frame"""
-        return self.sim.agents[self.userid].globalVelocity.length
+        return numpy.linalg.norm(self.sim.agents[self.userid].globalVelocity)
 
     @property
     def velocity(self):
@@ -1,8 +1,6 @@
-import bpy
 from .iai_masterChannels import MasterChannel as Mc
 
 import math
-import mathutils
 
 
 class World(Mc):
@@ -26,7 +24,7 @@ class World(Mc):
 
     @property
     def time(self):
-        return bpy.context.scene.frame_current
+        return self.sim.scene.frameCurrent
 
 
 class Channel:
@@ -40,28 +38,27 @@ class Channel:
         self.calcd = False
 
     def calculate(self):
-        O = bpy.context.scene.objects
+        prof = self.sim.profiler
+        if prof is not None:
+            t = prof.now()
+        scene = self.sim.scene
 
-        to = O[self.target]
-        ag = O[self.userid]
+        toLocation = scene.getLocation(self.target)
+        agLocation = scene.getLocation(self.userid)
         userDim = self.sim.agents[self.userid].dimensions
 
         tDim = max(self.sim.agents[self.target].dimensions)
         uDim = max(userDim)
 
-        difx = to.location.x - ag.location.x
-        dify = to.location.y - ag.location.y
-        difz = to.location.z - ag.location.z
+        difx = toLocation[0] - agLocation[0]
+        dify = toLocation[1] - agLocation[1]
+        difz = toLocation[2] - agLocation[2]
         dist = math.sqrt(difx**2 + dify**2 + difz**2)
 
-        target = to.location - ag.location
+        target = toLocation - agLocation
 
-        z = mathutils.Matrix.Rotation(ag.rotation_euler[2], 4, 'Z')
-        y = mathutils.Matrix.Rotation(ag.rotation_euler[1], 4, 'Y')
-        x = mathutils.Matrix.Rotation(ag.rotation_euler[0], 4, 'X')
-
-        rotation = x * y * z
-        relative = target * rotation
+        relative = self.sim.orientations.toLocal(
+            self.sim.agents[self.userid].index, target)
 
         changez = math.atan2(relative[0], relative[1])/math.pi
         changex = math.atan2(relative[2], relative[1])/math.pi
@@ -70,6 +67,8 @@ class Channel:
                                  "arrived": 1 if dist < (tDim + uDim) else 0}
 
         self.calcd = True
+        if prof is not None:
+            prof.add("channel.World", t)
 
     @property
     def rz(self):
@@ -6,9 +6,13 @@ collision detection and point intersection tests.
 try:
     from ins_vector import Vector
 except:
-    from mathutils import Vector
+    from .ins_vector import Vector
 
-import bpy
+try:
+    import bpy
+except ImportError:
+    # Only needed by the *FromBPY functions
+    bpy = None
 
 #  TODO use Vector for locations and dimensions
 
@@ -70,7 +70,7 @@ except:
             return sum([x**2 for x in self])
 
         def __eq__(self, eq):
-            if not isinstance(eq, Vector) or (self.length() != eq.length()):
+            if not isinstance(eq, Vector) or (self.length != eq.length):
                 return False
             result = True
             for d1, d2 in zip(self._vec, eq._vec):
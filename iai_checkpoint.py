@@ -0,0 +1,182 @@
+"""Saving the state of a simulation at the end of a frame so that it can be
+carried on from there later instead of starting again from the first frame.
+
+A checkpoint is a compressed numpy .npz file. The AgentStateTable arrays are
+stored as they are and everything else (brain states, agvars, tags and the
+state of the channels that persists between frames) is stored as json in
+the "meta" array.
+
+The random numbers (see iai_random) only depend on the seed, the agent and
+the frame so only the seed needs saving. The keyframes and actions already
+written to the scene are not part of the checkpoint.
+"""
+
+import io
+import json
+import os
+
+import numpy
+
+VERSION = 2
+
+
+def vertex(v):
+    return [float(x) for x in v]
+
+
+def dumpFormations(formation):
+    result = {}
+    for formID, f in formation.formations.items():
+        lastCalcd = None
+        if f.lastCalcd is not None:
+            agents, targets, calcd = f.lastCalcd
+            lastCalcd = [sorted(agents), sorted(vertex(t) for t in targets),
+                         {k: vertex(v) for k, v in calcd.items()}]
+        result[formID] = {"priority": f.priority,
+                          "targets": [vertex(t) for t in f.targets],
+                          "lastCalcd": lastCalcd}
+    return result
+
+
+def loadFormations(formation, data):
+    for formID, d in data.items():
+        if formID not in formation.formations:
+            continue
+        f = formation.formations[formID]
+        f.priority = d["priority"]
+        f.targets = [numpy.array(t) for t in d["targets"]]
+        if d["lastCalcd"] is None:
+            f.lastCalcd = None
+        else:
+            agents, targets, calcd = d["lastCalcd"]
+            f.lastCalcd = (set(agents), set(tuple(t) for t in targets),
+                           {k: numpy.array(v) for k, v in calcd.items()})
+
+
+def dumpMeta(sim, agents):
+    """Everything but the AgentStateTable as a json compatible dict
+
+    :param agents: the agents to include the brain state of"""
+    brains = {}
+    for ag in agents:
+        brain = ag.brain
+        brains[ag.id] = {
+            "currentState": brain.currentState,
+            "activeState": brain.activeState,
+            "states": {name: [brain.stateFrame[name], brain.stateLength[name]]
+                       for name in brain.compiled.states},
+            "agvars": brain.agvars,
+            "tags": brain.tags}
+    return {"version": VERSION,
+            "framelast": sim.framelast,
+            "seed": sim.rng.seed,
+            "ids": sim.state.ids,
+            "brains": brains,
+            # Replayed in order on load so that the channels see the tags in
+            #  the same order as they did originally
+            "tagged": [[tag, list(members.items())]
+                       for tag, members in sim.tagRegistry.tagged.items()],
+            "formations": dumpFormations(sim.lvars["Formation"].channel)}
+
+
+def dumps(sim):
+    """The state of sim as bytes"""
+    if sim.parallel is not None:
+        # The brains are only up to date in the worker processes
+        meta = sim.parallel.checkpointMeta()
+    else:
+        meta = dumpMeta(sim, sim.agents.values())
+
+    state = sim.state
+    arrays = {f: getattr(state, f)[:state.count] for f in state.fields}
+    # default=float for numpy numbers
+    meta = json.dumps(meta, default=float).encode()
+    arrays["meta"] = numpy.frombuffer(meta, dtype=numpy.uint8)
+    buf = io.BytesIO()
+    numpy.savez_compressed(buf, **arrays)
+    return buf.getvalue()
+
+
+def loads(sim, data):
+    """Restore the state of sim from the output of dumps. sim must have just
+    been created (with the same scene and agents) and not stepped yet"""
+    with numpy.load(io.BytesIO(data)) as arrays:
+        meta = json.loads(arrays["meta"].tobytes().decode())
+        if meta["version"] != VERSION:
+            raise ValueError("Unknown checkpoint version {}".format(
+                meta["version"]))
+        state = sim.state
+        if meta["ids"] != state.ids:
+            raise ValueError("The checkpoint is for different agents")
+        n = state.count
+        for f in state.fields:
+            getattr(state, f)[:n] = arrays[f]
+
+    sim.framelast = meta["framelast"]
+    sim.rng.seed = meta["seed"]
+
+    scene = sim.scene
+    for agentid, ag in sim.agents.items():
+        scene.setPose(agentid, tuple(state.position[ag.index]),
+                      tuple(state.rotation[ag.index]))
+    sim.orientations.clear()
+    loadBrains(sim, meta)
+
+    for tag, members in meta["tagged"]:
+        for agentid, value in members:
+            sim.tagRegistry.applyChanges(sim.agents[agentid], {tag: value})
+
+    loadFormations(sim.lvars["Formation"].channel, meta["formations"])
+
+
+def loadBrains(sim, meta):
+    """Restore the brain states, agvars and tags from the output of
+    dumpMeta"""
+    for agentid, b in meta["brains"].items():
+        ag = sim.agents[agentid]
+        brain = ag.brain
+        brain.currentState = b["currentState"]
+        brain.activeState = b["activeState"]
+        for name, (stateFrame, stateLength) in b["states"].items():
+            brain.stateFrame[name] = stateFrame
+            brain.stateLength[name] = stateLength
+        # These dicts are shared with the Agent so change them in place
+        brain.agvars.clear()
+        brain.agvars.update(b["agvars"])
+        brain.tags.clear()
+        brain.tags.update(b["tags"])
+        brain.tagChanges = {}
+        ag.access["tags"] = dict(b["tags"])
+
+
+def save(sim, path):
+    with open(path, "wb") as f:
+        f.write(dumps(sim))
+
+
+def load(sim, path):
+    with open(path, "rb") as f:
+        loads(sim, f.read())
+
+
+def checkpointPath(directory, frame):
+    return os.path.join(directory, "checkpoint_{:06d}.npz".format(frame))
+
+
+def findCheckpoint(directory, frame):
+    """The path of the latest checkpoint in directory from before or on
+    frame or None if there isn't one"""
+    best = None
+    if not os.path.isdir(directory):
+        return None
+    for name in os.listdir(directory):
+        if name.startswith("checkpoint_") and name.endswith(".npz"):
+            try:
+                f = int(name[len("checkpoint_"):-len(".npz")])
+            except ValueError:
+                continue
+            if f <= frame and (best is None or f > best):
+                best = f
+    if best is None:
+        return None
+    return checkpointPath(directory, best)
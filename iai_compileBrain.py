@@ -1,8 +1,8 @@
-import bpy
-
-from .iai_nodeFunctions import logictypes, statetypes
+from .iai_nodeFunctions import logictypes, statetypes, LogicCONSTANT
 from collections import OrderedDict
-from .iai_brainClasses import Neuron, Brain, State
+from .iai_brainClasses import CompiledBrain, ImpulseContainer, State
+from .iai_brainClasses import wrapOutput
+from .iai_brainCodegen import compileBrainFunction
 import functools
 
 
@@ -40,34 +40,181 @@ def getOutputs(out):
     return result
 
 
-def compileBrain(nodeGroup, sim, userid):
-    """Compile the brain that defines how and agent moves and is animated"""
-    result = Brain(sim, userid)
-    """create the connections from the node"""
+class SettingsHolder:
+    """Given to bpyNode.getSettings in place of a neuron or state"""
+    def __init__(self):
+        self.settings = {}
+
+
+def describeNodeGroup(nodeGroup):
+    """Turn a bpy node group into the plain description of the brain graph
+    that compileBrain uses (see iai_sceneAdapter for the format)"""
+    result = []
     for node in nodeGroup.nodes:
+        if node.bl_idname not in logictypes and \
+                node.bl_idname not in statetypes:
+            continue
+        # node.name  -  The identifier
+        # node.bl_idname  -  The type
+        holder = SettingsHolder()
+        node.getSettings(holder)
+        desc = {"name": node.name, "type": node.bl_idname, "bpyNode": node}
+        desc.update(vars(holder))
         if node.bl_idname in logictypes:
-            # node.name  -  The identifier
-            # node.bl_idname  -  The type
-            item = logictypes[node.bl_idname](result, node)
-            node.getSettings(item)
             if node.bl_idname == "PriorityNode":
-                item.inputs = getMultiInputs(node.inputs)
+                desc["inputs"] = getMultiInputs(node.inputs)
+            else:
+                desc["inputs"] = getInputs(node.inputs["Input"])
+            desc["dependantOn"] = getOutputs(node.outputs["Dependant"])
+            desc["isOutput"] = not node.outputs["Output"].is_linked
+        else:
+            desc["outputs"] = getOutputs(node.outputs["To"])
+            if node.bl_idname != "StartState":
+                desc["valueInputs"] = getInputs(node.inputs["Value"])
+        result.append(desc)
+    return result
+
+
+class ConstantBrain:
+    """Given to Neuron.core in place of a BrainInstance when working out the
+    output of a pure node in optimiseBrain"""
+    lvars = {}
+
+
+def optimiseBrain(compiled):
+    """Make the schedule of compiled do less for every agent every frame
+    without changing what it does.
+
+        Pure nodes (see Neuron.isPure) whose inputs are all constant are
+            worked out once and replaced by a LogicCONSTANT.
+        Pure nodes with the same type, settings, inputs and dependantOn as
+            one earlier in the schedule are merged into that one.
+        Nodes whose output isn't used by anything with side effects (see
+            Neuron.hasSideEffects) or by a state are taken out of the
+            schedule.
+
+    What was changed is printed and kept in compiled.optimised"""
+    neurons = compiled.neurons
+    folded = []
+    merged = OrderedDict()  # {name: the neuron it was merged into}
+    seen = {}
+    done = set()
+
+    def rename(names):
+        return [merged.get(n, n) for n in names]
+
+    def isConstant(name):
+        """If the output of the neuron is always the same when it is
+        used"""
+        neur = neurons[name]
+        return name in done and isinstance(neur, LogicCONSTANT) and \
+            not neur.dependantOn
+
+    schedule = []
+    for neur in compiled.schedule:
+        name = neur.name
+        done.add(name)
+        if isinstance(neur, State):
+            neur.valueInputs = rename(neur.valueInputs)
+            schedule.append(neur)
+            continue
+        neur.inputs = rename(neur.inputs)
+        if not neur.isPure():
+            schedule.append(neur)
+            continue
+
+        if not isinstance(neur, LogicCONSTANT) and \
+                all(isConstant(i) for i in neur.inputs):
+            values = [neurons[i].settings["Value"] for i in neur.inputs]
+            inps = [ImpulseContainer(dict(v)) for v in values
+                    if v is not None]
+            try:
+                output = wrapOutput(neur.core(ConstantBrain, inps,
+                                              neur.settings))
+            except Exception:
+                # Left to go wrong when the brain is evaluated
+                output = False
+            if output is not False:
+                const = LogicCONSTANT(compiled, neur.bpyNode, name)
+                const.settings["Value"] = None if output is None else \
+                    dict(output.cont)
+                const.dependantOn = neur.dependantOn
+                neurons[name] = const
+                neur = const
+                folded.append(name)
+
+        key = (type(neur).__name__, repr(sorted(neur.settings.items())),
+               tuple(neur.inputs), tuple(neur.dependantOn))
+        if key in seen:
+            merged[name] = seen[key]
+            continue
+        seen[key] = name
+        schedule.append(neur)
+
+    live = set()
+    for neur in reversed(schedule):
+        if neur.name in live or isinstance(neur, State) or \
+                neur.hasSideEffects():
+            live.add(neur.name)
+            if isinstance(neur, State):
+                live.update(neur.valueInputs)
             else:
-                item.inputs = getInputs(node.inputs["Input"])
-            item.dependantOn = getOutputs(node.outputs["Dependant"])
-            if not node.outputs["Output"].is_linked:
-                result.outputs.append(node.name)
-            result.neurons[node.name] = item
-        elif node.bl_idname in statetypes:
-            item = statetypes[node.bl_idname](result, node, node.name)
-            node.getSettings(item)
-            item.outputs = getOutputs(node.outputs["To"])
-            print(node.name, "outputs", item.outputs)
-            if node.bl_idname == "StartState":
-                result.setStartState(node.name)
+                live.update(neur.inputs)
+    removed = [n.name for n in schedule if n.name not in live]
+    schedule = [n for n in schedule if n.name in live]
+
+    compiled.aliases = OrderedDict((name, into) for name, into in
+                                   merged.items() if into in live)
+    compiled.setSchedule(schedule)
+    compiled.optimised = {"folded": folded, "merged": merged,
+                          "removed": removed}
+    if folded:
+        print("Folded constant nodes:", ", ".join(folded))
+    if merged:
+        print("Merged duplicate nodes:", ", ".join(
+            "{} into {}".format(n, into) for n, into in merged.items()))
+    if removed:
+        print("Removed unused nodes:", ", ".join(removed))
+
+
+def compileBrain(brainGraph, sim):
+    """Compile the brain that defines how and agent moves and is animated.
+    The result is shared by every agent with this brain type, see
+    CompiledBrain.instance"""
+    result = CompiledBrain(sim)
+    """create the connections from the node"""
+    for desc in brainGraph:
+        name = desc["name"]
+        bpyNode = desc.get("bpyNode")
+        if desc["type"] in logictypes:
+            item = logictypes[desc["type"]](result, bpyNode, name)
+            item.settings.update(desc["settings"])
+            item.inputs = list(desc["inputs"])
+            item.dependantOn = list(desc["dependantOn"])
+            if desc["isOutput"]:
+                result.outputs.append(name)
+            result.neurons[name] = item
+        elif desc["type"] in statetypes:
+            item = statetypes[desc["type"]](result, bpyNode, name)
+            item.settings.update(desc["settings"])
+            for attr in ("length", "cycleState", "actionName",
+                         "useValueOfSpeed"):
+                if attr in desc:
+                    setattr(item, attr, desc[attr])
+            item.outputs = list(desc["outputs"])
+            if desc["type"] == "StartState":
+                result.setStartState(name)
             else:
-                item.valueInputs = getInputs(node.inputs["Value"])
+                item.valueInputs = list(desc["valueInputs"])
                 if len(item.valueInputs) != 0:
-                    result.outputs.append(node.name)
-            result.neurons[node.name] = item
+                    result.outputs.append(name)
+            result.neurons[name] = item
+            result.states.append(name)
+    for item in result.neurons.values():
+        item.setup()
+    result.buildSchedule()
+    if sim.optimise:
+        optimiseBrain(result)
+    if sim.codegen:
+        compileBrainFunction(result, brainGraph)
     return result
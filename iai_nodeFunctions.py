@@ -1,16 +1,20 @@
 from collections import OrderedDict
+import ast
 import math
 from . import iai_brainClasses
-from .iai_brainClasses import Neuron, State
-from . import iai_pythonEmbededInterpreter
-from .iai_pythonEmbededInterpreter import Interpreter
-import copy
-import bpy
+from .iai_brainClasses import Neuron, State, ImpulseContainer, wrapOutput
+from .iai_debuggingMode import debugMode
+from .iai_brainBatch import ImpulseTable, gather, groups, lastValues, power
+from .iai_brainBatch import perAgentSum, perAgentCount, lookup
+from .iai_pythonEmbededInterpreter import Script
+
+import numpy
 
 
 """
 class Logic{NAME}(Neuron):
-    def core(self, inps, settings):
+    def core(self, brain, inps, settings):
+        :param brain: the BrainInstance of the agent being evaluated
         :param inps: list of form [ImpulseContainer |
                                    dict of form {str: float | int}, ]
         :param settings: dict of form {str: str | int | float, }
@@ -20,19 +24,159 @@ class Logic{NAME}(Neuron):
 
 class LogicINPUT(Neuron):
     """Retrieve information from the scene or about the agent"""
-
-    def core(self, inps, settings):
-        lvars = copy.copy(self.brain.lvars)
-        lvars["math"] = math
-        lvars["inps"] = inps
-        result = eval(settings["Input"], lvars)
-        return result
+    # Names that can be used in the expression without anything happening
+    pureNames = {"math", "inps", "abs", "min", "max", "round", "len", "sum",
+                 "int", "float", "bool", "pow", "dict", "list", "tuple",
+                 "sorted", "any", "all", "range", "zip"}
+
+    def __init__(self, compiled, bpyNode, name):
+        Neuron.__init__(self, compiled, bpyNode, name)
+        self.tree = None  # type: ast.Expression - None if not valid
+        self.code = None
+        self.namespace = None  # type: Dict[str, object]
+        self.getter = None  # type: Callable - for Channel.attr[.attr...]
+        # type: Callable - the same for a list of agents (see batch)
+        self.batchGetter = None
+
+    def setup(self):
+        """Parse and compile the expression once and check that the channel
+        attributes it uses exist"""
+        expression = self.settings["Input"]
+        lvars = self.compiled.sim.lvars
+        self.namespace = dict(lvars)
+        self.namespace["math"] = math
+        try:
+            self.tree = ast.parse(expression, mode="eval")
+        except SyntaxError as e:
+            print("Syntax error in Input node", self.name, e)
+            self.tree = self.code = self.getter = self.batchGetter = None
+            return
+        self.code = compile(self.tree, "<Input node {}>".format(self.name),
+                            "eval")
+
+        for node in ast.walk(self.tree):
+            if isinstance(node, ast.Attribute) and \
+                    isinstance(node.value, ast.Name) and \
+                    node.value.id in lvars and \
+                    not lvars[node.value.id].hasQuery(node.attr):
+                print("Input node", self.name, "uses", node.value.id +
+                      "." + node.attr, "which", node.value.id,
+                      "doesn't have")
+
+        """Things like Sound.A.dist are looked up without eval"""
+        attrs = []
+        node = self.tree.body
+        while isinstance(node, ast.Attribute):
+            attrs.append(node.attr)
+            node = node.value
+        self.getter = None
+        self.batchGetter = None
+        if attrs and isinstance(node, ast.Name) and node.id in lvars:
+            self.batchGetter = lvars[node.id].batchGetter(attrs[::-1])
+            first = lvars[node.id].getter(attrs.pop())
+            attrs.reverse()
+            if attrs:
+                def get():
+                    result = first()
+                    for attr in attrs:
+                        result = getattr(result, attr)
+                    return result
+                self.getter = get
+            else:
+                self.getter = first
+
+    def core(self, brain, inps, settings):
+        if self.getter is not None:
+            return self.getter()
+        if self.code is None:
+            # Raises the syntax error
+            return eval(settings["Input"])
+        namespace = self.namespace
+        namespace["inps"] = inps
+        return eval(self.code, namespace)
+
+    def hasBatch(self):
+        return self.batchGetter is not None
+
+    def batch(self, batch, ins, active):
+        """Ask the channel for every active agent at once"""
+        userids = [b.userid for b, a in zip(batch.brains, active) if a]
+        values = self.batchGetter(userids)
+        if values is None:
+            return None
+        values = iter(values)
+        return ImpulseTable.fromOutputs(
+            batch, [wrapOutput(next(values)) if a else None for a in active])
+
+    def names(self):
+        """The variables used in the expression (None if it can't be
+        parsed)"""
+        if self.tree is None:
+            return None
+        return {n.id for n in ast.walk(self.tree) if isinstance(n, ast.Name)}
+
+    def hasSideEffects(self):
+        names = self.names()
+        if names is None:
+            return True
+        lvars = self.compiled.sim.lvars
+        for name in names - self.pureNames:
+            if name not in lvars or \
+                    lvars[name].channel.queriesHaveSideEffects:
+                return True
+        return False
+
+    def isPure(self):
+        names = self.names()
+        return names is not None and names <= self.pureNames
+
+
+class LogicCONSTANT(Neuron):
+    """Put in place of a node whose output is always the same by
+    iai_compileBrain.optimiseBrain. settings["Value"] is the output as a
+    dict (or None)"""
+    sideEffects = False
+    pure = True
+
+    def core(self, brain, inps, settings):
+        if settings["Value"] is None:
+            return None
+        return dict(settings["Value"])
+
+    def emit(self, settings):
+        literal = repr(settings["Value"])
+        try:
+            if ast.literal_eval(literal) != settings["Value"]:
+                return None
+        except (ValueError, SyntaxError):
+            return None
+        return ["im = " + literal], "any"
+
+    def batch(self, batch, ins, active):
+        if self.settings["Value"] is None:
+            empty = numpy.zeros(0, dtype=numpy.int64)
+            return ImpulseTable(batch, numpy.ones(batch.n, dtype=bool),
+                                empty, empty, numpy.zeros(0))
+        ids, vals = ImpulseContainer(self.settings["Value"]).arrays()
+        if vals.dtype == object:
+            return None
+        rows = numpy.flatnonzero(active)
+        return ImpulseTable.keyed(batch, active,
+                                  numpy.repeat(rows, len(ids)),
+                                  numpy.tile(ids, len(rows)),
+                                  numpy.tile(vals, len(rows)))
+
+
+GRAPHLOST = """LogicGRAPH data lost due to multiple inputs
+                             with the same key"""
 
 
 class LogicGRAPH(Neuron):
     """Return value 0 to 1 mapping from graph"""
+    sideEffects = False
+    pure = True
 
-    def core(self, inps, settings):
+    def core(self, brain, inps, settings):
         def linear(value):
             lz = settings["LowerZero"]
             lo = settings["LowerOne"]
@@ -59,38 +203,99 @@ class LogicGRAPH(Neuron):
 
         output = {}
         for into in inps:
-            for i in into:
-                if i.key in output:
-                    print("""LogicGRAPH data lost due to multiple inputs
-                             with the same key""")
+            for key, val in into.items():
+                if key in output:
+                    print(GRAPHLOST)
                 else:
                     if settings["CurveType"] == "RBF":
-                        output[i.key] = RBF(i.val)
+                        output[key] = RBF(val)
                     elif settings["CurveType"] == "RANGE":
-                        output[i.key] = linear(i.val)
+                        output[key] = linear(val)
                     # cubic bezier could also be an option here (1/2 sided)
         return output
 
+    def emit(self, settings):
+        lines = ["im = {}",
+                 "for into in inps:",
+                 "    for key, val in into.items():",
+                 "        if key in im:",
+                 "            print(" + repr(GRAPHLOST) + ")",
+                 "        else:"]
+        if settings["CurveType"] == "RBF":
+            u = settings["RBFMiddle"]
+            a = math.log(0.1) / (settings["RBFTenPP"]**2)
+            lines += ["            im[key] = {!r}**({!r}*(val-{!r})**2)"
+                      .format(math.e, a, u)]
+        elif settings["CurveType"] == "RANGE":
+            lz = settings["LowerZero"]
+            lo = settings["LowerOne"]
+            uo = settings["UpperOne"]
+            uz = settings["UpperZero"]
+            lines += ["            if val < {!r}:".format(lz),
+                      "                im[key] = 0",
+                      "            elif val < {!r}:".format(lo),
+                      "                im[key] = (val - {!r}) / {!r}"
+                      .format(lz, lo - lz),
+                      "            elif val <= {!r}:".format(uo),
+                      "                im[key] = 1",
+                      "            elif val < {!r}:".format(uz),
+                      "                im[key] = ({!r} - val) / {!r}"
+                      .format(uz, uz - uo),
+                      "            else:",
+                      "                im[key] = 0"]
+        else:
+            lines += ["            pass"]
+        return lines, "dict"
+
+    def batch(self, batch, ins, active):
+        settings = self.settings
+        agents, codes, v = gather(ins, active)
+        first, group = groups(batch, agents, codes)
+        for i in range(len(v) - len(first)):
+            print(GRAPHLOST)
+        agents = agents[first]
+        codes = codes[first]
+        v = v[first]
+        if settings["CurveType"] == "RBF":
+            u = settings["RBFMiddle"]
+            a = math.log(0.1) / (settings["RBFTenPP"]**2)
+            values = power(math.e, a*power(v-u, 2))
+        elif settings["CurveType"] == "RANGE":
+            lz = settings["LowerZero"]
+            lo = settings["LowerOne"]
+            uo = settings["UpperOne"]
+            uz = settings["UpperZero"]
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                values = numpy.select([v < lz, v < lo, v <= uo, v < uz],
+                                      [0, (v - lz) / (lo - lz), 1,
+                                       (uz - v) / (uz - uo)], 0)
+        else:
+            agents = codes = agents[:0]
+            values = v[:0]
+        return ImpulseTable.keyed(batch, active, agents, codes, values)
+
 
 class LogicAND(Neuron):
     """returns the values multiplied together"""
+    sideEffects = False
+    pure = True
 
-    def core(self, inps, settings):
+    def core(self, brain, inps, settings):
         results = {}
         for into in inps:
-            for i in into:
-                if i.key in results:
+            for key, val in into.items():
+                if key in results:
                     if settings["Method"] == "MUL":
-                        results[i.key] *= i.val
+                        results[key] *= val
                     else:  # Method == "MIN"
-                        results[i.key] = min(results[i.key], i.val)
+                        results[key] = min(results[key], val)
                 else:
                     inAll = True
                     if settings["IncludeAll"]:
                         for intoB in inps:
-                            inAll &= i.key in intoB
+                            inAll &= key in intoB
                     if inAll:
-                        results[i.key] = i.val
+                        results[key] = val
 
         if settings["SingleOutput"]:
             total = 1
@@ -103,18 +308,81 @@ class LogicAND(Neuron):
         else:
             return results
 
+    def emit(self, settings):
+        mul = settings["Method"] == "MUL"
+        lines = ["im = {}",
+                 "for into in inps:",
+                 "    for key, val in into.items():",
+                 "        if key in im:"]
+        if mul:
+            lines += ["            im[key] *= val"]
+        else:
+            lines += ["            im[key] = min(im[key], val)"]
+        lines += ["        else:"]
+        if settings["IncludeAll"]:
+            lines += ["            inAll = True",
+                      "            for intoB in inps:",
+                      "                inAll &= key in intoB",
+                      "            if inAll:",
+                      "                im[key] = val"]
+        else:
+            lines += ["            im[key] = val"]
+        if settings["SingleOutput"]:
+            if mul:
+                lines += ["total = 1",
+                          "for v in im.values():",
+                          "    total *= v"]
+            else:
+                lines += ["total = min(im)"]
+            lines += ["im = {'None': total}"]
+        return lines, "dict"
+
+    def batch(self, batch, ins, active):
+        settings = self.settings
+        mul = settings["Method"] == "MUL"
+        if settings["SingleOutput"] and not mul:
+            # min of the keys. Leave it to core
+            return None
+        agents, codes, v = gather(ins, active)
+        first, group = groups(batch, agents, codes)
+        rest = numpy.ones(len(v), dtype=bool)
+        rest[first] = False
+        acc = v[first]
+        if mul:
+            numpy.multiply.at(acc, group[rest], v[rest])
+        else:
+            numpy.minimum.at(acc, group[rest], v[rest])
+        agents = agents[first]
+        codes = codes[first]
+        if settings["IncludeAll"]:
+            # In every input that isn't None
+            inputs = sum(((~t.isNone).astype(int) for t in ins),
+                         numpy.zeros(batch.n, dtype=int))
+            keep = numpy.bincount(group, minlength=len(first)) == \
+                inputs[agents]
+            agents = agents[keep]
+            codes = codes[keep]
+            acc = acc[keep]
+        if settings["SingleOutput"]:
+            total = numpy.ones(batch.n)
+            numpy.multiply.at(total, agents, acc)
+            return ImpulseTable.scalar(batch, total, active)
+        return ImpulseTable.keyed(batch, active, agents, codes, acc)
+
 
 class LogicOR(Neuron):
     """If any of the values are high return a high value
     1 - ((1-a) * (1-b) * (1-c)...)"""
+    sideEffects = False
+    pure = True
 
-    def core(self, inps, settings):
+    def core(self, brain, inps, settings):
         if settings["SingleOutput"]:
             total = 1
             for into in inps:
                 if settings["Method"] == "MUL":
-                    for i in [i.val for i in into]:
-                        total *= (1-i)
+                    for val in into.values():
+                        total *= (1-val)
                     total = 1 - total
                 else:  # Method == "MAX"
                     total = max(into.values())
@@ -122,220 +390,510 @@ class LogicOR(Neuron):
         else:
             results = {}
             for into in inps:
-                for i in into:
-                    if i.key in results:
+                for key, val in into.items():
+                    if key in results:
                         if settings["Method"] == "MUL":
-                            results[i.key] *= (1-i.val)
+                            results[key] *= (1-val)
                         else:  # Method == "MAX"
-                            results[i.key] = min(1-results[i.key], 1-i.val)
+                            results[key] = min(1-results[key], 1-val)
                     else:
-                        results[i.key] = (1-i.val)
+                        results[key] = (1-val)
             results.update((k, 1-v) for k, v in results.items())
             return results
 
+    def emit(self, settings):
+        mul = settings["Method"] == "MUL"
+        if settings["SingleOutput"]:
+            lines = ["im = 1",
+                     "for into in inps:"]
+            if mul:
+                lines += ["    for v in into.values():",
+                          "        im *= (1-v)",
+                          "    im = 1 - im"]
+            else:
+                lines += ["    im = max(into.values())"]
+            return lines, "number"
+        lines = ["im = {}",
+                 "for into in inps:",
+                 "    for key, val in into.items():",
+                 "        if key in im:"]
+        if mul:
+            lines += ["            im[key] *= (1-val)"]
+        else:
+            lines += ["            im[key] = min(1-im[key], 1-val)"]
+        lines += ["        else:",
+                  "            im[key] = (1-val)",
+                  "im.update((k, 1-v) for k, v in im.items())"]
+        return lines, "dict"
+
+    def batch(self, batch, ins, active):
+        mul = self.settings["Method"] == "MUL"
+        if self.settings["SingleOutput"]:
+            total = numpy.ones(batch.n)
+            for t in ins:
+                used = active & ~t.isNone
+                use = active[t.agents]
+                agents = t.agents[use]
+                v = t.values[use]
+                if mul:
+                    numpy.multiply.at(total, agents, 1-v)
+                    total = numpy.where(used, 1 - total, total)
+                else:
+                    if (used & (perAgentCount(batch, agents) == 0)).any():
+                        # max() of nothing. Leave the error to core
+                        return None
+                    best = numpy.full(batch.n, -numpy.inf)
+                    numpy.maximum.at(best, agents, v)
+                    total = numpy.where(used, best, total)
+            return ImpulseTable.scalar(batch, total, active)
+        agents, codes, v = gather(ins, active)
+        first, group = groups(batch, agents, codes)
+        rest = numpy.ones(len(v), dtype=bool)
+        rest[first] = False
+        acc = 1 - v[first]
+        if mul:
+            numpy.multiply.at(acc, group[rest], 1 - v[rest])
+        else:
+            for i in numpy.flatnonzero(rest):
+                acc[group[i]] = min(1-acc[group[i]], 1-v[i])
+        return ImpulseTable.keyed(batch, active, agents[first], codes[first],
+                                  1 - acc)
+
 
 class LogicStrong(Neuron):
     """Make 1's and 0's stronger"""
     # https://www.desmos.com/calculator/izfhogpchr
+    sideEffects = False
+    pure = True
 
-    def core(self, inps, settings):
+    def core(self, brain, inps, settings):
         results = {}
         for into in inps:
-            for i in into:
-                results[i.key] = i.val**2 * (-2*i.val + 3)
+            for key, val in into.items():
+                results[key] = val**2 * (-2*val + 3)
         return results
 
+    def emit(self, settings):
+        return ["im = {}",
+                "for into in inps:",
+                "    for key, val in into.items():",
+                "        im[key] = val**2 * (-2*val + 3)"], "dict"
+
+    def batch(self, batch, ins, active):
+        agents, codes, v = gather(ins, active)
+        first, group = groups(batch, agents, codes)
+        v = lastValues(v, group, len(first))
+        return ImpulseTable.keyed(batch, active, agents[first], codes[first],
+                                  power(v, 2) * (-2*v + 3))
+
 
 class LogicWeak(Neuron):
     """Make 1's and 0's stronger"""
     # https://www.desmos.com/calculator/izfhogpchr
+    sideEffects = False
+    pure = True
 
-    def core(self, inps, settings):
+    def core(self, brain, inps, settings):
         results = {}
         for into in inps:
-            for i in into:
-                results[i.key] = 2*i.val - (i.val**2 * (-2*i.val + 3))
+            for key, val in into.items():
+                results[key] = 2*val - (val**2 * (-2*val + 3))
         return results
 
+    def emit(self, settings):
+        return ["im = {}",
+                "for into in inps:",
+                "    for key, val in into.items():",
+                "        im[key] = 2*val - (val**2 * (-2*val + 3))"], "dict"
+
+    def batch(self, batch, ins, active):
+        agents, codes, v = gather(ins, active)
+        first, group = groups(batch, agents, codes)
+        v = lastValues(v, group, len(first))
+        return ImpulseTable.keyed(batch, active, agents[first], codes[first],
+                                  2*v - (power(v, 2) * (-2*v + 3)))
+
 
 class LogicQUERYTAG(Neuron):
     """Return the value of Tag (normally 1) or else 0"""
+    sideEffects = False
 
-    def core(self, inps, settings):
+    def core(self, brain, inps, settings):
         results = {}
-        if settings["Tag"] in self.brain.tags:
-            return self.brain.tags[settings["Tag"]]
+        if settings["Tag"] in brain.tags:
+            return brain.tags[settings["Tag"]]
         else:
             return 0
 
+    def emit(self, settings):
+        tag = repr(settings["Tag"])
+        return ["im = brain.tags.get({}, 0)".format(tag)], "any"
+
+    def batch(self, batch, ins, active):
+        tag = self.settings["Tag"]
+        values = [b.tags.get(tag, 0) if a else 0
+                  for b, a in zip(batch.brains, active)]
+        if any(not isinstance(v, (int, float)) for v in values):
+            return None
+        return ImpulseTable.scalar(batch, values, active)
+
 
 class LogicSETTAG(Neuron):
     """If any of the inputs are above the Threshold level add or remove the
     Tag from the agents tags"""
 
-    def core(self, inps, settings):
+    def core(self, brain, inps, settings):
         condition = False
         total = 0
         count = 0
         for into in inps:
-            for i in into:
-                if i.val > settings["Threshold"]:
+            for val in into.values():
+                if val > settings["Threshold"]:
                     condition = True
-                total += i.val
+                total += val
                 count += 1
         if settings["UseThreshold"]:
             if condition:
                 if settings["Action"] == "ADD":
-                    self.brain.tags[settings["Tag"]] = 1
+                    brain.setTag(settings["Tag"], 1)
                 else:
-                    if settings["Tag"] in self.brain.tags:
-                        del self.brain.tags[settings["Tag"]]
+                    brain.removeTag(settings["Tag"])
         else:
             if settings["Action"] == "ADD":
-                self.brain.tags[settings["Tag"]] = total
+                brain.setTag(settings["Tag"], total)
             else:
-                if settings["Tag"] in self.brain.tags:
-                    del self.brain.tags[settings["Tag"]]
+                brain.removeTag(settings["Tag"])
         return settings["Threshold"]
 
+    def emit(self, settings):
+        tag = repr(settings["Tag"])
+        threshold = settings["Threshold"]
+        if settings["Action"] == "ADD":
+            change = "brain.setTag({}, {})"
+        else:
+            change = "brain.removeTag({})"
+        if settings["UseThreshold"]:
+            lines = ["for into in inps:",
+                     "    if any(v > {!r} for v in into.values()):"
+                     .format(threshold),
+                     "        " + change.format(tag, 1),
+                     "        break"]
+        elif settings["Action"] == "ADD":
+            lines = ["total = 0",
+                     "for into in inps:",
+                     "    for v in into.values():",
+                     "        total += v",
+                     change.format(tag, "total")]
+        else:
+            lines = [change.format(tag)]
+        lines += ["im = {!r}".format(threshold)]
+        return lines, "number"
+
+    def batch(self, batch, ins, active):
+        settings = self.settings
+        tag = settings["Tag"]
+        add = settings["Action"] == "ADD"
+        agents, codes, v = gather(ins, active)
+        if settings["UseThreshold"]:
+            over = agents[v > settings["Threshold"]]
+            change = perAgentCount(batch, over) > 0
+            total = None
+        else:
+            change = active
+            total = perAgentSum(batch, agents, v)
+        for a in numpy.flatnonzero(change):
+            if not add:
+                batch.brains[a].removeTag(tag)
+            elif total is None:
+                batch.brains[a].setTag(tag, 1)
+            else:
+                batch.brains[a].setTag(tag, total[a].item())
+        return ImpulseTable.scalar(batch, settings["Threshold"], active)
+
 
 class LogicVARIABLE(Neuron):
     """Set or retrieve (or both) an agent variable (0 if it doesn't exist)"""
 
-    def core(self, inps, settings):
+    def core(self, brain, inps, settings):
         count = 0
         for into in inps:
-            for i in into:
-                self.brain.agvars[settings["Variable"]] += i.val
+            for val in into.values():
+                brain.agvars[settings["Variable"]] += val
                 count += 1
         if count:
-            self.brain.agvars[settings["Variable"]] /= count
-        if settings["Variable"] in self.brain.agvars:
-            out = self.brain.agvars[settings["Variable"]]
+            brain.agvars[settings["Variable"]] /= count
+        if settings["Variable"] in brain.agvars:
+            out = brain.agvars[settings["Variable"]]
         else:
             out = 0
         # TODO Doesn't work
-        return self.brain.agvars[settings["Variable"]]
+        return brain.agvars[settings["Variable"]]
 
 
 class LogicMAP(Neuron):
     """Map the input from the input range to the output range
     (extrapolates outside of input range)"""
+    sideEffects = False
+    pure = True
 
-    def core(self, inps, settings):
+    def core(self, brain, inps, settings):
         result = {}
         if settings["LowerInput"] != settings["UpperInput"]:
             for into in inps:
-                for i in into:
-                    num = i.val
+                for key, num in into.items():
                     li = settings["LowerInput"]
                     ui = settings["UpperInput"]
                     lo = settings["LowerOutput"]
                     uo = settings["UpperOutput"]
-                    result[i.key] = ((uo - lo) / (ui - li)) * (num - li) + lo
+                    result[key] = ((uo - lo) / (ui - li)) * (num - li) + lo
         return result
 
+    def emit(self, settings):
+        li = settings["LowerInput"]
+        ui = settings["UpperInput"]
+        lo = settings["LowerOutput"]
+        uo = settings["UpperOutput"]
+        if li == ui:
+            return ["im = {}"], "dict"
+        return ["im = {}",
+                "for into in inps:",
+                "    for key, val in into.items():",
+                "        im[key] = {!r} * (val - {!r}) + {!r}".format(
+                    (uo - lo) / (ui - li), li, lo)], "dict"
+
+    def batch(self, batch, ins, active):
+        li = self.settings["LowerInput"]
+        ui = self.settings["UpperInput"]
+        lo = self.settings["LowerOutput"]
+        uo = self.settings["UpperOutput"]
+        agents, codes, v = gather(ins, active)
+        if li == ui:
+            empty = agents[:0]
+            return ImpulseTable.keyed(batch, active, empty, empty, v[:0])
+        first, group = groups(batch, agents, codes)
+        v = lastValues(v, group, len(first))
+        return ImpulseTable.keyed(batch, active, agents[first], codes[first],
+                                  ((uo - lo) / (ui - li)) * (v - li) + lo)
+
 
 class LogicOUTPUT(Neuron):
     """Sets an agents output. (Has to be picked up in iai_agents.Agents)"""
 
-    def core(self, inps, settings):
+    def core(self, brain, inps, settings):
         val = 0
         if settings["MultiInputType"] == "AVERAGE":
             count = 0
             for into in inps:
-                for i in into:
-                    val += i.val
+                for v in into.values():
+                    val += v
                     count += 1
             out = val/(max(1, count))
         elif settings["MultiInputType"] == "MAX":
             out = 0
             for into in inps:
-                for i in into:
-                    if abs(i.val) > abs(out):
-                        out = i.val
+                for v in into.values():
+                    if abs(v) > abs(out):
+                        out = v
         elif settings["MultiInputType"] == "SIZEAVERAGE":
             """Takes a weighed average of the inputs where smaller values have
             less of an impact on the final result"""
             Sm = 0
             SmSquared = 0
             for into in inps:
-                for i in into:
-                    print("Val:", i.val)
-                    Sm += i.val
-                    SmSquared += i.val * abs(i.val)  # To retain sign
+                for v in into.values():
+                    print("Val:", v)
+                    Sm += v
+                    SmSquared += v * abs(v)  # To retain sign
             print(Sm, SmSquared)
             if Sm == 0:
                 out = 0
             else:
                 out = SmSquared / Sm
             print("out", out)
-        self.brain.outvars[settings["Output"]] = out
+        brain.outvars[settings["Output"]] = out
         return out
 
+    def emit(self, settings):
+        if settings["MultiInputType"] == "AVERAGE":
+            lines = ["val = 0",
+                     "count = 0",
+                     "for into in inps:",
+                     "    for v in into.values():",
+                     "        val += v",
+                     "        count += 1",
+                     "im = val/(max(1, count))"]
+        elif settings["MultiInputType"] == "MAX":
+            lines = ["im = 0",
+                     "for into in inps:",
+                     "    for v in into.values():",
+                     "        if abs(v) > abs(im):",
+                     "            im = v"]
+        else:
+            # SIZEAVERAGE prints for debugging so leave it to core
+            return None
+        lines += ["brain.outvars[{!r}] = im".format(settings["Output"])]
+        return lines, "number"
+
+    def batch(self, batch, ins, active):
+        settings = self.settings
+        agents, codes, v = gather(ins, active)
+        if settings["MultiInputType"] == "AVERAGE":
+            out = perAgentSum(batch, agents, v) / \
+                numpy.maximum(1, perAgentCount(batch, agents))
+        elif settings["MultiInputType"] == "MAX":
+            # The first value with the largest size
+            size = numpy.abs(v)
+            largest = numpy.zeros(batch.n)
+            numpy.maximum.at(largest, agents, size)
+            found = numpy.flatnonzero((size == largest[agents]) & (size > 0))
+            withLargest, firsts = numpy.unique(agents[found],
+                                               return_index=True)
+            out = numpy.zeros(batch.n)
+            out[withLargest] = v[found[firsts]]
+        else:
+            return None
+        output = settings["Output"]
+        for a in numpy.flatnonzero(active):
+            batch.brains[a].outvars[output] = out[a].item()
+        return ImpulseTable.scalar(batch, out, active)
+
 
 class LogicPRIORITY(Neuron):
     """Combine inputs by priority"""
+    sideEffects = False
+    pure = True
 
-    def core(self, inps, settings):
+    def core(self, brain, inps, settings):
         result = {}
         remaining = {}
         for v in range((len(inps)+1)//2):
             into = inps[2*v]
             # print("into", into)
             if 2*v+1 < len(inps):
-                priority = inps[2*v+1]
+                priority = inps[2*v+1].cont
                 usesPriority = True
             else:
-                priority = []
+                priority = {}
                 usesPriority = False
             # print("priority", priority)
-            for i in into:
-                if i.key in priority:
-                    # TODO what if priority[i.key] < 0?
-                    if i.key in result:
-                        contribution = priority[i.key].val * remaining[i.key]
-                        result[i.key] += i.val * contribution
-                        remaining[i.key] -= contribution
+            for key, val in into.items():
+                if key in priority:
+                    # TODO what if priority[key] < 0?
+                    if key in result:
+                        contribution = priority[key] * remaining[key]
+                        result[key] += val * contribution
+                        remaining[key] -= contribution
                     else:
-                        result[i.key] = i.val * priority[i.key].val
-                        remaining[i.key] = 1 - priority[i.key].val
+                        result[key] = val * priority[key]
+                        remaining[key] = 1 - priority[key]
                 elif not usesPriority:
-                    if i.key in result:
-                        contribution = remaining[i.key]
-                        result[i.key] += i.val * contribution
-                        remaining[i.key] -= 0
+                    if key in result:
+                        contribution = remaining[key]
+                        result[key] += val * contribution
+                        remaining[key] -= 0
                     else:
-                        result[i.key] = i.val
-                        remaining[i.key] = 0
+                        result[key] = val
+                        remaining[key] = 0
             #print("resultPartial", result)
         for key, rem in remaining.items():
             if rem != 0:
                 result[key] += settings["defaultValue"] * rem
         return result
 
+    def batch(self, batch, ins, active):
+        """Which inputs are paired with which depends on which of them are
+        None so the agents are split up by that first"""
+        parts = []
+        if ins:
+            noneInputs = numpy.array([t.isNone for t in ins]).T
+            patterns, which = numpy.unique(noneInputs[active], axis=0,
+                                           return_inverse=True)
+            rows = numpy.flatnonzero(active)
+            for p, pattern in enumerate(patterns):
+                mask = numpy.zeros(batch.n, dtype=bool)
+                mask[rows[which.ravel() == p]] = True
+                present = [t for t, isNone in zip(ins, pattern) if not isNone]
+                if present:
+                    parts.append(self.batchPart(batch, present, mask))
+        if not parts:
+            empty = numpy.zeros(0, dtype=numpy.int64)
+            return ImpulseTable.keyed(batch, active, empty, empty,
+                                      numpy.zeros(0))
+        agents, codes, values = (numpy.concatenate(x) for x in zip(*parts))
+        order = numpy.argsort(agents, kind="stable")
+        return ImpulseTable.keyed(batch, active, agents[order], codes[order],
+                                  values[order])
+
+    def batchPart(self, batch, inps, active):
+        """core for the agents in active which all have inps as their inputs
+
+        :returns: agents, codes, values"""
+        kept = []
+        for v in range((len(inps)+1)//2):
+            agents, codes, vals = gather([inps[2*v]], active)
+            if 2*v+1 < len(inps):
+                found, prio = lookup(agents, codes, inps[2*v+1])
+                agents = agents[found]
+                codes = codes[found]
+                vals = vals[found]
+            else:
+                prio = None
+            kept.append((agents, codes, vals, prio))
+        agents = numpy.concatenate([k[0] for k in kept])
+        codes = numpy.concatenate([k[1] for k in kept])
+        pair = numpy.concatenate([numpy.full(len(k[0]), v)
+                                  for v, k in enumerate(kept)])
+        # Sort by agent keeping the order the keys are added to result in
+        order = numpy.argsort(agents, kind="stable")
+        first, group = groups(batch, agents[order], codes[order])
+        group = group[numpy.argsort(order)]
+
+        result = numpy.zeros(len(first))
+        remaining = numpy.zeros(len(first))
+        seen = numpy.zeros(len(first), dtype=bool)
+        for v, (ag, co, vals, prio) in enumerate(kept):
+            g = group[pair == v]
+            new = ~seen[g]
+            old = ~new
+            if prio is not None:
+                result[g[new]] = vals[new] * prio[new]
+                remaining[g[new]] = 1 - prio[new]
+                contribution = prio[old] * remaining[g[old]]
+                result[g[old]] += vals[old] * contribution
+                remaining[g[old]] -= contribution
+            else:
+                result[g[new]] = vals[new]
+                remaining[g[new]] = 0
+                result[g[old]] += vals[old] * remaining[g[old]]
+            seen[g] = True
+        rem = remaining != 0
+        result[rem] += self.settings["defaultValue"] * remaining[rem]
+        first = order[first]
+        return agents[first], codes[first], result
+
 
 class LogicEVENT(Neuron):
     """Check if an event is happening that frame"""
+    sideEffects = False
 
-    def core(self, inps, settings):
-        events = bpy.context.scene.iai_events.coll
+    def core(self, brain, inps, settings):
+        scene = brain.sim.scene
         en = settings["EventName"]
-        for e in events:
+        for e in scene.getEvents():
             if e.eventname == en:
                 result = 1
                 if e.category == "Time" or e.category == "Time+Volume":
-                    if e.time != bpy.context.scene.frame_current:
+                    if e.time != scene.frameCurrent:
                         result = 0
                 if e.category == "Volume" or e.category == "Time+Volume":
                     if result:
-                        pt = bpy.data.objects[self.brain.userid].location
-                        l = bpy.data.objects[e.volume].location
-                        d = bpy.data.objects[e.volume].dimensions
+                        pt = scene.getLocation(brain.userid)
+                        l = scene.getLocation(e.volume)
+                        d = scene.getDimensions(e.volume)
 
-                        if not (l.x-(d.x/2) <= pt.x <= l.x+(d.x/2) and
-                                l.y-(d.y/2) <= pt.y <= l.y+(d.y/2) and
-                                l.z-(d.z/2) <= pt.z <= l.z+(d.z/2)):
+                        if not (l[0]-(d[0]/2) <= pt[0] <= l[0]+(d[0]/2) and
+                                l[1]-(d[1]/2) <= pt[1] <= l[1]+(d[1]/2) and
+                                l[2]-(d[2]/2) <= pt[2] <= l[2]+(d[2]/2)):
                             result = 0
                 if result:
                     return result
@@ -343,31 +901,62 @@ class LogicEVENT(Neuron):
 
 
 class LogicPYTHON(Neuron):
-    """execute a python expression"""
-
-    def core(self, inps, settings):
-        global Inter
-        setup = copy.copy(self.brain.lvars)
-        setup["inps"] = inps
-        setup["settings"] = settings
-        Inter.setup(setup)
-        Inter.enter(settings["Expression"]["value"])
-        result = Inter.getoutput()
-        return result
-
-
-Inter = Interpreter()
+    """execute a python expression
+
+    The script has to set output. If the Vectorized setting is on it is run
+    once for all the agents in a batch (see iai_brainBatch) with agents (the
+    agent ids) and inps (the inps of each agent) and has to set output to a
+    list with the output of each agent"""
+
+    def __init__(self, compiled, bpyNode, name):
+        Neuron.__init__(self, compiled, bpyNode, name)
+        self.script = None  # type: Script
+        self.vectorized = False
+
+    def setup(self):
+        expression = self.settings["Expression"]
+        if isinstance(expression, dict):
+            expression = expression["value"]
+        self.vectorized = bool(self.settings.get("Vectorized", False))
+        self.script = Script(expression, self.name, self.compiled.sim.lvars)
+
+    def hasBatch(self):
+        return self.vectorized
+
+    def core(self, brain, inps, settings):
+        if self.vectorized:
+            outputs = self.script.run({"agents": [brain.userid],
+                                       "inps": [inps],
+                                       "settings": settings})
+            return None if outputs is None else outputs[0]
+        return self.script.run({"inps": inps, "settings": settings})
+
+    def batch(self, batch, ins, active):
+        agents = []
+        inps = []
+        for a in numpy.flatnonzero(active):
+            agents.append(batch.brains[a].userid)
+            inps.append([t.agentImpulses(a) for t in ins if not t.isNone[a]])
+        outputs = self.script.run({"agents": agents, "inps": inps,
+                                   "settings": self.settings})
+        if outputs is None:
+            outputs = [None] * len(agents)
+        results = [None] * batch.n
+        for a, output in zip(numpy.flatnonzero(active), outputs):
+            results[a] = wrapOutput(output)
+        return ImpulseTable.fromOutputs(batch, results)
 
 
 class LogicPRINT(Neuron):
     """print everything that is given to it"""
+    # Only kept when nothing uses the output if debugging
+    sideEffects = debugMode
 
-    def core(self, inps, settings):
-        selected = [o.name for o in bpy.context.selected_objects]
-        if self.brain.userid in selected:
+    def core(self, brain, inps, settings):
+        if brain.sim.scene.isSelected(brain.userid):
             for into in inps:
-                for i in into:
-                    print(settings["Label"], ">>", i.key, i.val)
+                for key, val in into.items():
+                    print(settings["Label"], ">>", key, val)
         return 0
 
 
@@ -398,24 +987,56 @@ class StateSTART(State):
     """Points to the first state for the agent to be in"""
 
 
-class StateAction(State):
-    """The normal state in a state machine"""
-    def moveTo(self):
-        State.moveTo(self)
+class MotionDeltas:
+    """How much an action moves and rotates the agent on each frame. Made
+    once for each action by Simulation.actions"""
+    outvars = {"location": ("px", "py", "pz"),
+               "rotation_euler": ("rx", "ry", "rz")}
 
-        act = self.actionName
-        if act in self.brain.sim.actions:
-            actionobj = self.brain.sim.actions[act]  # from .iai_motion.py
-            obj = bpy.context.scene.objects[self.brain.userid]  # bpy object
+    def __init__(self, action):
+        self.keys = ()  # The outvars that the action changes
+        columns = []
+        for data_path, data in action.motiondata.items():
+            if data_path in self.outvars:
+                self.keys += self.outvars[data_path][:len(data)]
+                for axis in data[:3]:
+                    columns.append(numpy.diff(numpy.asarray(axis,
+                                                            dtype=float)))
+        # frames[f] is the change from frame f - 1 to frame f
+        self.frames = [None] + list(zip(*(c.tolist() for c in columns)))
 
-            tr = obj.animation_data.nla_tracks.new()  # NLA track
-            action = actionobj.action  # bpy action
-            if action:
-                currentFrame = bpy.context.scene.frame_current
-                strip = tr.strips.new("", currentFrame, action)
-                strip.extrapolation = 'NOTHING'
-                strip.use_auto_blend = True
-            self.length = actionobj.length
+    def apply(self, brain, frame):
+        """Add the change on frame to the outvars of brain"""
+        outvars = brain.outvars
+        for key, delta in zip(self.keys, self.frames[frame]):
+            outvars[key] += delta
+
+
+class StateAction(State):
+    """The normal state in a state machine"""
+    def __init__(self, compiled, bpyNode, name):
+        State.__init__(self, compiled, bpyNode, name)
+        self.actionName = None
+        # set by setup
+        self.action = None  # from .iai_motion.py
+        self.motion = None  # type: MotionDeltas
+
+    def setup(self):
+        State.setup(self)
+        sim = self.compiled.sim
+        self.action = sim.actions.get(self.actionName)
+        self.motion = sim.motionDeltas.get(self.actionName)
+        if self.motion is not None and not self.motion.keys:
+            self.motion = None
+
+    def moveTo(self, brain):
+        State.moveTo(self, brain)
+
+        if self.action is not None:
+            actionobj = self.action
+            scene = brain.sim.scene
+            scene.playAction(brain.userid, actionobj, scene.frameCurrent)
+            brain.stateLength[self.name] = actionobj.length
 
             """tr = obj.animation_data.nla_tracks.new()  # NLA track
             action = actionobj.motion
@@ -425,65 +1046,32 @@ class StateAction(State):
                 strip.use_auto_blend = False
                 strip.blend_type = 'ADD'"""
 
-    def evaluateState(self):
-        self.currentFrame += 1
+    def evaluateState(self, brain):
+        brain.stateFrame[self.name] += 1
+        stateFrame = brain.stateFrame[self.name]
+        length = brain.stateLength[self.name]
 
         """Check to see if the current state is still playing an animation"""
-        # print("currentFrame", self.currentFrame, "length", self.length)
-        # print("Value compared", self.length - 2 - self.settings["Fade out"])
+        # print("currentFrame", stateFrame, "length", length)
+        # print("Value compared", length - 2 - self.settings["Fade out"])
 
         # The proportion of the way through the state
-        if self.length == 0:
+        if length == 0:
             complete = 1
         else:
-            complete = self.currentFrame/self.length
+            complete = stateFrame/length
             complete = 0.5 + complete/2
-        currentFrame = bpy.context.scene.frame_current
-        self.resultLog[currentFrame] = ((0.15, 0.4, complete))
-
-        if self.actionName in self.brain.sim.actions:
-            actionobj = self.brain.sim.actions[self.actionName]
-
-            for data_path, data in actionobj.motiondata.items():
-                x = data[0][self.currentFrame] - data[0][self.currentFrame - 1]
-                y = data[1][self.currentFrame] - data[1][self.currentFrame - 1]
-                z = data[2][self.currentFrame] - data[2][self.currentFrame - 1]
-                if data_path == "location":
-                    self.brain.outvars["px"] += x
-                    self.brain.outvars["py"] += y
-                    self.brain.outvars["pz"] += z
-                elif data_path == "rotation_euler":
-                    self.brain.outvars["rx"] += x
-                    self.brain.outvars["ry"] += y
-                    self.brain.outvars["rz"] += z
-
-        if self.currentFrame < self.length - 1:
+        brain.recordHighlight(self.name, complete)
+
+        if self.motion is not None:
+            self.motion.apply(brain, stateFrame)
+
+        if stateFrame < length - 1:
             return False, self.name
 
         # ==== Will stop here is this state hasn't reached its end ====
 
-        options = []
-        for con in self.outputs:
-            val = self.neurons[con].query()
-            # print(con, val)
-            if val is not None:
-                options.append((con, val))
-
-        # If the cycleState button is checked then add a contection back to
-        #    this state again.
-        if self.cycleState and self.name not in self.outputs:
-            val = self.neurons[self.name].query()
-            # print(con, val)
-            if val is not None:
-                options.append((self.name, val))
-
-        if len(options) > 0:
-            if len(options) == 1:
-                return True, options[0][0]
-            else:
-                return True, max(options, key=lambda v: v[1])[0]
-
-        return False, None
+        return self.nextState(brain)
 
 statetypes = OrderedDict([
     ("StartState", StateSTART),
@@ -0,0 +1,300 @@
+"""Evaluate the brains of the agents in several processes at once.
+
+Each worker process builds its own copy of the simulation from a scene
+description (see iai_sceneAdapter) but only steps the agents in its
+partition. Every frame the main process writes last frame's AgentStateTable
+into shared memory. The workers read it, step their agents and send back the
+brain outputs, tag changes and actions played. The main process then
+integrates and applies them in the same way as Simulation.step does when
+running in a single process.
+
+Things that depend on the order the agents are evaluated in (tag changes and
+the channels' frameState) are merged in agent order and sent to every worker
+at the start of the next frame so the results are the same as serial mode.
+"""
+
+import multiprocessing
+import traceback
+
+import numpy
+
+from .iai_sceneAdapter import MemorySceneAdapter
+from . import iai_checkpoint
+
+# The fields of AgentStateTable that are copied to the workers each frame
+SNAPSHOT_FIELDS = ("position", "rotation", "speed", "rotationSpeed",
+                   "globalVelocity")
+
+
+def snapshotArray(raw, count):
+    """numpy view of the shared memory. Shape (fields, agents, 3)"""
+    return numpy.frombuffer(raw, dtype=float).reshape(len(SNAPSHOT_FIELDS),
+                                                      count, 3)
+
+
+def getContext():
+    """Forking is much quicker to start than spawning where it is
+    available"""
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+class Worker:
+    """The part of the simulation that runs in each worker process"""
+    def __init__(self, description, checkpoint, rows, raw, options):
+        """:param checkpoint: the state of the main simulation (see
+        iai_checkpoint.dumps)
+        :param options: keyword arguments for Simulation"""
+        from .iai_simulate import Simulation
+        self.scene = MemorySceneAdapter(description)
+        self.sim = Simulation(self.scene, **options)
+        self.sim.actions()
+        self.sim.createAgents(self.scene.getAgents())
+        iai_checkpoint.loads(self.sim, checkpoint)
+        self.agents = list(self.sim.agents.values())
+        self.own = [self.agents[r] for r in rows]
+        self.rows = rows
+        self.snapshot = snapshotArray(raw, len(self.agents))
+        self.strips = {ag.id: 0 for ag in self.own}
+        # If the end of the last frame has been dealt with (see finishFrame)
+        self.finished = True
+
+    def finishFrame(self, tagChanges, channelStates):
+        """Do what Simulation.step does after the agents are evaluated for
+        last frame with the tag changes and channel frameStates of every
+        worker"""
+        if self.finished:
+            return
+        sim = self.sim
+        for ag in self.agents:
+            if ag.id in tagChanges:
+                ag.brain.tagChanges = tagChanges[ag.id]
+                ag.swapBuffers()
+        for name, chan in sim.lvars.items():
+            chan.mergeFrameStates(channelStates.get(name, []))
+            chan.newframe()
+        self.finished = True
+
+    def checkpointMeta(self, tagChanges, channelStates):
+        """See iai_checkpoint.dumpMeta. Only the brains of this workers
+        agents are included"""
+        self.finishFrame(tagChanges, channelStates)
+        return iai_checkpoint.dumpMeta(self.sim, self.own)
+
+    def step(self, frame, tagChanges, channelStates, profile, highlight):
+        """:param highlight: None or (frames, active agent, selected agents)
+            from the main process (see Simulation.enableHighlights)"""
+        sim = self.sim
+        state = sim.state
+        if highlight is None:
+            sim.highlightFrames = None
+        else:
+            sim.highlightFrames, active, selected = highlight
+            self.scene.activeName = active
+            for ag in self.agents:
+                self.scene.objects[ag.id].select = ag.id in selected
+        if not profile:
+            sim.disableProfiler()
+        elif sim.profiler is None:
+            sim.enableProfiler()
+        prof = sim.profiler
+        if prof is not None:
+            prof.beginFrame(frame)
+
+        self.finishFrame(tagChanges, channelStates)
+
+        n = len(self.agents)
+        for f, data in zip(SNAPSHOT_FIELDS, self.snapshot):
+            getattr(state, f)[:n] = data
+        for ag in self.agents:
+            self.scene.setPose(ag.id, state.position[ag.index],
+                               state.rotation[ag.index])
+        sim.orientations.clear()
+
+        self.scene.advanceFrame(frame)
+        sim.framelast = frame
+        if prof is not None:
+            t = prof.now()
+        sim.stepAgents(self.own)
+        self.finished = False
+        if prof is not None:
+            # The main process records the time for "brains"
+            prof.add("workerBrains", t)
+
+        """The main process needs what the nodes of the selected agents did
+        to highlight them in the node editor"""
+        highlights = {}
+        for ag in self.own:
+            if ag.brain.capturing:
+                values = ag.brain.highlights.frameValues(frame)
+                if values is not None:
+                    highlights[ag.id] = values
+
+        played = []
+        for ag in self.own:
+            strips = self.scene.strips[ag.id]
+            played += [(ag.id, f, act) for f, act in
+                       strips[self.strips[ag.id]:]]
+            self.strips[ag.id] = len(strips)
+
+        return (state.turn[self.rows].copy(), state.move[self.rows].copy(),
+                {ag.id: ag.brain.tagChanges for ag in self.own
+                 if ag.brain.tagChanges},
+                played, highlights,
+                {name: chan.frameState() for name, chan in sim.lvars.items()},
+                self.profileRecord())
+
+    def profileRecord(self):
+        """This frames record from the profiler to be merged into the main
+        process' profiler"""
+        prof = self.sim.profiler
+        if prof is None:
+            return None
+        prof.endFrame()
+        return prof.frames.pop()
+
+
+def workerMain(conn, description, checkpoint, rows, raw, options):
+    """The loop run by each worker process"""
+    try:
+        worker = Worker(description, checkpoint, rows, raw, options)
+        conn.send(("ready", None))
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+        return
+    while True:
+        message = conn.recv()
+        if message[0] == "stop":
+            break
+        try:
+            func = getattr(worker, message[0])
+            conn.send(("done", func(*message[1:])))
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+
+
+class ParallelStepper:
+    """Used by Simulation.step instead of calling agent.step for every agent
+    when the simulation is running in parallel mode"""
+    def __init__(self, sim, workers=None):
+        """:param workers: number of processes. Defaults to the cpu count"""
+        self.sim = sim
+        agents = list(sim.agents.values())
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = max(1, min(workers, len(agents)))
+
+        ctx = getContext()
+        self.raw = ctx.RawArray("d", len(SNAPSHOT_FIELDS) * len(agents) * 3)
+        self.snapshot = snapshotArray(self.raw, len(agents))
+
+        description = sim.scene.describeScene()
+        checkpoint = iai_checkpoint.dumps(sim)
+        options = {"codegen": sim.codegen, "batch": sim.batch,
+                   "optimise": sim.optimise}
+        # Contiguous partitions so that concatenating the results of the
+        #  workers gives them in agent order
+        self.partitions = [[int(r) for r in p] for p in
+                           numpy.array_split(numpy.arange(len(agents)),
+                                             workers)]
+        self.conns = []
+        self.processes = []
+        for rows in self.partitions:
+            parent, child = ctx.Pipe()
+            p = ctx.Process(target=workerMain,
+                            args=(child, description, checkpoint, rows,
+                                  self.raw, options),
+                            daemon=True)
+            p.start()
+            self.conns.append(parent)
+            self.processes.append(p)
+        for conn in self.conns:
+            self.receive(conn)
+
+        self.tagChanges = {}
+        self.channelStates = {}
+
+    def receive(self, conn):
+        status, result = conn.recv()
+        if status == "error":
+            self.stop()
+            raise RuntimeError("Parallel worker failed:\n" + result)
+        return result
+
+    def step(self):
+        """Evaluate every agent for the current frame. Leaves sim.state.turn
+        and sim.state.move set and the tag changes in the brains ready for
+        sim.state.integrate and agent.apply"""
+        sim = self.sim
+        state = sim.state
+        n = len(self.snapshot[0])
+        for f, data in zip(SNAPSHOT_FIELDS, self.snapshot):
+            data[:] = getattr(state, f)[:n]
+
+        frame = sim.scene.frameCurrent
+        highlight = None
+        if sim.highlightFrames is not None:
+            scene = sim.scene
+            highlight = (sim.highlightFrames, scene.getActiveName(),
+                         {a for a in sim.agents if scene.isSelected(a)})
+        for conn in self.conns:
+            conn.send(("step", frame, self.tagChanges, self.channelStates,
+                       sim.profiler is not None, highlight))
+
+        self.tagChanges = {}
+        self.channelStates = {}
+        for rows, conn in zip(self.partitions, self.conns):
+            (turn, move, tagChanges, played, highlights, frameStates,
+             record) = self.receive(conn)
+            if record is not None and sim.profiler is not None:
+                sim.profiler.merge(record)
+            state.turn[rows] = turn
+            state.move[rows] = move
+            self.tagChanges.update(tagChanges)
+            for agentid, f, act in played:
+                sim.scene.playAction(agentid, sim.actions[act], f)
+            for agentid, values in highlights.items():
+                log = sim.agents[agentid].brain.highlightLog()
+                log.setFrameValues(frame, values)
+            for name, frameState in frameStates.items():
+                if frameState is not None:
+                    self.channelStates.setdefault(name, []).append(frameState)
+
+        for agentid, changes in self.tagChanges.items():
+            brain = sim.agents[agentid].brain
+            for tag, value in changes.items():
+                if value is None:
+                    brain.removeTag(tag)
+                else:
+                    brain.setTag(tag, value)
+
+        active = sim.agents.get(sim.scene.getActiveName())
+        if active is not None and sim.highlightFrames is not None:
+            active.highLight()
+
+    def checkpointMeta(self):
+        """iai_checkpoint.dumpMeta with the brains from all the workers"""
+        for conn in self.conns:
+            conn.send(("checkpointMeta", self.tagChanges, self.channelStates))
+        self.tagChanges = {}
+        self.channelStates = {}
+        metas = [self.receive(conn) for conn in self.conns]
+        meta = metas[0]
+        for m in metas[1:]:
+            meta["brains"].update(m["brains"])
+        return meta
+
+    def stop(self):
+        """Shut down the worker processes"""
+        for conn in self.conns:
+            try:
+                conn.send(("stop",))
+            except (BrokenPipeError, OSError):
+                pass
+        for p in self.processes:
+            p.join(5)
+            if p.is_alive():
+                p.terminate()
+        self.conns = []
+        self.processes = []
@@ -0,0 +1,84 @@
+"""Timing and counting what happens in each frame of the simulation.
+
+Turned on with Simulation.enableProfiler(). When it is off sim.profiler is
+None and everything that would be recorded is skipped with an
+"if prof is not None" check so it costs next to nothing.
+
+Each frame is recorded as a dict of
+    "frame": the frame number
+    "time.<phase>": seconds spent in that phase
+    "count.<name>": number of times something happened
+Phases can be inside other phases. "time.brains" includes "time.states" and
+all of the "time.channel.*" and "time.apply" includes "time.tags". When
+running in parallel (see iai_parallel) the records of the workers are added
+together so "time.channel.*" is the total over all the processes and
+"time.workerBrains" is the time the workers spent evaluating brains.
+"""
+
+import csv
+import json
+import time
+
+
+class Profiler:
+    """Collects a time series with one record for each frame"""
+    def __init__(self):
+        self.frames = []
+        self.current = None
+        self.frameStart = 0
+
+    now = staticmethod(time.perf_counter)
+
+    def beginFrame(self, frame):
+        self.current = {"frame": frame}
+        self.frameStart = self.now()
+
+    def endFrame(self):
+        self.current["time.total"] = self.now() - self.frameStart
+        self.frames.append(self.current)
+        self.current = None
+
+    def add(self, phase, start):
+        """Add the time since start (from self.now()) to phase"""
+        key = "time." + phase
+        self.current[key] = self.current.get(key, 0) + self.now() - start
+
+    def count(self, name, n=1):
+        key = "count." + name
+        self.current[key] = self.current.get(key, 0) + n
+
+    def merge(self, record):
+        """Add a record made in another process (see iai_parallel) to the
+        current frame"""
+        for key, value in record.items():
+            if key not in ("frame", "time.total"):
+                self.current[key] = self.current.get(key, 0) + value
+
+    def columns(self):
+        """All the keys used in any frame in a stable order"""
+        keys = set()
+        for f in self.frames:
+            keys.update(f)
+        keys.discard("frame")
+        return ["frame"] + sorted(keys)
+
+    def summary(self):
+        """{key: total over all frames}"""
+        result = {}
+        for f in self.frames:
+            for key, value in f.items():
+                if key != "frame":
+                    result[key] = result.get(key, 0) + value
+        return result
+
+    def exportJSON(self, path):
+        with open(path, "w") as f:
+            json.dump({"frames": self.frames, "summary": self.summary()}, f,
+                      indent=1)
+
+    def exportCSV(self, path):
+        columns = self.columns()
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, columns, restval=0)
+            writer.writeheader()
+            writer.writerows(self.frames)
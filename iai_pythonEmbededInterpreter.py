@@ -1,4 +1,5 @@
 import code
+import traceback
 
 
 class Interpreter(code.InteractiveConsole):
@@ -28,3 +29,41 @@ class Interpreter(code.InteractiveConsole):
             return self.locals["output"]
         else:
             print("Script must have out output")
+
+
+class Script:
+    """The script of one Python node. It is compiled once and run with the
+    same namespace every time instead of going through an Interpreter"""
+    def __init__(self, codesource, name, localvars):
+        """:param name: used in tracebacks
+        :param localvars: pre-declared variables such as the channels"""
+        self.base = {'__name__': '__console__', '__doc__': None}
+        self.base.update(localvars)
+        self.namespace = dict(self.base)
+        try:
+            self.code = compile(Interpreter.preprocess(codesource),
+                                "<Python node {}>".format(name), "exec")
+        except SyntaxError:
+            traceback.print_exc()
+            self.code = None
+
+    def run(self, variables):
+        """Run the script with variables added and return its output"""
+        if self.code is None:
+            print("Script must have out output")
+            return None
+        namespace = self.namespace
+        namespace.update(variables)
+        try:
+            exec(self.code, namespace)
+        except SystemExit:
+            raise
+        except Exception:
+            traceback.print_exc()
+        output = namespace.get("output")
+        if "output" not in namespace:
+            print("Script must have out output")
+        # Nothing the script sets is kept for next time
+        namespace.clear()
+        namespace.update(self.base)
+        return output
@@ -0,0 +1,97 @@
+"""Counter based random numbers.
+
+Every random number is worked out from (agent index, frame, stream, counter)
+so there is no generator state to seed or save. The same agent gets the same
+numbers on the same frame whatever order the agents are evaluated in and in
+whichever process (see iai_parallel).
+"""
+
+import zlib
+
+import numpy
+
+MASK = 0xFFFFFFFFFFFFFFFF
+GOLDEN = 0x9E3779B97F4A7C15
+MIX1 = 0xBF58476D1CE4E5B9
+MIX2 = 0x94D049BB133111EB
+
+
+def streamId(name):
+    """A number for a named stream that is the same in every process (unlike
+    hash(name))"""
+    return zlib.crc32(name.encode())
+
+
+def mix(z):
+    """The splitmix64 finaliser"""
+    z = ((z ^ (z >> 30)) * MIX1) & MASK
+    z = ((z ^ (z >> 27)) * MIX2) & MASK
+    return z ^ (z >> 31)
+
+
+def mixArray(z):
+    """mix for numpy uint64 arrays"""
+    z = (z ^ (z >> numpy.uint64(30))) * numpy.uint64(MIX1)
+    z = (z ^ (z >> numpy.uint64(27))) * numpy.uint64(MIX2)
+    return z ^ (z >> numpy.uint64(31))
+
+
+class RandomStreams:
+    """The random number service of a simulation (sim.rng)"""
+    def __init__(self, seed=0):
+        self.seed = seed & MASK
+
+    def key(self, *parts):
+        x = self.seed
+        for p in parts:
+            x = mix((x + GOLDEN + (p & MASK)) & MASK)
+        return x
+
+    def random(self, agent, frame, stream, counter=0):
+        """A float in the range 0-1
+
+        :param agent: the row of the agent in sim.state
+        :param stream: see streamId"""
+        return (self.key(agent, frame, stream, counter) >> 11) * 2.0**-53
+
+    def randomArray(self, agents, frame, stream, counter=0):
+        """random for lots of agents at once
+
+        :param agents: array of rows in sim.state. Use
+            numpy.arange(sim.state.count) for every agent
+        :returns: array of floats the same shape as agents (each the same as
+            calling random for that agent)"""
+        agents = numpy.asarray(agents, dtype=numpy.int64).astype(numpy.uint64)
+        golden = numpy.uint64(GOLDEN)
+        x = numpy.full(agents.shape, self.seed, dtype=numpy.uint64)
+        with numpy.errstate(over="ignore"):
+            x = mixArray(x + golden + agents)
+            for p in (frame, stream, counter):
+                x = mixArray(x + golden + numpy.uint64(p & MASK))
+        return (x >> numpy.uint64(11)).astype(float) * 2.0**-53
+
+
+if __name__ == "__main__":
+    import unittest
+
+    class Test(unittest.TestCase):
+        def testArray(self):
+            """randomArray gives the same numbers as random"""
+            for seed in (0, 1, MASK, 2**63 + 12345):
+                rng = RandomStreams(seed)
+                agents = numpy.array([0, 1, 2, 7, 1000, 2**40])
+                for frame, stream, counter in ((0, 0, 0), (5, 3, 1),
+                                               (2**50, streamId("x"), 99)):
+                    expected = [rng.random(a, frame, stream, counter)
+                                for a in agents.tolist()]
+                    self.assertEqual(rng.randomArray(agents, frame, stream,
+                                                     counter).tolist(),
+                                     expected)
+
+        def testRange(self):
+            values = RandomStreams(3).randomArray(numpy.arange(10000), 1, 2)
+            self.assertTrue(((values >= 0) & (values < 1)).all())
+            self.assertTrue(0.45 < values.mean() < 0.55)
+
+    # Run unit test
+    unittest.main()
@@ -0,0 +1,707 @@
+"""The simulation only talks to the scene through a SceneAdapter so that it can
+be run both inside Blender (BlenderSceneAdapter) and without it on a headless
+machine (MemorySceneAdapter).
+
+The serialized scene description that MemorySceneAdapter loads (and that
+BlenderSceneAdapter.describeScene produces) is a json compatible dict:
+
+{"frameStart": int, "frameEnd": int, "active": str | None,
+ "objects": [{"name": str, "location": [x, y, z], "rotation": [x, y, z],
+              "scale": [x, y, z], "dimensions": [x, y, z], "select": bool,
+              "parent": 4x4 [[float, ], ] | None,
+              "vertices": [[x, y, z], ], "polygons": [[int, ], ]}, ],
+ "agents": [{"name": str, "group": int}, ],
+ "groups": [{"name": str, "type": str}, ],
+ "brains": {str: [node description, ], },
+ "actions": [{"name": str, "length": int,
+              "motiondata": {data_path: [[float, ], ] * 3}}, ],
+ "events": [{"eventname": str, "category": str, "time": int,
+             "volume": str}, ]}
+
+Each node description is the output of iai_compileBrain.describeNodeGroup:
+
+{"name": str, "type": bl_idname, "settings": {str: value, },
+ # Logic nodes
+ "inputs": [str, ], "dependantOn": [str, ], "isOutput": bool,
+ # State nodes
+ "outputs": [str, ], "valueInputs": [str, ] (not for StartState),
+ "length": int, "cycleState": bool, "actionName": str}
+"""
+
+import json
+from types import SimpleNamespace
+
+import numpy
+
+from .iai_transforms import toWorld
+
+try:
+    import bpy
+except ImportError:
+    # Running headless. Only MemorySceneAdapter can be used.
+    bpy = None
+
+
+class SceneAdapter:
+    """The parent class for all scene adapters. Everything the simulation
+    needs to read from or write to the scene goes through one of these"""
+    def __init__(self):
+        pass
+
+    @property
+    def frameCurrent(self):
+        """The frame that the scene is currently on"""
+        raise NotImplementedError
+
+    def advanceFrame(self, frame):
+        """Move the scene to frame without calling the frame handlers or
+        updating the view. Used when baking"""
+        raise NotImplementedError
+
+    def describeScene(self):
+        """A description of the scene (see the top of this file) that can be
+        loaded by MemorySceneAdapter"""
+        raise NotImplementedError
+
+    def getFrameRange(self):
+        """(first frame, last frame) of the scene"""
+        raise NotImplementedError
+
+    def addFrameHandler(self, func):
+        """Call func(scene) whenever the scene changes frame"""
+        raise NotImplementedError
+
+    def removeFrameHandler(self, func):
+        raise NotImplementedError
+
+    def hasFrameHandler(self, func):
+        raise NotImplementedError
+
+    def getAgents(self):
+        """All the agent entries. Each has a .name"""
+        raise NotImplementedError
+
+    def getBrainType(self, agentName):
+        """The name of the brain used by this agent"""
+        raise NotImplementedError
+
+    def getBrainGraph(self, brainType):
+        """The node descriptions for brainType or None if it doesn't exist"""
+        raise NotImplementedError
+
+    def getActions(self):
+        """{name: action} where each action has .name, .action, .length
+        and .motiondata"""
+        raise NotImplementedError
+
+    def getEvents(self):
+        """List of events with .eventname, .category, .time and .volume"""
+        raise NotImplementedError
+
+    def getObject(self, name):
+        raise NotImplementedError
+
+    def getLocation(self, name):
+        raise NotImplementedError
+
+    def getRotation(self, name):
+        raise NotImplementedError
+
+    def getDimensions(self, name):
+        raise NotImplementedError
+
+    def getBoundsCentre(self, name):
+        """The middle of the world space bounding box of an object"""
+        raise NotImplementedError
+
+    def getVertices(self, name):
+        """World space positions of the vertices of an object"""
+        raise NotImplementedError
+
+    def rayCast(self, name, point, direction):
+        """Cast a ray against the mesh of an object. point is relative to the
+        location of the object.
+
+        :returns: location, normal, index, distance (all None if missed)"""
+        raise NotImplementedError
+
+    def isSelected(self, name):
+        raise NotImplementedError
+
+    def getActiveName(self):
+        """The name of the active object or None"""
+        raise NotImplementedError
+
+    def initAgent(self, name):
+        """Clear any old animation from an agent"""
+        raise NotImplementedError
+
+    def setTransform(self, name, location, rotation, frame):
+        """Move an agent and record its position for this frame"""
+        raise NotImplementedError
+
+    def setPose(self, name, location, rotation):
+        """Move an agent without keyframing it"""
+        raise NotImplementedError
+
+    def writeKeyframes(self, name, frames, locations, rotations):
+        """Keyframe many frames of an agent at once (see iai_bakeOutput)
+
+        :param frames: (f,) array
+        :param locations: (f, 3) array
+        :param rotations: (f, 3) array"""
+        raise NotImplementedError
+
+    def playAction(self, name, action, frame):
+        """Start playing action on the agent"""
+        raise NotImplementedError
+
+    def colourNode(self, bpyNode, hsv):
+        """Show the output of a node in the interface"""
+        pass
+
+
+class BlenderSceneAdapter(SceneAdapter):
+    """Reads from and writes to a Blender scene"""
+    def __init__(self, scene=None):
+        SceneAdapter.__init__(self)
+        self.scene = scene if scene is not None else bpy.context.scene
+        self.objects = bpy.data.objects
+        self.groundTrees = {}
+
+    @property
+    def frameCurrent(self):
+        return self.scene.frame_current
+
+    @frameCurrent.setter
+    def frameCurrent(self, frame):
+        self.scene.frame_current = frame
+
+    def advanceFrame(self, frame):
+        # Unlike scene.frame_set this doesn't evaluate the scene or call the
+        # frame_change handlers
+        self.scene.frame_current = frame
+
+    def getFrameRange(self):
+        return self.scene.frame_start, self.scene.frame_end
+
+    def addFrameHandler(self, func):
+        bpy.app.handlers.frame_change_pre.append(func)
+
+    def removeFrameHandler(self, func):
+        bpy.app.handlers.frame_change_pre.remove(func)
+
+    def hasFrameHandler(self, func):
+        return func in bpy.app.handlers.frame_change_pre
+
+    def getAgents(self):
+        return self.scene.iai_agents.coll
+
+    def getBrainType(self, agentName):
+        group = self.scene.iai_agents.coll[agentName].group
+        return self.scene.iai_groups.coll[group-1].type
+
+    def getBrainGraph(self, brainType):
+        from .iai_compileBrain import describeNodeGroup
+        if brainType in bpy.data.node_groups:
+            return describeNodeGroup(bpy.data.node_groups[brainType])
+        return None
+
+    def getActions(self):
+        from .iai_actions import getmotions
+        return getmotions()
+
+    def getEvents(self):
+        return self.scene.iai_events.coll
+
+    def getObject(self, name):
+        return self.objects[name]
+
+    def getLocation(self, name):
+        return numpy.array(self.objects[name].location)
+
+    def getRotation(self, name):
+        return numpy.array(self.objects[name].rotation_euler)
+
+    def getDimensions(self, name):
+        return numpy.array(self.objects[name].dimensions)
+
+    def getBoundsCentre(self, name):
+        from mathutils import Vector
+        ob = self.objects[name]
+        wrld = self.matrixWorld(ob)
+        corners = numpy.array([tuple(wrld * Vector(c))
+                               for c in ob.bound_box])
+        return (corners.min(axis=0) + corners.max(axis=0)) / 2
+
+    def getVertices(self, name):
+        ob = self.objects[name]
+        wrld = self.matrixWorld(ob)
+        return [numpy.array(wrld * v.co) for v in ob.data.vertices]
+
+    @staticmethod
+    def matrixWorld(ob):
+        """matrix_world is only updated when the scene is evaluated which
+        doesn't happen while baking. matrix_basis is always up to date"""
+        if ob.parent is None:
+            return ob.matrix_basis
+        return ob.matrix_world
+
+    def rayCast(self, name, point, direction):
+        if name not in self.groundTrees:
+            from mathutils.bvhtree import BVHTree
+            gnd = self.objects[name]
+            r = gnd.rotation_euler
+            if not (r[0] or r[1] or r[2]):
+                print(name, "rotation must be applied")
+                # TODO make ray_cast work with rotation
+            self.groundTrees[name] = BVHTree.FromObject(gnd, self.scene)
+        loc, norm, ind, dist = self.groundTrees[name].ray_cast(point,
+                                                               direction)
+        if loc is None:
+            return None, None, None, None
+        return numpy.array(loc), numpy.array(norm), ind, dist
+
+    def isSelected(self, name):
+        return self.objects[name].select
+
+    def getActiveName(self):
+        active = bpy.context.active_object
+        return active.name if active else None
+
+    def initAgent(self, name):
+        ob = self.objects[name]
+        ob.animation_data_clear()
+        ob.keyframe_insert(data_path="location", frame=1)
+        ob.keyframe_insert(data_path="rotation_euler", frame=1)
+
+    def setTransform(self, name, location, rotation, frame):
+        ob = self.objects[name]
+
+        if ob.animation_data:
+            ob.animation_data.action_extrapolation = 'HOLD_FORWARD'
+            ob.animation_data.action_blend_type = 'ADD'
+
+        """Set objects rotation and location"""
+        ob.rotation_euler = rotation
+        ob.location = location
+        if ob.animation_data:
+            for track in ob.animation_data.nla_tracks:
+                track.mute = False
+
+        """Set the keyframes"""
+        ob.keyframe_insert(data_path="rotation_euler", frame=frame)
+        ob.keyframe_insert(data_path="location", frame=frame)
+
+    def setPose(self, name, location, rotation):
+        ob = self.objects[name]
+        ob.rotation_euler = rotation
+        ob.location = location
+
+    def writeKeyframes(self, name, frames, locations, rotations):
+        ob = self.objects[name]
+        if ob.animation_data is None:
+            ob.animation_data_create()
+        animData = ob.animation_data
+        animData.action_extrapolation = 'HOLD_FORWARD'
+        animData.action_blend_type = 'ADD'
+        for track in animData.nla_tracks:
+            track.mute = False
+        if animData.action is None:
+            animData.action = bpy.data.actions.new(name + "Action")
+        fcurves = animData.action.fcurves
+
+        for data_path, values in (("location", locations),
+                                  ("rotation_euler", rotations)):
+            for axis in range(3):
+                fc = fcurves.find(data_path, axis)
+                if fc is None:
+                    fc = fcurves.new(data_path, axis)
+                points = fc.keyframe_points
+                existing = len(points)
+                co = numpy.empty(2 * (existing + len(frames)))
+                if existing:
+                    points.foreach_get("co", co[:2 * existing])
+                co[2 * existing::2] = frames
+                co[2 * existing + 1::2] = values[:, axis]
+                points.add(len(frames))
+                points.foreach_set("co", co)
+                fc.update()
+
+    def playAction(self, name, action, frame):
+        obj = self.scene.objects[name]  # bpy object
+
+        tr = obj.animation_data.nla_tracks.new()  # NLA track
+        if action.action:
+            strip = tr.strips.new("", frame, action.action)
+            strip.extrapolation = 'NOTHING'
+            strip.use_auto_blend = True
+
+    def colourNode(self, bpyNode, hsv):
+        from mathutils import Color
+        bpyNode.use_custom_color = True
+        c = Color()
+        c.hsv = hsv
+        bpyNode.color = c
+        bpyNode.keyframe_insert("color")
+
+    def describeObject(self, name):
+        ob = self.objects[name]
+        result = {"name": name,
+                  "location": list(ob.location),
+                  "rotation": list(ob.rotation_euler),
+                  "scale": list(ob.scale),
+                  "dimensions": list(ob.dimensions),
+                  "select": ob.select}
+        if ob.parent is not None:
+            # What matrix_world adds to matrix_basis
+            parent = ob.parent.matrix_world * ob.matrix_parent_inverse
+            result["parent"] = [list(row) for row in parent]
+        if ob.type == 'MESH':
+            result["vertices"] = [list(v.co) for v in ob.data.vertices]
+            result["polygons"] = [list(p.vertices) for p in ob.data.polygons]
+        return result
+
+    def describeScene(self):
+        """Turn everything the simulation uses into a description that can
+        be loaded by MemorySceneAdapter"""
+        agents = [ag.name for ag in self.getAgents()]
+        events = [{"eventname": e.eventname, "category": e.category,
+                   "time": e.time, "volume": e.volume}
+                  for e in self.getEvents()]
+        objects = set(agents)
+        objects.update(e["volume"] for e in events if e["volume"])
+
+        brains = {}
+        for g in self.scene.iai_groups.coll:
+            if g.type not in brains:
+                graph = self.getBrainGraph(g.type)
+                if graph is not None:
+                    brains[g.type] = [{k: v for k, v in n.items()
+                                       if k != "bpyNode"} for n in graph]
+
+        actions = []
+        for act in self.getActions().values():
+            actions.append({"name": act.name, "length": act.length,
+                            "motiondata": act.motiondata})
+
+        return {"frameStart": self.scene.frame_start,
+                "frameEnd": self.scene.frame_end,
+                "active": self.getActiveName(),
+                "objects": [self.describeObject(o) for o in sorted(objects)
+                            if o in self.objects],
+                "agents": [{"name": ag.name, "group": ag.group}
+                           for ag in self.getAgents()],
+                "groups": [{"name": g.name, "type": g.type}
+                           for g in self.scene.iai_groups.coll],
+                "brains": brains,
+                "actions": actions,
+                "events": events}
+
+    def saveDescription(self, path):
+        with open(path, "w") as f:
+            json.dump(self.describeScene(), f)
+
+
+class MemoryObject:
+    """Impersonates the parts of a bpy object that the simulation uses"""
+    def __init__(self, name, location=(0, 0, 0), rotation=(0, 0, 0),
+                 dimensions=(1, 1, 1), select=False, vertices=None,
+                 polygons=None, scale=(1, 1, 1), parent=None):
+        """:param parent: 4x4 matrix of the transform of the parent (see
+            BlenderSceneAdapter.describeObject) or None"""
+        self.name = name
+        self.location = numpy.array(location, dtype=float)
+        self.rotation_euler = numpy.array(rotation, dtype=float)
+        self.scale = numpy.array(scale, dtype=float)
+        if parent is not None:
+            parent = numpy.array(parent, dtype=float)
+        self.parent = parent
+        self.dimensions = numpy.array(dimensions, dtype=float)
+        self.select = select
+        if vertices:
+            self.vertices = numpy.array(vertices, dtype=float)
+        else:
+            self.vertices = None
+        self.polygons = polygons or []
+        self.triangles = None
+
+    def toWorld(self, points):
+        """Object space points to world space, the same as matrix_world"""
+        points = toWorld(self.rotation_euler, points * self.scale) + \
+            self.location
+        if self.parent is not None:
+            points = points @ self.parent[:3, :3].T + self.parent[:3, 3]
+        return points
+
+    def worldVertices(self):
+        return self.toWorld(self.vertices)
+
+    def boundBox(self):
+        """The 8 corners of the object space bounding box (bound_box)"""
+        lo = self.vertices.min(axis=0)
+        hi = self.vertices.max(axis=0)
+        return numpy.array([[(lo, hi)[i][0], (lo, hi)[j][1], (lo, hi)[k][2]]
+                            for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+
+    def getTriangles(self):
+        """(n, 3, 3) array of the corners of the triangulated polygons"""
+        if self.triangles is None:
+            tris = []
+            for poly in self.polygons:
+                for i in range(1, len(poly) - 1):
+                    tris.append((poly[0], poly[i], poly[i + 1]))
+            if tris:
+                self.triangles = self.vertices[numpy.array(tris)]
+            else:
+                self.triangles = numpy.zeros((0, 3, 3))
+        return self.triangles
+
+
+class MemoryAction:
+    """Impersonates iai_motion.Action"""
+    def __init__(self, name, length, motiondata):
+        self.name = name
+        self.action = None
+        self.length = length
+        self.motiondata = motiondata
+
+
+class MemorySceneAdapter(SceneAdapter):
+    """A scene that only exists in memory. Loaded from a scene description so
+    that the simulation can be run without Blender"""
+    def __init__(self, description):
+        SceneAdapter.__init__(self)
+        self.description = description
+        self.frameStart = description.get("frameStart", 1)
+        self.frameEnd = description.get("frameEnd", 250)
+        self.activeName = description.get("active")
+        self._frameCurrent = self.frameStart
+        self.handlers = []
+
+        self.objects = {}
+        for o in description.get("objects", []):
+            self.objects[o["name"]] = MemoryObject(
+                o["name"], o.get("location", (0, 0, 0)),
+                o.get("rotation", (0, 0, 0)), o.get("dimensions", (1, 1, 1)),
+                o.get("select", False), o.get("vertices"), o.get("polygons"),
+                o.get("scale", (1, 1, 1)), o.get("parent"))
+
+        self.agents = [SimpleNamespace(**a)
+                       for a in description.get("agents", [])]
+        self.groups = [SimpleNamespace(**g)
+                       for g in description.get("groups", [])]
+        self.brains = description.get("brains", {})
+        self.actions = {a["name"]: MemoryAction(a["name"], a["length"],
+                                                a["motiondata"])
+                        for a in description.get("actions", [])}
+        self.events = [SimpleNamespace(**e)
+                       for e in description.get("events", [])]
+
+        # {name: {frame: (location, rotation)}} The output of the simulation
+        self.keyframes = {}
+        # {name: [(frame, action name), ]}
+        self.strips = {}
+
+    @classmethod
+    def fromFile(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def describeScene(self):
+        return self.description
+
+    @property
+    def frameCurrent(self):
+        return self._frameCurrent
+
+    @frameCurrent.setter
+    def frameCurrent(self, frame):
+        """Behaves like Blender by calling the frame change handlers"""
+        self._frameCurrent = frame
+        for func in list(self.handlers):
+            func(self)
+
+    def advanceFrame(self, frame):
+        self._frameCurrent = frame
+
+    def getFrameRange(self):
+        return self.frameStart, self.frameEnd
+
+    def addFrameHandler(self, func):
+        self.handlers.append(func)
+
+    def removeFrameHandler(self, func):
+        self.handlers.remove(func)
+
+    def hasFrameHandler(self, func):
+        return func in self.handlers
+
+    def getAgents(self):
+        return self.agents
+
+    def getBrainType(self, agentName):
+        for ag in self.agents:
+            if ag.name == agentName:
+                return self.groups[ag.group-1].type
+
+    def getBrainGraph(self, brainType):
+        return self.brains.get(brainType)
+
+    def getActions(self):
+        return self.actions
+
+    def getEvents(self):
+        return self.events
+
+    def getObject(self, name):
+        return self.objects[name]
+
+    def getLocation(self, name):
+        return self.objects[name].location.copy()
+
+    def getRotation(self, name):
+        return self.objects[name].rotation_euler.copy()
+
+    def getDimensions(self, name):
+        return self.objects[name].dimensions.copy()
+
+    def getBoundsCentre(self, name):
+        ob = self.objects[name]
+        if ob.vertices is None:
+            return ob.toWorld(numpy.zeros((1, 3)))[0]
+        corners = ob.toWorld(ob.boundBox())
+        return (corners.min(axis=0) + corners.max(axis=0)) / 2
+
+    def getVertices(self, name):
+        ob = self.objects[name]
+        if ob.vertices is None:
+            return []
+        return list(ob.worldVertices())
+
+    def rayCast(self, name, point, direction):
+        """Moller-Trumbore against every triangle of the object"""
+        tris = self.objects[name].getTriangles()
+        if len(tris) == 0:
+            return None, None, None, None
+        point = numpy.asarray(point, dtype=float)
+        direction = numpy.asarray(direction, dtype=float)
+        v0, v1, v2 = tris[:, 0], tris[:, 1], tris[:, 2]
+        e1 = v1 - v0
+        e2 = v2 - v0
+        p = numpy.cross(direction, e2)
+        det = numpy.einsum("ij,ij->i", e1, p)
+        valid = numpy.abs(det) > 1e-12
+        inv = numpy.where(valid, 1 / numpy.where(valid, det, 1), 0)
+        t = point - v0
+        u = numpy.einsum("ij,ij->i", t, p) * inv
+        q = numpy.cross(t, e1)
+        v = (q @ direction) * inv
+        dist = numpy.einsum("ij,ij->i", e2, q) * inv
+        hit = valid & (u >= 0) & (v >= 0) & (u + v <= 1) & (dist >= 0)
+        if not hit.any():
+            return None, None, None, None
+        ind = int(numpy.argmin(numpy.where(hit, dist, numpy.inf)))
+        norm = numpy.cross(e1[ind], e2[ind])
+        norm /= numpy.linalg.norm(norm)
+        return point + direction * dist[ind], norm, ind, float(dist[ind])
+
+    def isSelected(self, name):
+        return self.objects[name].select
+
+    def getActiveName(self):
+        return self.activeName
+
+    def initAgent(self, name):
+        ob = self.objects[name]
+        self.keyframes[name] = {1: (tuple(ob.location.tolist()),
+                                    tuple(ob.rotation_euler.tolist()))}
+        self.strips[name] = []
+
+    def setTransform(self, name, location, rotation, frame):
+        ob = self.objects[name]
+        ob.location = numpy.array(location, dtype=float)
+        ob.rotation_euler = numpy.array(rotation, dtype=float)
+        self.keyframes[name][frame] = (tuple(float(x) for x in location),
+                                       tuple(float(x) for x in rotation))
+
+    def setPose(self, name, location, rotation):
+        ob = self.objects[name]
+        ob.location = numpy.array(location, dtype=float)
+        ob.rotation_euler = numpy.array(rotation, dtype=float)
+
+    def writeKeyframes(self, name, frames, locations, rotations):
+        keys = self.keyframes[name]
+        for frame, loc, rot in zip(frames.tolist(), locations.tolist(),
+                                   rotations.tolist()):
+            keys[int(frame)] = (tuple(loc), tuple(rot))
+
+    def playAction(self, name, action, frame):
+        self.strips[name].append((frame, action.name))
+
+
+if __name__ == "__main__":
+    import math
+    import unittest
+
+    def matrixBasis(location, rotation, scale):
+        """Blender's matrix_basis: location * RotZ * RotY * RotX * scale"""
+        rx, ry, rz = rotation
+        x = numpy.array(((1, 0, 0), (0, math.cos(rx), -math.sin(rx)),
+                         (0, math.sin(rx), math.cos(rx))))
+        y = numpy.array(((math.cos(ry), 0, math.sin(ry)), (0, 1, 0),
+                         (-math.sin(ry), 0, math.cos(ry))))
+        z = numpy.array(((math.cos(rz), -math.sin(rz), 0),
+                         (math.sin(rz), math.cos(rz), 0), (0, 0, 1)))
+        result = numpy.identity(4)
+        result[:3, :3] = z @ y @ x @ numpy.diag(scale)
+        result[:3, 3] = location
+        return result
+
+    def transform(matrix, points):
+        return numpy.array(points) @ matrix[:3, :3].T + matrix[:3, 3]
+
+    class Test(unittest.TestCase):
+        def setUp(self):
+            self.verts = [[-1, -1, 0], [1, -1, 0], [1, 1, 2], [-1, 1, 2]]
+            self.parent = matrixBasis([10, 0, 0], [0, 0, math.pi / 2],
+                                      [2, 2, 2])
+            self.scene = MemorySceneAdapter({"objects": [
+                {"name": "scaled", "location": [1, 2, 3],
+                 "rotation": [0.3, 0.2, 1], "scale": [2, 1, 0.5],
+                 "vertices": self.verts, "polygons": [[0, 1, 2, 3]]},
+                {"name": "child", "location": [1, 2, 3],
+                 "rotation": [0.3, 0.2, 1], "scale": [2, 1, 0.5],
+                 "parent": self.parent.tolist(),
+                 "vertices": self.verts, "polygons": [[0, 1, 2, 3]]},
+                {"name": "empty", "location": [1, 2, 3],
+                 "parent": self.parent.tolist()}]})
+
+        def check(self, name, matrix):
+            """getVertices and getBoundsCentre against matrix_world"""
+            expected = transform(matrix, self.verts)
+            got = numpy.array(self.scene.getVertices(name))
+            self.assertTrue(numpy.allclose(got, expected))
+            # The bounds are the object space bound_box moved into world
+            #  space
+            corners = transform(matrix, [[x, y, z] for x in (-1, 1)
+                                         for y in (-1, 1) for z in (0, 2)])
+            centre = (corners.min(axis=0) + corners.max(axis=0)) / 2
+            self.assertTrue(numpy.allclose(self.scene.getBoundsCentre(name),
+                                           centre))
+
+        def testScale(self):
+            self.check("scaled", matrixBasis([1, 2, 3], [0.3, 0.2, 1],
+                                             [2, 1, 0.5]))
+
+        def testParent(self):
+            self.check("child", self.parent @ matrixBasis(
+                [1, 2, 3], [0.3, 0.2, 1], [2, 1, 0.5]))
+
+        def testNoVertices(self):
+            self.assertEqual(self.scene.getVertices("empty"), [])
+            self.assertTrue(numpy.allclose(self.scene.getBoundsCentre("empty"),
+                                           transform(self.parent, [1, 2, 3])))
+
+    # Run unit test
+    unittest.main()
@@ -1,21 +1,61 @@
-import bpy
 from collections import OrderedDict
 
+import os
 import sys
 import time
-from .iai_debuggingMode import debugMode
 
 from . import iai_channels as chan
 wr = chan.Wrapper
 
 from .iai_agent import Agent
-from .iai_actions import getmotions
+from .iai_compileBrain import compileBrain
+from .iai_nodeFunctions import MotionDeltas
+from .iai_brainBatch import executeBatch
+from .iai_agentState import AgentStateTable, OrientationCache
+from .iai_bakeOutput import BakeOutput
+from .iai_tagRegistry import TagRegistry
+from .iai_parallel import ParallelStepper
+from .iai_random import RandomStreams
+from .iai_profiler import Profiler
+from . import iai_checkpoint
+from .iai_sceneAdapter import BlenderSceneAdapter
 
 
 class Simulation():
     """The object that contains everything once the simulation starts"""
-    def __init__(self):
+    def __init__(self, scene=None, seed=0, codegen=False, batch=False,
+                 optimise=True):
+        """:param scene: the SceneAdapter to simulate. Defaults to the current
+        Blender scene
+        :param seed: changes all the random numbers used (see iai_random)
+        :param codegen: compile each brain into a python function (see
+            iai_brainCodegen) instead of evaluating the nodes one by one
+        :param batch: evaluate the brains of all the agents with the same
+            brain type together (see iai_brainBatch)
+        :param optimise: fold constants and remove unused nodes from the
+            brains (see iai_compileBrain.optimiseBrain)"""
+        if scene is None:
+            scene = BlenderSceneAdapter()
+        self.scene = scene
         self.agents = {}
+        self.state = AgentStateTable()
+        # The rotation matrices of the agents for the channels
+        self.orientations = OrientationCache(self)
+        self.rng = RandomStreams(seed)
+        self.codegen = codegen
+        self.batch = batch
+        self.optimise = optimise
+        # None means every agent is keyframed as soon as it is moved
+        self.bakeOutput = None
+        # Set by startParallel to evaluate the agents in worker processes
+        self.parallel = None
+        # Set by enableProfiler
+        self.profiler = None
+        # Set by enableHighlights
+        self.highlightFrames = None
+        # Set by autoCheckpoint
+        self.checkpointDir = None
+        self.checkpointEvery = 0
         self.framelast = 1
         self.compbrains = {}
         Noise = chan.Noise(self)
@@ -25,6 +65,12 @@ class Simulation():
         Crowd = chan.Crowd(self)
         Ground = chan.Ground(self)
         Formation = chan.Formation(self)
+        self.tagRegistry = TagRegistry()
+        for name, channel in (("Noise", Noise), ("Sound", Sound),
+                              ("State", State), ("World", World),
+                              ("Crowd", Crowd), ("Ground", Ground),
+                              ("Formation", Formation)):
+            self.tagRegistry.subscribe(name, channel)
         self.lvars = {"Noise": wr(Noise),
                       "Sound": wr(Sound),
                       "State": wr(State),
@@ -32,21 +78,94 @@ class Simulation():
                       "Crowd": wr(Crowd),
                       "Ground": wr(Ground),
                       "Formation": wr(Formation)}
-        if debugMode:
-            self.totalTime = 0
-            self.totalFrames = 0
 
     def actions(self):
         """Set up the actions"""
-        self.actions = getmotions()
+        self.actions = self.scene.getActions()
+        self.motionDeltas = {name: MotionDeltas(act)
+                             for name, act in self.actions.items()}
+
+    def bufferKeyframes(self, flushEvery=None):
+        """Stop keyframing agents every frame and instead write all the
+        keyframes in bulk with flushKeyframes (or every flushEvery frames).
+        Much faster for big crowds but the F-curves aren't up to date until
+        they are flushed"""
+        self.bakeOutput = BakeOutput(self, flushEvery)
+
+    def flushKeyframes(self):
+        """Write any keyframes buffered by bufferKeyframes"""
+        if self.bakeOutput is not None:
+            self.bakeOutput.flush()
+
+    def enableProfiler(self):
+        """Start recording how long each part of each frame takes (see
+        iai_profiler). Returns the Profiler"""
+        self.profiler = Profiler()
+        return self.profiler
+
+    def disableProfiler(self):
+        self.profiler = None
+
+    def enableHighlights(self, frames=250):
+        """Keep what the nodes of the selected agents output for the last
+        so many frames so that the nodes of the active agent can be coloured
+        in the node editor (see BrainInstance.hightLight)"""
+        self.highlightFrames = frames
+
+    def disableHighlights(self):
+        self.highlightFrames = None
+
+    def saveCheckpoint(self, path):
+        """Save the state of the simulation at the end of the last frame
+        simulated (see iai_checkpoint)"""
+        iai_checkpoint.save(self, path)
+
+    def loadCheckpoint(self, path):
+        """Carry on from a checkpoint made by saveCheckpoint. Must be called
+        straight after createAgents on a new Simulation of the same scene"""
+        iai_checkpoint.load(self, path)
+
+    def autoCheckpoint(self, directory, every):
+        """Save a checkpoint into directory every so many frames. Use
+        iai_checkpoint.findCheckpoint to find the one to carry on from.
+
+        :param every: 0 to stop making checkpoints"""
+        if every and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.checkpointDir = directory
+        self.checkpointEvery = every
+
+    def startParallel(self, workers=None):
+        """Evaluate the agents in several processes (see iai_parallel). Call
+        after createAgents. The results are the same as in a single
+        process"""
+        self.stopParallel()
+        self.parallel = ParallelStepper(self, workers)
+
+    def stopParallel(self):
+        if self.parallel is not None:
+            # Bring the brains in this process up to date so that the
+            #  simulation can carry on without the workers
+            meta = self.parallel.checkpointMeta()
+            iai_checkpoint.loadBrains(self, meta)
+            iai_checkpoint.loadFormations(self.lvars["Formation"].channel,
+                                          meta["formations"])
+            self.parallel.stop()
+            self.parallel = None
 
     def newagent(self, name):
         """Set up an agent"""
-        group = bpy.context.scene.iai_agents.coll[name].group
-        groupEntry = bpy.context.scene.iai_groups.coll[group-1]
-        ty = bpy.context.scene.iai_groups.coll[group-1].type
-        if ty in bpy.data.node_groups:
-            ag = Agent(name, bpy.data.node_groups[ty], self)
+        ty = self.scene.getBrainType(name)
+        if ty not in self.compbrains:
+            """Each brain type is only compiled once and then shared by all
+            of the agents that use it"""
+            brainGraph = self.scene.getBrainGraph(ty)
+            if brainGraph is not None:
+                brainGraph = compileBrain(brainGraph, self)
+            self.compbrains[ty] = brainGraph
+        compiled = self.compbrains[ty]
+        if compiled is not None:
+            ag = Agent(name, compiled, self)
             self.agents[name] = ag
         else:
             print("No such brain type:" + ty)
@@ -58,52 +177,138 @@ class Simulation():
 
     def step(self, scene):
         """Called when the next frame is moved to"""
-        if debugMode:
-            t = time.time()
-        print("NEWFRAME", bpy.context.scene.frame_current)
-        for agent in self.agents.values():
-            for tag in agent.access["tags"]:
-                for channel in self.lvars:
-                    if tag[:len(channel)] == channel:
-                        self.lvars[channel].register(agent, tag[len(channel):],
-                                                     agent.access["tags"][tag])
-        # TODO registering channels would be much more efficient if done
-        # straight after the agent is evaluated.
-        for a in self.agents.values():
-            a.step()
+        prof = self.profiler
+        print("NEWFRAME", self.scene.frameCurrent)
+        if prof is not None:
+            prof.beginFrame(self.scene.frameCurrent)
+            t = prof.now()
+        # The channels are told about tags by self.tagRegistry as they change
+        if self.parallel is not None:
+            self.parallel.step()
+        else:
+            self.stepAgents(self.agents.values())
+        if prof is not None:
+            prof.add("brains", t)
+            t = prof.now()
+        self.state.integrate()
+        if prof is not None:
+            prof.add("integrate", t)
+            t = prof.now()
         for a in self.agents.values():
             a.apply()
+        self.orientations.clear()
+        if self.bakeOutput is not None:
+            self.bakeOutput.record(self.scene.frameCurrent)
+        if prof is not None:
+            prof.add("apply", t)
+            t = prof.now()
         for chan in self.lvars.values():
             chan.newframe()
-        if debugMode:
-            newT = time.time()
-            print("time", newT - t)
-            self.totalTime += newT - t
-            self.totalFrames += 1
-            print("spf", self.totalTime/self.totalFrames)  # seconds per frame
+        if prof is not None:
+            prof.add("newframe", t)
+            prof.endFrame()
+        if self.checkpointEvery and self.framelast % self.checkpointEvery == 0:
+            self.saveCheckpoint(iai_checkpoint.checkpointPath(
+                self.checkpointDir, self.framelast))
+
+    def stepAgents(self, agents):
+        """Evaluate the brains of agents for the current frame"""
+        if not self.batch:
+            for a in agents:
+                a.step()
+            return
+        groups = OrderedDict()
+        for a in agents:
+            groups.setdefault(a.brain.compiled, []).append(a)
+        for compiled, group in groups.items():
+            executeBatch(compiled, [a.brain for a in group])
+        for a in agents:
+            a.finishStep()
+
+    def bake(self, frameStart=None, frameEnd=None, flushEvery=None,
+             progress=None, workers=None):
+        """Run the simulation over a range of frames in one go instead of
+        waiting for the scene to change frame. The scene isn't updated
+        between frames and the keyframes are written in bulk. The frame
+        change handler (if there is one) is put back afterwards, even if
+        the bake fails.
+
+        :param frameStart: defaults to the frame after the last simulated
+        :param frameEnd: defaults to the last frame of the scene
+        :param flushEvery: see bufferKeyframes
+        :param progress: func(frame, done, total, eta) called after each frame
+            (eta in seconds). Defaults to printing the progress
+        :param workers: if given the agents are evaluated in this many
+            processes for the duration of the bake (see startParallel)"""
+        if frameStart is None:
+            frameStart = self.framelast + 1
+        if frameEnd is None:
+            frameEnd = self.scene.getFrameRange()[1]
+
+        # Scrubbing through the scene carries on working after the bake
+        handler = self.scene.hasFrameHandler(self.frameChangeHandler)
+        self.stopFrameHandler()
+        buffered = self.bakeOutput is not None
+        parallel = self.parallel is not None
+        finished = False
+        try:
+            if not buffered:
+                self.bufferKeyframes(flushEvery)
+            if workers is not None and not parallel:
+                self.startParallel(workers)
+
+            total = frameEnd - frameStart + 1
+            startTime = time.time()
+            for done, frame in enumerate(range(frameStart, frameEnd + 1), 1):
+                self.scene.advanceFrame(frame)
+                self.framelast = frame
+                self.step(self.scene)
+
+                elapsed = time.time() - startTime
+                eta = elapsed / done * (total - done)
+                if progress is None:
+                    print("Baked frame {} ({}/{}) ETA {:.1f}s".format(
+                        frame, done, total, eta))
+                else:
+                    progress(frame, done, total, eta)
+            self.flushKeyframes()
+            finished = True
+        finally:
+            if not buffered:
+                # Anything that wasn't flushed because of an error is lost
+                self.bakeOutput = None
+            if self.parallel is not None and not parallel:
+                if finished:
+                    self.stopParallel()
+                else:
+                    # The workers might be what went wrong so they can't be
+                    #  asked for their brains
+                    self.parallel.stop()
+                    self.parallel = None
+            if handler:
+                self.startFrameHandler()
 
     def frameChangeHandler(self, scene):
         """Given to Blender to call whenever the scene moves to a new frame"""
-        if self.framelast+1 == bpy.context.scene.frame_current:
-            self.framelast = bpy.context.scene.frame_current
+        frame = self.scene.frameCurrent
+        if self.framelast+1 == frame:
+            self.framelast = frame
             self.step(scene)
-        if self.framelast >= bpy.context.scene.frame_current:
-            active = bpy.context.active_object
+        if self.framelast >= frame:
+            active = self.scene.getActiveName()
             if active and active in self.agents:
-                self.agents[bpy.context.active_object.name].highLight()
+                self.agents[active].highLight()
 
     def startFrameHandler(self):
-        """Add self.frameChangeHandler to the Blender event handlers"""
-        if debugMode:
-            self.totalTime = 0
-            self.totalFrames = 0
+        """Add self.frameChangeHandler to the scenes frame change handlers"""
         print("Registering frame change handler")
-        if self.frameChangeHandler in bpy.app.handlers.frame_change_pre:
-            bpy.app.handlers.frame_change_pre.remove(self.frameChangeHandler)
-        bpy.app.handlers.frame_change_pre.append(self.frameChangeHandler)
+        if self.scene.hasFrameHandler(self.frameChangeHandler):
+            self.scene.removeFrameHandler(self.frameChangeHandler)
+        self.scene.addFrameHandler(self.frameChangeHandler)
 
     def stopFrameHandler(self):
-        """Remove self.frameChangeHandler from Blenders event handlers"""
-        if self.frameChangeHandler in bpy.app.handlers.frame_change_pre:
+        """Remove self.frameChangeHandler from the scenes handlers"""
+        if self.scene.hasFrameHandler(self.frameChangeHandler):
             print("Unregistering frame change handler")
-            bpy.app.handlers.frame_change_pre.remove(self.frameChangeHandler)
+            self.scene.removeFrameHandler(self.frameChangeHandler)
+        self.flushKeyframes()
@@ -0,0 +1,52 @@
+class TagRegistry:
+    """Keeps track of which agents have which tags so that nothing has to
+    scan every agent each frame.
+
+    Tags that start with the name of a channel (eg. "SoundA") are passed on
+    to that channel as channel.register(agent, "A", value) when they are set
+    and channel.unregister(agent, "A") when they are removed."""
+    def __init__(self):
+        self.tagged = {}  # {tag: {agent id: value}}
+        self.subscribers = {}  # {prefix: channel}
+        self.dispatch = {}  # {tag: [(channel, rest of tag), ]}
+
+    def subscribe(self, prefix, channel):
+        """Send changes of all tags starting with prefix to channel"""
+        self.subscribers[prefix] = channel
+        self.dispatch = {}
+
+    def resolve(self, tag):
+        """Which channels need to know about tag. Only worked out once for
+        each tag"""
+        if tag not in self.dispatch:
+            self.dispatch[tag] = [(ch, tag[len(prefix):])
+                                  for prefix, ch in self.subscribers.items()
+                                  if tag[:len(prefix)] == prefix]
+        return self.dispatch[tag]
+
+    def applyChanges(self, agent, changes):
+        """Update the registry with the tags an agent has set or removed.
+
+        :param changes: {tag: value or None if the tag was removed}"""
+        for tag, value in changes.items():
+            members = self.tagged.get(tag)
+            if value is None:
+                if members is None or agent.id not in members:
+                    continue
+                del members[agent.id]
+                if not members:
+                    del self.tagged[tag]
+                for channel, rest in self.resolve(tag):
+                    channel.unregister(agent, rest)
+            else:
+                if members is None:
+                    members = self.tagged[tag] = {}
+                elif members.get(agent.id) == value:
+                    continue
+                members[agent.id] = value
+                for channel, rest in self.resolve(tag):
+                    channel.register(agent, rest, value)
+
+    def agentsWithTag(self, tag):
+        """{agent id: value} for all the agents with tag"""
+        return self.tagged.get(tag, {})
@@ -0,0 +1,51 @@
+import numpy
+
+
+def rotationMatrix(rx, ry, rz):
+    """The 3x3 equivalent of mathutils.Matrix.Rotation(rx, 'X') *
+    Matrix.Rotation(ry, 'Y') * Matrix.Rotation(rz, 'Z')"""
+    cx, sx = numpy.cos(rx), numpy.sin(rx)
+    cy, sy = numpy.cos(ry), numpy.sin(ry)
+    cz, sz = numpy.cos(rz), numpy.sin(rz)
+    x = numpy.array(((1, 0, 0), (0, cx, -sx), (0, sx, cx)))
+    y = numpy.array(((cy, 0, sy), (0, 1, 0), (-sy, 0, cy)))
+    z = numpy.array(((cz, -sz, 0), (sz, cz, 0), (0, 0, 1)))
+    return x @ y @ z
+
+
+def toLocal(rotation, vector):
+    """Rotate a world space vector into the frame of reference of an object
+    with rotation_euler == rotation. Same as the old mathutils version:
+    vector * (RotX * RotY * RotZ)"""
+    return numpy.asarray(vector, dtype=float) @ rotationMatrix(*rotation)
+
+
+def toWorld(rotation, vector):
+    """Rotate a vector from the frame of reference of an object into world
+    space. Used by Agent.step to turn movement into a change of position"""
+    rx, ry, rz = rotation
+    return numpy.asarray(vector, dtype=float) @ rotationMatrix(-rx, -ry, -rz)
+
+
+def rotationMatrices(rotations):
+    """Batched version of rotationMatrix.
+
+    :param rotations: (n, 3) array of euler rotations
+    :returns: (n, 3, 3) array"""
+    rotations = numpy.asarray(rotations, dtype=float)
+    c = numpy.cos(rotations)
+    s = numpy.sin(rotations)
+    cx, cy, cz = c[:, 0], c[:, 1], c[:, 2]
+    sx, sy, sz = s[:, 0], s[:, 1], s[:, 2]
+    result = numpy.empty((len(rotations), 3, 3))
+    # Rx * Ry * Rz multiplied out
+    result[:, 0, 0] = cy*cz
+    result[:, 0, 1] = -cy*sz
+    result[:, 0, 2] = sy
+    result[:, 1, 0] = sx*sy*cz + cx*sz
+    result[:, 1, 1] = -sx*sy*sz + cx*cz
+    result[:, 1, 2] = -sx*cy
+    result[:, 2, 0] = -cx*sy*cz + sx*sz
+    result[:, 2, 1] = cx*sy*sz + sx*cz
+    result[:, 2, 2] = cx*cy
+    return result